@@ -0,0 +1,499 @@
+#!/usr/bin/python
+
+#
+# File: EPFBenchmark.py
+# Abstract: Generates synthetic EPF files and measures the throughput of the EPFParser and EPFIngester code paths.
+# Version: 1.0
+# 
+# Disclaimer: IMPORTANT:  This Apple software is supplied to you by Apple
+# Inc. ("Apple") in consideration of your agreement to the following
+# terms, and your use, installation, modification or redistribution of
+# this Apple software constitutes acceptance of these terms.  If you do
+# not agree with these terms, please do not use, install, modify or
+# redistribute this Apple software.
+# 
+# In consideration of your agreement to abide by the following terms, and
+# subject to these terms, Apple grants you a personal, non-exclusive
+# license, under Apple's copyrights in this original Apple software (the
+# "Apple Software"), to use, reproduce, modify and redistribute the Apple
+# Software, with or without modifications, in source and/or binary forms;
+# provided that if you redistribute the Apple Software in its entirety and
+# without modifications, you must retain this notice and the following
+# text and disclaimers in all such redistributions of the Apple Software.
+# Neither the name, trademarks, service marks or logos of Apple Inc. may
+# be used to endorse or promote products derived from the Apple Software
+# without specific prior written permission from Apple.  Except as
+# expressly stated in this notice, no other rights or licenses, express or
+# implied, are granted by Apple herein, including but not limited to any
+# patent rights that may be infringed by your derivative works or by other
+# works in which the Apple Software may be incorporated.
+# 
+# The Apple Software is provided by Apple on an "AS IS" basis.  APPLE
+# MAKES NO WARRANTIES, EXPRESS OR IMPLIED, INCLUDING WITHOUT LIMITATION
+# THE IMPLIED WARRANTIES OF NON-INFRINGEMENT, MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE, REGARDING THE APPLE SOFTWARE OR ITS USE AND
+# OPERATION ALONE OR IN COMBINATION WITH YOUR PRODUCTS.
+# 
+# IN NO EVENT SHALL APPLE BE LIABLE FOR ANY SPECIAL, INDIRECT, INCIDENTAL
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) ARISING IN ANY WAY OUT OF THE USE, REPRODUCTION,
+# MODIFICATION AND/OR DISTRIBUTION OF THE APPLE SOFTWARE, HOWEVER CAUSED
+# AND WHETHER UNDER THEORY OF CONTRACT, TORT (INCLUDING NEGLIGENCE),
+# STRICT LIABILITY OR OTHERWISE, EVEN IF APPLE HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#  
+# Copyright (C) 2010 Apple Inc. All Rights Reserved.
+#
+
+
+import EPFParser
+import os
+import sys
+import time
+import random
+import shutil
+import optparse
+import resource
+import multiprocessing
+
+
+DESCRIPTION = """EPFBenchmark generates synthetic EPF files and times the EPF import code paths against them."""
+
+DATA_DIR = "./EPFBenchmarkData"
+
+#The parse cache used by the parse benchmark; emptied before each run
+PARSE_CACHE_DIR = os.path.join(DATA_DIR, "cache")
+
+#Where the export benchmark writes its files
+EXPORT_DIR = os.path.join(DATA_DIR, "exports")
+
+#The SQLite database used by the sink benchmark unless others are given
+SINK_DB_PATH = os.path.join(DATA_DIR, "benchmark.db")
+
+#Column layout of the synthetic files; modeled on the EPF application table,
+#which mixes short numeric fields with long (and sometimes multi-line) text.
+COLUMNS = [("export_date", "BIGINT"),
+    ("application_id", "INTEGER"),
+    ("title", "VARCHAR(1000)"),
+    ("recommended_age", "VARCHAR(20)"),
+    ("artist_name", "VARCHAR(1000)"),
+    ("seller_name", "VARCHAR(1000)"),
+    ("company_url", "VARCHAR(1000)"),
+    ("support_url", "VARCHAR(1000)"),
+    ("view_url", "VARCHAR(1000)"),
+    ("artwork_url_large", "VARCHAR(1000)"),
+    ("artwork_url_small", "VARCHAR(1000)"),
+    ("itunes_release_date", "DATETIME"),
+    ("copyright", "VARCHAR(4000)"),
+    ("description", "LONGTEXT"),
+    ("version", "VARCHAR(100)"),
+    ("itunes_version", "VARCHAR(100)"),
+    ("download_size", "BIGINT")]
+PRIMARY_KEY = ["application_id"]
+
+#Column layout of the date-heavy file used by the fixup benchmark
+DATE_COLUMNS = ([("export_date", "BIGINT"), ("application_id", "INTEGER")] +
+    [("date_%i" % j, "DATETIME") for j in range(10)] + [("title", "VARCHAR(1000)")])
+DATE_FILE_MB = 32
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt "
+    "ut labore et dolore magna aliqua caf\xe9 na\xefve \xfcber r\xe9sum\xe9").split()
+
+
+def _text(rnd, minWords, maxWords):
+    """Returns a string of between minWords and maxWords random words."""
+    return " ".join([rnd.choice(WORDS) for j in range(rnd.randint(minWords, maxWords))])
+
+
+def _record(rnd, recordNum, exportDate):
+    """
+    Returns the list of (string) field values for the recordNumth synthetic record.
+    """
+    appId = str(recordNum + 1)
+    url = "http://example.com/%s/%s" % (_text(rnd, 1, 3).replace(" ", "-"), appId)
+    #Descriptions contain embedded newlines, so most records span several physical lines
+    description = "\n".join([_text(rnd, 5, 40) for j in range(rnd.randint(1, 6))])
+    return [exportDate,
+        appId,
+        _text(rnd, 1, 6),
+        rnd.choice(["4+", "9+", "12+", "17+", ""]),
+        _text(rnd, 1, 3),
+        _text(rnd, 1, 3),
+        url,
+        url + "/support",
+        url + "/view",
+        url + "/large.jpg",
+        url + "/small.jpg",
+        "%04d %02d %02d" % (rnd.randint(2008, 2010), rnd.randint(1, 12), rnd.randint(1, 28)),
+        (_text(rnd, 2, 8) if rnd.random() < 0.8 else ""),
+        description,
+        "%d.%d" % (rnd.randint(1, 5), rnd.randint(0, 9)),
+        "%d.%d" % (rnd.randint(1, 5), rnd.randint(0, 9)),
+        str(rnd.randint(10000, 500000000))]
+
+
+def _dateRecord(rnd, recordNum, exportDate):
+    """
+    Returns the list of (string) field values for the recordNumth record of a DATE_COLUMNS file,
+    mixing the date formats found in EPF exports with the occasional empty date.
+    """
+    dates = []
+    for j in range(10):
+        year, month, day = rnd.randint(1990, 2010), rnd.randint(1, 12), rnd.randint(1, 28)
+        dates.append(rnd.choice(["%04d %02d %02d" % (year, month, day),
+            "%04d-%02d-%02d-00:00:00-Etc/GMT" % (year, month, day), "%04d" % year, ""]))
+    return [exportDate, str(recordNum + 1)] + dates + [_text(rnd, 1, 6)]
+
+
+def generateFile(filePath, sizeMB, recordDelim='\x02\n', fieldDelim='\x01', exportMode="FULL", seed=0,
+        firstRecord=0, exportDate="1276808400000", columns=COLUMNS, recordFunction=_record):
+    """
+    Writes a synthetic EPF file of approximately sizeMB megabytes to filePath,
+    including the usual header comments and recordsWritten trailer.
+    
+    The records' primary keys start from firstRecord + 1, so that an incremental file
+    can be made to overlap a full one. columns and recordFunction give the file's layout
+    and the function that makes each record (for example DATE_COLUMNS and _dateRecord).
+    
+    Returns the number of records written.
+    """
+    rnd = random.Random(seed)
+    targetSize = sizeMB * 1024 * 1024
+    header = [EPFParser.Parser.commentChar + fieldDelim.join([aCol[0] for aCol in columns]),
+        EPFParser.Parser.commentChar + EPFParser.Parser.primaryKeyTag + fieldDelim.join(PRIMARY_KEY),
+        EPFParser.Parser.commentChar + EPFParser.Parser.dataTypesTag + fieldDelim.join([aCol[1] for aCol in columns]),
+        EPFParser.Parser.commentChar + EPFParser.Parser.exportModeTag + exportMode]
+    recordCount = 0
+    with open(filePath, mode="wb") as f:
+        f.write(recordDelim.join(header) + recordDelim)
+        while (f.tell() < targetSize):
+            #write in chunks to keep the number of write calls down
+            chunk = []
+            for j in range(1000):
+                chunk.append(fieldDelim.join(recordFunction(rnd, firstRecord + recordCount, exportDate)) + recordDelim)
+                recordCount += 1
+            f.write("".join(chunk))
+        f.write("%s%s%i%s" % (EPFParser.Parser.commentChar, EPFParser.Parser.recordCountTag, recordCount, recordDelim))
+    return recordCount
+
+
+def _timeParser(filePath, parserArgs, resultQueue):
+    """
+    Reads every record in filePath with a Parser created using parserArgs, and puts
+    a tuple of (record count, elapsed seconds, peak RSS in KB) on resultQueue.
+    
+    Run in a child process so that each measurement gets its own peak RSS.
+    """
+    startTime = time.time()
+    parser = EPFParser.Parser(filePath, **parserArgs)
+    recordCount = 0
+    while (True):
+        records = parser.nextRecords(maxNum=200)
+        if (not records):
+            break
+        recordCount += len(records)
+    elapsed = time.time() - startTime
+    resultQueue.put((recordCount, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def benchmarkParser(filePath, parserArgs):
+    """
+    Returns a tuple of (record count, elapsed seconds, peak RSS in KB) for a complete
+    pass over filePath by a Parser created using parserArgs.
+    """
+    resultQueue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_timeParser, args=(filePath, parserArgs, resultQueue))
+    proc.start()
+    result = resultQueue.get()
+    proc.join()
+    return result
+
+
+def _timeExporter(filePath, exporterArgs, resultQueue):
+    """
+    Exports filePath with an EPFExporter.Exporter created using exporterArgs, and puts a tuple of
+    (record count, elapsed seconds, peak RSS in KB, bytes written) on resultQueue.
+    
+    Run in a child process so that each measurement gets its own peak RSS.
+    """
+    import EPFExporter
+    startTime = time.time()
+    exporter = EPFExporter.Exporter(filePath, **exporterArgs)
+    exporter.ingest()
+    elapsed = time.time() - startTime
+    outputSize = sum([os.path.getsize(aPath) for aPath in exporter.exportPaths])
+    resultQueue.put((exporter.lastRecordIngested + 1, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        outputSize))
+
+
+def benchmarkExporter(filePath, exporterArgs):
+    """
+    Returns a tuple of (record count, elapsed seconds, peak RSS in KB, bytes written) for
+    an export of filePath by an EPFExporter.Exporter created using exporterArgs.
+    """
+    resultQueue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_timeExporter, args=(filePath, exporterArgs, resultQueue))
+    proc.start()
+    result = resultQueue.get()
+    proc.join()
+    return result
+
+
+def verifyParsers(filePath, parserArgsList):
+    """
+    Reads filePath with a Parser for each entry in parserArgsList, checking that every
+    one returns exactly the same records in the same order.
+    
+    Returns None if they all match, otherwise a string describing the first mismatch.
+    """
+    parsers = [EPFParser.Parser(filePath, **someArgs) for someArgs in parserArgsList]
+    baseline = parsers[0]
+    while (True):
+        rec = baseline.nextRecord()
+        for j in range(1, len(parsers)):
+            other = parsers[j].nextRecord()
+            if other != rec:
+                return "Record %i differs for %s: %r != %r" % (baseline.latestRecordNum,
+                    parserArgsList[j], other, rec)
+        if rec is None:
+            return None
+
+
+def benchmarkFixups(filePath):
+    """
+    Times the record fixups (NULL substitution and date massaging) on every record in filePath,
+    done a record at a time as by Parser.nextRecord() and in batches of 200 as by Parser.nextRecords(),
+    checking that both give the same records.
+    
+    Returns a tuple of (record count, per-record seconds, batch seconds, columnar batch seconds);
+    the file is split into records beforehand, so none of the times include reading it.
+    """
+    parser = EPFParser.Parser(filePath)
+    batches = []
+    while (True):
+        records = []
+        for j in range(200):
+            rec = parser._nextSplitRecord()
+            if rec is None:
+                break
+            records.append(rec)
+        if (not records):
+            break
+        batches.append(records)
+    recordCount = sum([len(records) for records in batches])
+    
+    copies = [[list(rec) for rec in records] for records in batches]
+    startTime = time.time()
+    for records in copies:
+        for rec in records:
+            parser._fixupRecord(rec)
+    recordTime = time.time() - startTime
+    
+    startTime = time.time()
+    batchResults = [parser._fixupBatch(records) for records in batches]
+    batchTime = time.time() - startTime
+    if batchResults != copies:
+        raise AssertionError("Batch fixups differ from record-wise fixups")
+    
+    startTime = time.time()
+    for records in batches:
+        parser._fixupBatch(records, columnar=True)
+    columnarTime = time.time() - startTime
+    return (recordCount, recordTime, batchTime, columnarTime)
+
+
+def _report(label, recordCount, elapsed, fileSize, maxRSS=None):
+    """Prints a single line of benchmark results."""
+    line = "%-24s %10i records %8.2fs %10.0f records/s %8.1f MB/s" % (label, recordCount, elapsed,
+        recordCount / elapsed, fileSize / elapsed / 1048576.0)
+    if maxRSS is not None:
+        line += " %8.1f MB peak RSS" % (maxRSS / 1024.0)
+    print line
+    sys.stdout.flush()
+
+
+def main():
+    """
+    Entry point for command-line execution
+    """
+    usage = """usage: %prog [options] command
+    
+    Commands:
+        generate    write the synthetic EPF file only
+        parse       time a full pass over the file with each parser read mode (and with -c, the passes
+                    which write and then read a parse cache of it)
+        ingest      time a full ingest of the file into MySQL with each Ingester engine
+        export      time an export of the file to each columnar format given with -x (by default Parquet
+                    and Arrow IPC), reporting the peak RSS and the size of the exported files
+        sink        time a full ingest of the file into each sink given with -k (by default an SQLite
+                    database in DATA_DIR, which needs no server)
+        fixup       time the per-record and batch record fixups on a date-heavy file (DATA_DIR/dates)
+        merge       time a large incremental ingest into the fully ingested file with each merge strategy;
+                    the incremental file updates the second half of the full file's records and adds as many
+                    new ones (use -m to make the full table 10M+ rows, about 8500 MB)"""
+    op = optparse.OptionParser(description=DESCRIPTION, usage=usage)
+    op.add_option('-f', '--file', dest='filePath', default=os.path.join(DATA_DIR, "application"),
+        help="""Path of the synthetic EPF file; it is generated if it doesn't exist""")
+    op.add_option('-m', '--megabytes', dest='sizeMB', type='int', default=2048,
+        help="""Approximate size of the generated file, in megabytes (default 2048)""")
+    op.add_option('-g', '--regenerate', action='store_true', dest='regenerate', default=False,
+        help="""Regenerate the file even if it already exists""")
+    op.add_option('-r', '--readmode', action='append', dest='readModes',
+        help="""A parser read mode to benchmark; repeated -r arguments will append (default is all modes)""")
+    op.add_option('-v', '--verify', action='store_true', dest='verify', default=False,
+        help="""Check that every read mode returns identical records before timing them""")
+    op.add_option('-e', '--engine', action='append', dest='engines',
+        help="""An Ingester engine to benchmark; repeated -e arguments will append (default is all engines)""")
+    op.add_option('-i', '--incrementalmegabytes', dest='incrementalMB', type='int', default=512,
+        help="""Approximate size of the incremental file generated for the merge benchmark, in megabytes (default 512)""")
+    op.add_option('-s', '--mergestrategy', action='append', dest='mergeStrategies',
+        help="""An incremental merge strategy to benchmark; repeated -s arguments will append (default is all strategies)""")
+    op.add_option('-o', '--sorted', action='store_true', dest='sorted', default=False,
+        help="""For 'ingest', also time each engine with records sorted by primary key first""")
+    op.add_option('-c', '--cache', action='store_true', dest='cache', default=False,
+        help="""For 'parse', also time a pass which writes a parse cache of the file, and one which reads it""")
+    op.add_option('-x', '--exportformat', action='append', dest='exportFormats',
+        help="""An export format to benchmark ('parquet' or 'arrow'); repeated -x arguments will append (default is all formats)""")
+    op.add_option('-b', '--batchrecords', dest='batchRecords', type='int', default=10000,
+        help="""The number of records in each batch of the export benchmark (default 10000); peak memory grows with it""")
+    op.add_option('-k', '--sink', action='append', dest='sinks',
+        help="""A sink URL to benchmark (see EPFSink.sinkFor); repeated -k arguments will append (default is sqlite:///%s)""" % SINK_DB_PATH)
+    op.add_option('-d', '--dbhost', dest='dbHost', default='localhost',
+        help="""The hostname of the database used by the ingest benchmark""")
+    op.add_option('-u', '--dbuser', dest='dbUser', default='epfimporter',
+        help="""The database user used by the ingest benchmark""")
+    op.add_option('-p', '--dbpassword', dest='dbPassword', default='epf123',
+        help="""The database user's password""")
+    op.add_option('-n', '--dbname', dest='dbName', default='epf',
+        help="""The database used by the ingest benchmark""")
+    (options, args) = op.parse_args()
+    
+    if len(args) != 1:
+        op.print_usage()
+        sys.exit()
+    command = args[0]
+    
+    if command == "fixup":
+        datePath = os.path.join(DATA_DIR, "dates")
+        if options.regenerate or not os.path.exists(datePath):
+            if not os.path.exists(DATA_DIR):
+                os.makedirs(DATA_DIR)
+            print "Generating %i MB date-heavy EPF file at %s..." % (DATE_FILE_MB, datePath)
+            generateFile(datePath, DATE_FILE_MB, columns=DATE_COLUMNS, recordFunction=_dateRecord)
+        dateSize = os.path.getsize(datePath)
+        recordCount, recordTime, batchTime, columnarTime = benchmarkFixups(datePath)
+        _report("per-record fixups", recordCount, recordTime, dateSize)
+        _report("batch fixups", recordCount, batchTime, dateSize)
+        _report("columnar batch fixups", recordCount, columnarTime, dateSize)
+        print "%-24s %10.2fx speedup (%.2fx columnar)" % ("", recordTime / batchTime, recordTime / columnarTime)
+        return
+    
+    filePath = options.filePath
+    if options.regenerate or not os.path.exists(filePath):
+        dirPath = os.path.dirname(filePath)
+        if dirPath and not os.path.exists(dirPath):
+            os.makedirs(dirPath)
+        print "Generating %i MB synthetic EPF file at %s..." % (options.sizeMB, filePath)
+        startTime = time.time()
+        recordCount = generateFile(filePath, options.sizeMB)
+        print "Wrote %i records in %.2fs" % (recordCount, time.time() - startTime)
+    fileSize = os.path.getsize(filePath)
+    
+    if command == "generate":
+        return
+    elif command == "parse":
+        readModes = (options.readModes if options.readModes else EPFParser.Parser.readModes)
+        argsList = [dict(readMode=aMode) for aMode in readModes]
+        if options.verify:
+            mismatch = verifyParsers(filePath, argsList)
+            if mismatch:
+                print mismatch
+                sys.exit(1)
+            print "All read modes returned identical records"
+        for someArgs in argsList:
+            recordCount, elapsed, maxRSS = benchmarkParser(filePath, someArgs)
+            _report(someArgs['readMode'], recordCount, elapsed, fileSize, maxRSS)
+        if options.cache:
+            shutil.rmtree(PARSE_CACHE_DIR, ignore_errors=True)
+            cacheArgs = dict(readMode=readModes[0], cacheDir=PARSE_CACHE_DIR)
+            for aLabel in ("cache (writing)", "cache (reading)"):
+                recordCount, elapsed, maxRSS = benchmarkParser(filePath, cacheArgs)
+                _report(aLabel, recordCount, elapsed, fileSize, maxRSS)
+            cacheSize = sum([os.path.getsize(os.path.join(PARSE_CACHE_DIR, aName)) for aName in os.listdir(PARSE_CACHE_DIR)])
+            print "%-24s %10.1f MB cached (%.1f%% of the EPF file)" % ("", cacheSize / 1048576.0, 100.0 * cacheSize / fileSize)
+    elif command == "ingest":
+        #imported here so that the parser benchmarks don't require MySQLdb
+        import EPFIngester
+        engines = (options.engines if options.engines else EPFIngester.Ingester.engines)
+        sortOptions = ([False, True] if options.sorted else [False])
+        for anEngine in engines:
+            for isSorted in sortOptions:
+                ing = EPFIngester.Ingester(filePath, tablePrefix="benchmark", dbHost=options.dbHost,
+                    dbUser=options.dbUser, dbPassword=options.dbPassword, dbName=options.dbName,
+                    engine=anEngine, sortTables=(["."] if isSorted else None))
+                startTime = time.time()
+                ing.ingestFull()
+                elapsed = time.time() - startTime
+                _report(anEngine + (" (sorted)" if isSorted else ""), ing.parser.recordsExpected, elapsed, fileSize)
+                print "%-24s execute %.2fs" % ("", ing.stageTimes.get('execute', 0.0))
+                ing._dropTable(ing.tableName)
+    elif command == "export":
+        exportFormats = (options.exportFormats if options.exportFormats else ["parquet", "arrow"])
+        for aFormat in exportFormats:
+            recordCount, elapsed, maxRSS, outputSize = benchmarkExporter(filePath, dict(exportDir=EXPORT_DIR,
+                exportFormat=aFormat, batchRecords=options.batchRecords))
+            _report(aFormat, recordCount, elapsed, fileSize, maxRSS)
+            print "%-24s %10.1f MB written (%.1f%% of the EPF file)" % ("", outputSize / 1048576.0,
+                100.0 * outputSize / fileSize)
+    elif command == "sink":
+        import EPFSink
+        sinkURLs = (options.sinks if options.sinks else ["sqlite:///" + SINK_DB_PATH])
+        for aURL in sinkURLs:
+            sink = EPFSink.sinkFor(aURL)
+            ing = EPFSink.SinkIngester(filePath, sink, tablePrefix="benchmark")
+            startTime = time.time()
+            ing.ingest()
+            elapsed = time.time() - startTime
+            _report(aURL.split(":")[0], ing.lastRecordIngested + 1, elapsed, fileSize)
+            sink.open()
+            print "%-24s %10i rows in table" % ("", sink.execute("""SELECT COUNT(*) FROM %s""" % ing.tableName)[0])
+            sink.dropTable(ing.tableName)
+            sink.commit()
+            sink.close()
+    elif command == "merge":
+        import EPFIngester
+        dbArgs = dict(tablePrefix="benchmark", dbHost=options.dbHost, dbUser=options.dbUser,
+            dbPassword=options.dbPassword, dbName=options.dbName)
+        #the incremental file needs the same name as the full one, so it goes in a subdirectory
+        incPath = os.path.join(os.path.dirname(filePath), "incremental", os.path.basename(filePath))
+        fullCount = EPFIngester.Ingester(filePath, **dbArgs).parser.recordsExpected
+        if options.regenerate or not os.path.exists(incPath):
+            if not os.path.exists(os.path.dirname(incPath)):
+                os.makedirs(os.path.dirname(incPath))
+            print "Generating %i MB synthetic incremental EPF file at %s..." % (options.incrementalMB, incPath)
+            generateFile(incPath, options.incrementalMB, exportMode="INCREMENTAL", seed=1,
+                firstRecord=fullCount // 2, exportDate="1276894800000")
+        incSize = os.path.getsize(incPath)
+        strategies = (options.mergeStrategies if options.mergeStrategies else EPFIngester.Ingester.mergeStrategies)
+        engines = (options.engines if options.engines else ["insert"])
+        for aStrategy in strategies:
+            #start each strategy from a freshly ingested full table
+            EPFIngester.Ingester(filePath, engine=engines[0], **dbArgs).ingestFull()
+            ing = EPFIngester.Ingester(incPath, engine=engines[0], mergeStrategy=aStrategy, **dbArgs)
+            startTime = time.time()
+            ing.ingestIncremental()
+            elapsed = time.time() - startTime
+            _report(aStrategy, ing.parser.recordsExpected, elapsed, incSize)
+            conn = ing.connect()
+            cur = conn.cursor()
+            cur.execute("""SELECT COUNT(*) FROM %s""" % ing.tableName)
+            print "%-24s %10i rows in merged table" % ("", cur.fetchone()[0])
+            conn.close()
+            ing._dropTable(ing.tableName)
+    else:
+        op.error("Unknown command '%s'" % command)
+
+#Execute
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+#
+# File: EPFExporter.py
+# Abstract: The EPFExporter.py module writes the records of EPF files to compressed Parquet or Arrow IPC files.
+# Version: 1.0
+# 
+# Disclaimer: IMPORTANT:  This Apple software is supplied to you by Apple
+# Inc. ("Apple") in consideration of your agreement to the following
+# terms, and your use, installation, modification or redistribution of
+# this Apple software constitutes acceptance of these terms.  If you do
+# not agree with these terms, please do not use, install, modify or
+# redistribute this Apple software.
+# 
+# In consideration of your agreement to abide by the following terms, and
+# subject to these terms, Apple grants you a personal, non-exclusive
+# license, under Apple's copyrights in this original Apple software (the
+# "Apple Software"), to use, reproduce, modify and redistribute the Apple
+# Software, with or without modifications, in source and/or binary forms;
+# provided that if you redistribute the Apple Software in its entirety and
+# without modifications, you must retain this notice and the following
+# text and disclaimers in all such redistributions of the Apple Software.
+# Neither the name, trademarks, service marks or logos of Apple Inc. may
+# be used to endorse or promote products derived from the Apple Software
+# without specific prior written permission from Apple.  Except as
+# expressly stated in this notice, no other rights or licenses, express or
+# implied, are granted by Apple herein, including but not limited to any
+# patent rights that may be infringed by your derivative works or by other
+# works in which the Apple Software may be incorporated.
+# 
+# The Apple Software is provided by Apple on an "AS IS" basis.  APPLE
+# MAKES NO WARRANTIES, EXPRESS OR IMPLIED, INCLUDING WITHOUT LIMITATION
+# THE IMPLIED WARRANTIES OF NON-INFRINGEMENT, MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE, REGARDING THE APPLE SOFTWARE OR ITS USE AND
+# OPERATION ALONE OR IN COMBINATION WITH YOUR PRODUCTS.
+# 
+# IN NO EVENT SHALL APPLE BE LIABLE FOR ANY SPECIAL, INDIRECT, INCIDENTAL
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) ARISING IN ANY WAY OUT OF THE USE, REPRODUCTION,
+# MODIFICATION AND/OR DISTRIBUTION OF THE APPLE SOFTWARE, HOWEVER CAUSED
+# AND WHETHER UNDER THEORY OF CONTRACT, TORT (INCLUDING NEGLIGENCE),
+# STRICT LIABILITY OR OTHERWISE, EVEN IF APPLE HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#  
+# Copyright (C) 2010 Apple Inc. All Rights Reserved.
+#
+
+import EPFSink
+import os
+import re
+import shutil
+import datetime
+import logging
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None #only needed for exporting
+
+LOGGER = logging.getLogger()
+
+#The file extension of each export format
+FORMAT_EXTENSIONS = {"parquet":".parquet", "arrow":".arrow"}
+
+
+def arrowType(dataType):
+    """
+    Returns the pyarrow type for dataType, a type from a dbTypes header (e.g. "DECIMAL(9,3)").
+
+    Integer types keep their MySQL sizes, DATE and DATETIME become dates and second-resolution
+    timestamps, and anything else (including TIME) is stored as a string.
+    """
+    baseType = dataType.split("(")[0].strip().upper()
+    if baseType == "TINYINT":
+        return pyarrow.int8()
+    elif baseType in ("INTEGER", "INT"):
+        return pyarrow.int32()
+    elif baseType == "BIGINT":
+        return pyarrow.int64()
+    elif baseType in ("DECIMAL", "NUMERIC"):
+        match = re.search(r"\(\s*(\d+)\s*(?:,\s*(\d+)\s*)?\)", dataType)
+        precision, scale = ((int(match.group(1)), int(match.group(2) or 0)) if match else (10, 0))
+        return pyarrow.decimal128(precision, scale)
+    elif baseType == "DATE":
+        return pyarrow.date32()
+    elif baseType in ("DATETIME", "TIMESTAMP"):
+        return pyarrow.timestamp("s")
+    return pyarrow.string()
+
+
+class Exporter(EPFSink.SinkIngester):
+    """
+    Used to export an EPF file to a compressed Parquet or Arrow IPC file, instead of
+    ingesting it into a database.
+
+    The records are read from the parser in columnar batches of batchRecords records, each
+    typed from the dbTypes header (see arrowType) and written as it is read, so memory use
+    is bounded by the batch size rather than the file's. Each batch becomes a Parquet row group
+    (or an Arrow record batch). Incremental files are exported just as full ones are, with
+    the file's export mode and primary key kept in the schema's metadata.
+
+    The export of <directory>/<file> is written to <exportDir>/<directory>/<table>.parquet (or .arrow).
+    If partitionByDate is True, its records are instead written to a file for each of their
+    export_dates, <exportDir>/<directory>/<table>/export_date=<export_date>/part-0.parquet, leaving
+    out the export_date column, as Hive-style partitioned datasets do (records with a null export_date
+    go to the export_date=__HIVE_DEFAULT_PARTITION__ partition). Files are written under
+    a temporary name and renamed when the export completes, so an interrupted export (which
+    starts over when resumed) never leaves a partial file in place. Partitions are written to
+    a staging directory, <table>.tmp, which replaces the table's directory when the export completes,
+    so that no partitions of an earlier export are left beside those of the new one.
+    """
+    formats = ("parquet", "arrow")
+    #compression used when none is specified
+    defaultCompression = {"parquet":"snappy", "arrow":"zstd"}
+    partitionColumn = "export_date"
+    #the partition of records with a null export_date, named as Hive names it
+    nullPartition = "__HIVE_DEFAULT_PARTITION__"
+
+    def __init__(self,
+            filePath,
+            exportDir,
+            exportFormat="parquet",
+            compression=None,
+            partitionByDate=False,
+            tablePrefix=None,
+            recordDelim='\x02\n',
+            fieldDelim='\x01',
+            readMode="readline",
+            indexDir=None,
+            cacheDir=None,
+            cacheBytes=10737418240,
+            progressCallback=None,
+            batchRecords=10000,
+            **ignoredArgs):
+        """
+        compression is the codec ("snappy", "gzip", "zstd", "lz4" or "none") for the format;
+        by default, Parquet files are compressed with snappy and Arrow files with zstd. Versions
+        of pyarrow before 2.0 can't compress Arrow files, and write them uncompressed.
+        """
+        if not pyarrow:
+            raise ImportError("Exporting EPF files requires the pyarrow module")
+        if exportFormat not in Exporter.formats:
+            raise ValueError("Unknown exportFormat '%s'" % exportFormat)
+        EPFSink.SinkIngester.__init__(self, filePath, None, tablePrefix=tablePrefix, recordDelim=recordDelim,
+            fieldDelim=fieldDelim, readMode=readMode, indexDir=indexDir, cacheDir=cacheDir, cacheBytes=cacheBytes,
+            progressCallback=progressCallback,
+            batchRecords=batchRecords)
+        self.exportFormat = exportFormat
+        self.compression = (compression if compression else Exporter.defaultCompression[exportFormat])
+        if self.compression == "none":
+            self.compression = None
+        dirName = os.path.basename(os.path.dirname(os.path.abspath(filePath)))
+        self.exportDir = os.path.join(exportDir, dirName)
+        self.tableDir = os.path.join(self.exportDir, self.tableName) #holds the partitions, if partitioned
+        self.stagingDir = self.tableDir + ".tmp"
+        columnNames = self.parser.columnNames
+        self.partitionIndex = None
+        if partitionByDate:
+            if Exporter.partitionColumn in columnNames:
+                self.partitionIndex = columnNames.index(Exporter.partitionColumn)
+            else:
+                LOGGER.warning("%s has no %s column, so it won't be partitioned", self.fileName, Exporter.partitionColumn)
+        self.arrowTypes = [arrowType(dType) for dType in self.parser.dataTypes[:len(columnNames)]]
+        metadata = {"epf.exportMode":str(self.parser.exportMode),
+            "epf.primaryKey":",".join(self.parser.primaryKey)}
+        fields = [pyarrow.field(colName, colType) for (j, colName, colType) in
+            zip(range(len(columnNames)), columnNames, self.arrowTypes) if j != self.partitionIndex]
+        self.schema = pyarrow.schema(fields, metadata=metadata)
+        self.textColumns = set([j for j in range(len(self.arrowTypes)) if self.arrowTypes[j] == pyarrow.string()])
+        self.writers = {} #maps each partition's export_date (None if unpartitioned) to (writer, temporary path, path)
+        self.exportPaths = [] #the files written by the last export
+        self._conversionWarnings = set() #columns whose unconvertible values have been logged
+
+
+    def exportPath(self, partitionValue=None):
+        """
+        Returns the path of the file for partitionValue (an export_date), or of the unpartitioned file.
+        """
+        extension = FORMAT_EXTENSIONS[self.exportFormat]
+        if self.partitionIndex is None:
+            return os.path.join(self.exportDir, self.tableName + extension)
+        if partitionValue is None:
+            partitionValue = Exporter.nullPartition
+        return os.path.join(self.tableDir, "%s=%s" % (Exporter.partitionColumn, partitionValue),
+            "part-0" + extension)
+
+
+    def ingest(self, skipKeyViolators=False):
+        """
+        Exports the file, replacing any previous export of its table (including all of
+        the table's partitions, if partitioned).
+
+        Raises an EPFSink.SinkError if pyarrow can't convert or write the records.
+        """
+        LOGGER.info("Beginning %s export of %s (%s)", self.exportFormat, self.tableName, self.parser.exportMode)
+        self.startTime = datetime.datetime.now()
+        didFinish = False
+        try:
+            if (self.partitionIndex is not None) and os.path.exists(self.stagingDir):
+                shutil.rmtree(self.stagingDir) #left by an interrupted export
+            try:
+                for columns in self._batches(columnar=True):
+                    self._writeBatch(columns)
+                didFinish = True
+            finally:
+                self._closeWriters(keep=didFinish)
+        except (pyarrow.ArrowException, EnvironmentError, ValueError, TypeError), e:
+            LOGGER.exception("Fatal error encountered while exporting '%s'", self.filePath)
+            LOGGER.error("Last record exported before failure: %d", self.lastRecordIngested)
+            self.abortTime = datetime.datetime.now()
+            self.didAbort = True
+            self.updateStatusDict()
+            raise EPFSink.SinkError(str(e), e)
+        self.endTime = datetime.datetime.now()
+        self.updateStatusDict()
+        LOGGER.info("Export of %s to %s took %s", self.tableName, ", ".join(self.exportPaths),
+            str(self.endTime - self.startTime))
+
+
+    def _writeBatch(self, columns):
+        """
+        Converts a columnar batch of records to Arrow arrays and writes it to the file
+        for each export_date it contains.
+        """
+        arrays = [self._toArray(j, columns[j]) for j in range(len(self.arrowTypes))]
+        if self.partitionIndex is None:
+            self._writeArrays(None, arrays)
+            return
+        dates = columns[self.partitionIndex]
+        del arrays[self.partitionIndex]
+        firstDate = dates[0]
+        if dates.count(firstDate) == len(dates):
+            #nearly every file has a single export_date, so check for that before grouping the rows
+            self._writeArrays(firstDate, arrays)
+            return
+        rowLists = {}
+        for (i, aDate) in enumerate(dates):
+            rowLists.setdefault(aDate, []).append(i)
+        for (aDate, rows) in rowLists.items():
+            indices = pyarrow.array(rows, type=pyarrow.int64())
+            self._writeArrays(aDate, [anArray.take(indices) for anArray in arrays])
+
+
+    def _toArray(self, j, values):
+        """
+        Returns the values of column j as an Arrow array of its type. Text is decoded from the
+        file's UTF-8 bytes, and any values of other columns which the parser couldn't convert
+        (and so passed through as strings) become nulls.
+        """
+        colType = self.arrowTypes[j]
+        if j in self.textColumns:
+            values = [(EPFSink._rawText(val).decode('utf-8', 'replace') if val is not None else None)
+                for val in values]
+            return pyarrow.array(values, type=colType)
+        try:
+            return pyarrow.array(values, type=colType)
+        except (pyarrow.ArrowException, TypeError, ValueError):
+            if j not in self._conversionWarnings:
+                self._conversionWarnings.add(j)
+                LOGGER.warning("Writing values of %s in %s which aren't %s as nulls",
+                    self.parser.columnNames[j], self.fileName, colType)
+            values = [(None if isinstance(val, basestring) else val) for val in values]
+            return pyarrow.array(values, type=colType)
+
+
+    def _writeArrays(self, partitionValue, arrays):
+        if partitionValue not in self.writers:
+            self.writers[partitionValue] = self._openWriter(self.exportPath(partitionValue))
+        writer = self.writers[partitionValue][0]
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+
+    def _openWriter(self, path):
+        """
+        Opens a writer for path, writing to a temporary file beside it; returns a tuple of
+        (writer, temporary path, path). A partition's temporary path is in the staging directory.
+        """
+        if self.partitionIndex is None:
+            tmpPath = path + ".tmp"
+        else:
+            tmpPath = os.path.join(self.stagingDir, os.path.relpath(path, self.tableDir))
+        dirPath = os.path.dirname(tmpPath)
+        if not os.path.exists(dirPath):
+            os.makedirs(dirPath)
+        if self.exportFormat == "parquet":
+            writer = pyarrow.parquet.ParquetWriter(tmpPath, self.schema, compression=(self.compression or "none"))
+        elif hasattr(pyarrow.ipc, "IpcWriteOptions"):
+            options = pyarrow.ipc.IpcWriteOptions(compression=self.compression)
+            writer = pyarrow.ipc.new_file(tmpPath, self.schema, options=options)
+        else:
+            if self.compression:
+                LOGGER.warning("This version of pyarrow can't compress Arrow files; writing %s uncompressed", path)
+            writer = pyarrow.RecordBatchFileWriter(tmpPath, self.schema)
+        return (writer, tmpPath, path)
+
+
+    def _closeWriters(self, keep=True):
+        """
+        Closes the writers of the export, renaming their files (or for partitioned exports,
+        the staging directory) into place if keep is True and deleting them if not.
+        """
+        self.exportPaths = []
+        for (writer, tmpPath, path) in self.writers.values():
+            writer.close()
+            if not keep:
+                if os.path.exists(tmpPath):
+                    os.remove(tmpPath)
+                continue
+            if self.partitionIndex is None:
+                os.rename(tmpPath, path)
+            self.exportPaths.append(path)
+        self.writers = {}
+        if self.partitionIndex is not None:
+            if keep:
+                self._replaceTableDir()
+            elif os.path.exists(self.stagingDir):
+                shutil.rmtree(self.stagingDir)
+        elif keep and not self.exportPaths:
+            #the file has no records; write an empty file, so that its schema is still there
+            self.writers[None] = self._openWriter(self.exportPath())
+            self._closeWriters(keep=True)
+
+
+    def _replaceTableDir(self):
+        """
+        Replaces the table's directory of partitions with the staging directory, moving the old
+        one aside first and then deleting it.
+        """
+        oldDir = self.tableDir + ".old"
+        if os.path.exists(oldDir):
+            shutil.rmtree(oldDir)
+        if not os.path.exists(self.stagingDir):
+            os.makedirs(self.stagingDir) #the file has no records
+        if os.path.exists(self.tableDir):
+            os.rename(self.tableDir, oldDir)
+        os.rename(self.stagingDir, self.tableDir)
+        if os.path.exists(oldDir):
+            shutil.rmtree(oldDir)
@@ -46,15 +46,21 @@
 # Copyright (C) 2010 Apple Inc. All Rights Reserved.
 # 
 
+import EPFExporter
 import EPFIngester
-import MySQLdb
+import EPFParser
+import EPFSink
 import os
 import sys
 import datetime
 import re
 import json
 import copy
+import Queue
 import optparse
+import threading
+import multiprocessing
+import multiprocessing.pool
 import ConfigParser
 import logging
 import logging.config
@@ -72,6 +78,18 @@ global SNAPSHOT_PATH, SNAPSHOT_DICT
 SNAPSHOT_PATH = "./EPFSnapshot.json"
 SNAPSHOT_DICT = {"tablePrefix":None, "dirsToImport":[], "dirsLeft":[], "currentDict":{}}
 
+#Record indexes let an interrupted import seek straight to the record it had reached
+INDEX_DIR = "./EPFIndexes"
+
+#With --profile, a JSON report of each file's ingest is written under this directory
+PROFILE_DIR = "./EPFProfiles"
+
+#With --cache, the parsed records of each file are cached here for later imports of the same files
+CACHE_DIR = "./EPFCache"
+
+#The errors which fail a file's ingest; MySQLdb is optional when writing to a sink or exporting
+INGEST_ERRORS = (EPFSink.SinkError,) + ((EPFIngester.MySQLdb.Error,) if EPFIngester.MySQLdb else ())
+
 # FULL_STATUS_PATH = "./EPFStatusFull.json"
 # INCREMENTAL_STATUS_PATH = "./EPFStatusIncremental.json"
 # FULL_STATUS_DICT = {"tablePrefix":None, "dirsToImport":[], "dirsLeft":[], "currentDict":{}}
@@ -136,7 +154,12 @@ def doImport(directoryPath,
             allowExtensions=False,
             skipKeyViolators=False,
             recordDelim='\x02\n',
-            fieldDelim='\x01'):
+            fieldDelim='\x01',
+            resumeDict=None,
+            jobs=1,
+            threaded=False,
+            ddlJobs=0,
+            **ingesterArgs):
     """
     Perform a full import of the EPF files in the directory specified by directoryPath.
     
@@ -155,26 +178,83 @@ def doImport(directoryPath,
     excluded from the import, even if they are matched in whiteList. By default, any filename 
     with a dot (".") in it will be excluded. Since EPF filenames never include a dot, this permits 
     placing any file with an extension (e.g., .txt) in the directory without disrupting the import.
+    The exception is compressed EPF files (e.g. "song.gz" or "song.bz2"), which are decompressed as
+    they're imported (see EPFParser.Parser); tar archives aren't supported, and must be extracted first.
+    
+    resumeDict maps file names to the status dictionaries of ingests that were interrupted
+    (normally the "inProgress" entry of a previous snapshot); those files are resumed from
+    their last checkpoint rather than started over.
+    
+    If jobs is greater than 1, that many files are ingested at once, each in its own process,
+    starting with the largest files. Only this process writes the snapshot.
+    
+    If threaded is True, they are ingested in threads of this process instead, sharing its connection pool.
+    MySQLdb lets other threads run while a statement executes, so one file's writes and DDL
+    overlap with the parsing of others, without the memory and connections of extra processes.
+    
+    If ddlJobs is greater than 0, at most that many of the files being ingested at once run heavy DDL
+    (such as building a primary key, or renaming or dropping a populated table) at a time;
+    see EPFIngester.DDLSlot.
+    
+    The remaining keyword arguments, ingesterArgs, are passed to the ingester of each file (see _ingestFile),
+    along with tablePrefix, the database connection settings and the delimiters:
+    
+    If indexDir is specified, record indexes for the files are kept there (see EPFParser.RecordIndex).
+    
+    If cacheDir is specified, the files' parsed records are cached there, up to cacheBytes in all,
+    so that importing the same files again (such as into another database) needn't parse them
+    (see EPFParser.ParseCache).
+    
+    engine is the EPFIngester.Ingester engine used to write records ("insert", "loaddata" or "executemany").
+    
+    If splits is greater than 1, each full ingest divides its file into that many byte ranges
+    and loads them at once (see EPFIngester.Ingester).
+    
+    If pipelineDepth is greater than 0, statements for the "insert" engine are built in a separate
+    thread, up to pipelineDepth ahead of the one being executed.
+    
+    batchMode is the EPFIngester.Ingester batch mode for the "insert" engine ("rows" or "bytes").
+    
+    poolSize is the number of idle database connections each process keeps open for reuse.
+    
+    mergeStrategy is the EPFIngester.Ingester strategy for merging large incremental ingests
+    ("subquery" or "antijoin"), and incrementalStrategy forces incremental ingests to update tables
+    in place ("replace") or merge them ("merge"), rather than choosing for each file ("auto").
+    
+    If deferKeys is True, full ingests add each table's primary key after loading it.
+    
+    sortTables is a list of regular expressions for files whose records should be sorted by primary key
+    before being written, using at most about sortMemory bytes before spilling to temporary files.
+    
+    If typed is True, the "insert" engine sends numbers, decimals and dates as typed values
+    rather than quoted strings (the "executemany" engine always does).
+    
+    If detectChanges is True, incremental ingests only write new and changed rows, keeping
+    a hash of each table's rows in a side table to find them.
+    
+    If profileDir is specified, a JSON report of the time spent in each stage of each file's
+    ingest, and the rows and bytes per second passing through it, is written there
+    (see EPFIngester.Ingester.writeProfile).
+    
+    If sink is a sink URL (such as sqlite:///epf.db or postgresql://user@host/epf; see EPFSink.sinkFor),
+    the files are written to that database with EPFSink.SinkIngesters rather than to MySQL, and the
+    database connection settings and the options of EPFIngester.Ingester don't apply.
+    
+    If exportDir is specified, the files aren't ingested into a database, but exported to compressed
+    files of exportFormat ("parquet" or "arrow") there, partitioned by export_date if partitionByDate
+    is True (see EPFExporter.Exporter).
     
     Returns a list of any files for which the import failed (empty if all succeeded)
     """    
-    #Exclude files with a dot (for example, the invisible .DSStore files HFS+ uses)
     if not allowExtensions:
-        blackList.append(r'.*\..*?') 
-       
-    wListRe = (r"|".join(whiteList) if whiteList else r"$a^") #The latter can never match anything
-    bListRe = (r"|".join(blackList) if blackList else r"$a^") #The latter can never match anything
-    wMatcher = re.compile(wListRe)
-    bMatcher = re.compile(bListRe)
+        blackList.append(_extensionPattern())
     
     dirPath = os.path.abspath(directoryPath)
-    fileList = os.listdir(dirPath)
-    #filter the list down to the entries matching our whitelist/blacklist
-    fileList = [f for f in fileList if (wMatcher.search(f) and not bMatcher.search(f))]
-    fileList.sort()
+    fileList = _matchingFiles(dirPath, whiteList, blackList)
     filesLeft = copy.copy(fileList)
     filesImported = []
     failedFiles = []
+    inProgress = (resumeDict if resumeDict else {})
     
     SNAPSHOT_DICT['tablePrefix'] = tablePrefix
     SNAPSHOT_DICT['wList'] = whiteList
@@ -193,47 +273,95 @@ def doImport(directoryPath,
     currentDict['filesLeft'] = filesLeft
     currentDict['filesImported'] = filesImported
     currentDict['failedFiles'] = failedFiles
+    currentDict['inProgress'] = inProgress
     
     
     _dumpDict(SNAPSHOT_DICT, SNAPSHOT_PATH)
     pathList = [os.path.join(dirPath, fileName) for fileName in fileList]
+    ingesterArgs = dict(ingesterArgs,
+        tablePrefix=tablePrefix,
+        dbHost=dbHost,
+        dbUser=dbUser,
+        dbPassword=dbPassword,
+        dbName=dbName,
+        recordDelim=recordDelim,
+        fieldDelim=fieldDelim)
+    
+    snapshotLock = threading.Lock() #threaded workers record their progress and results themselves
+    
+    def recordProgress(fName, statusDict):
+        with snapshotLock:
+            inProgress[fName] = statusDict
+            _dumpDict(SNAPSHOT_DICT, SNAPSHOT_PATH)
+        
+    def recordResult(fName, didSucceed):
+        with snapshotLock:
+            if didSucceed:
+                filesLeft.remove(fName)
+                filesImported.append(fName)
+                inProgress.pop(fName, None)
+            else:
+                failedFiles.append(fName)
+            _dumpDict(SNAPSHOT_DICT, SNAPSHOT_PATH)
     
     startTime = datetime.datetime.now()
+    startConnects = EPFIngester.connectCount()
+    workerConnects = 0 #connections opened by worker processes
     LOGGER.info("Starting import of %s...", dirPath)
-    for aPath in pathList:
-        fName = os.path.basename(aPath)
-        #In order to keep supposedly "matching" warnings from being suppressed during future
-        #ingests, we need to clear the module's warning registry before each ingest
+    if jobs > 1 and threaded:
+        #Start the largest files first, so the longest ingests aren't left until the end
+        pathList.sort(key=os.path.getsize, reverse=True)
+        pool = _workerPool(jobs, threaded=True, ddlJobs=ddlJobs)
         try:
-            EPFIngester.__warningregistry__.clear()
-        except AttributeError:
-            pass
-            
-        try: 
-            ing = EPFIngester.Ingester(aPath,
-                tablePrefix=tablePrefix,
-                dbHost=dbHost,
-                dbUser=dbUser,
-                dbPassword=dbPassword,
-                dbName=dbName,
-                recordDelim=recordDelim,
-                fieldDelim=fieldDelim)
-        except Exception, e:
-            LOGGER.error("Unable to create EPFIngester for %s", fName)
-            LOGGER.exception(e)
-            failedFiles.append(fName)
-            _dumpDict(SNAPSHOT_DICT, SNAPSHOT_PATH)
-            continue
-                        
+            results = []
+            for aPath in pathList:
+                fName = os.path.basename(aPath)
+                results.append(pool.apply_async(_ingestFile, (aPath, ingesterArgs),
+                    dict(skipKeyViolators=skipKeyViolators,
+                        resumeStatus=inProgress.get(fName),
+                        progressCallback=(lambda statusDict, fName=fName: recordProgress(fName, statusDict))),
+                    callback=(lambda didSucceed, fName=fName: recordResult(fName, didSucceed))))
+            for aResult in results:
+                aResult.get() #wait for each file, re-raising any unexpected exception
+        finally:
+            pool.terminate()
+            pool.join()
+            EPFIngester.limitDDL(0)
+    elif jobs > 1:
+        #Start the largest files first, so the longest ingests aren't left until the end
+        pathList.sort(key=os.path.getsize, reverse=True)
+        pool = _workerPool(jobs, ddlJobs=ddlJobs)
+        progressQueue = multiprocessing.Manager().Queue()
         try:
-            ing.ingest(skipKeyViolators=skipKeyViolators)
-            filesLeft.remove(fName)
-            filesImported.append(fName)
-            _dumpDict(SNAPSHOT_DICT, SNAPSHOT_PATH)
-        except MySQLdb.Error, e:
-            failedFiles.append(fName)
-            _dumpDict(SNAPSHOT_DICT, SNAPSHOT_PATH)
-            continue
+            pending = [pool.apply_async(_ingestFileWorker,
+                (aPath, ingesterArgs, skipKeyViolators, inProgress.get(os.path.basename(aPath)), progressQueue))
+                for aPath in pathList]
+            while pending:
+                finished = [aResult for aResult in pending if aResult.ready()]
+                #Record any progress sent before these files finished, so it can't overwrite their results
+                timeout = (0 if finished else 1)
+                while (True):
+                    try:
+                        recordProgress(*progressQueue.get(timeout=timeout))
+                    except Queue.Empty:
+                        break
+                    timeout = 0
+                for aResult in finished:
+                    pending.remove(aResult)
+                    fName, didSucceed, fileConnects = aResult.get()
+                    workerConnects += fileConnects
+                    recordResult(fName, didSucceed)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for aPath in pathList:
+            fName = os.path.basename(aPath)
+            didSucceed = _ingestFile(aPath, ingesterArgs,
+                skipKeyViolators=skipKeyViolators,
+                resumeStatus=inProgress.get(fName),
+                progressCallback=(lambda statusDict, fName=fName: recordProgress(fName, statusDict)))
+            recordResult(fName, didSucceed)
     
     endTime = datetime.datetime.now()
     ts = str(endTime - startTime)
@@ -241,12 +369,131 @@ def doImport(directoryPath,
     LOGGER.info("Import of %s completed at: %s", dirName, 
         endTime.strftime(EPFIngester.DATETIME_FORMAT))
     LOGGER.info("Total import time for %s: %s" , dirName, ts[:len(ts)-4])
+    LOGGER.info("Database connections opened for %s: %i", dirName,
+        EPFIngester.connectCount() - startConnects + workerConnects)
     if (failedFiles):
         LOGGER.warning("The following files encountered errors and were not imported:\n %s",
             ", ".join(failedFiles))
     return failedFiles
 
 
+def _extensionPattern():
+    """
+    Returns the regular expression which doImport adds to its blackList unless allowExtensions is True.
+    
+    It excludes files with a dot (for example, the invisible .DSStore files HFS+ uses),
+    other than compressed EPF files.
+    """
+    compressedExts = "|".join([re.escape(anExt[1:]) for anExt in EPFParser.COMPRESSED_FILE_TYPES])
+    return r'^[^.]*\.(?!(%s)$)' % compressedExts
+    
+    
+def _matchingFiles(dirPath, whiteList, blackList):
+    """
+    Returns the sorted names of the files in dirPath which match any of the regular expressions
+    in whiteList, but none of those in blackList.
+    """
+    wListRe = (r"|".join(whiteList) if whiteList else r"$a^") #The latter can never match anything
+    bListRe = (r"|".join(blackList) if blackList else r"$a^") #The latter can never match anything
+    wMatcher = re.compile(wListRe)
+    bMatcher = re.compile(bListRe)
+    
+    fileList = os.listdir(dirPath)
+    #filter the list down to the entries matching our whitelist/blacklist
+    fileList = [f for f in fileList if (wMatcher.search(f) and not bMatcher.search(f))]
+    fileList.sort()
+    return fileList
+    
+    
+def _workerPool(jobs, threaded=False, ddlJobs=0):
+    """
+    Returns a pool of jobs workers for ingesting files: a ThreadPool if threaded is True, or else
+    a process pool. Either way, the workers run heavy DDL at most ddlJobs at a time, if ddlJobs
+    is greater than 0 (see EPFIngester.limitDDL); for a ThreadPool this limit is set for the
+    whole process, and should be removed once the pool is done with.
+    """
+    if threaded:
+        EPFIngester.limitDDL(ddlJobs)
+        return multiprocessing.pool.ThreadPool(processes=jobs)
+    EPFIngester.closeConnections() #the worker processes can't share them
+    if ddlJobs > 0:
+        #the workers inherit the semaphore, so they share the limit
+        return multiprocessing.Pool(processes=jobs, initializer=EPFIngester.limitDDL,
+            initargs=(multiprocessing.BoundedSemaphore(ddlJobs),))
+    return multiprocessing.Pool(processes=jobs)
+
+
+def _ingestFile(filePath, ingesterArgs, skipKeyViolators=False, resumeStatus=None, progressCallback=None):
+    """
+    Ingest the EPF file at filePath, using an EPFIngester.Ingester created with ingesterArgs,
+    an EPFSink.SinkIngester if they specify a sink, or an EPFExporter.Exporter if they specify an exportDir.
+    
+    If resumeStatus is the statusDict of an interrupted ingest of the file, the ingest
+    resumes from its last checkpoint.
+    
+    Returns True if the ingest succeeded, False if it failed.
+    """
+    fName = os.path.basename(filePath)
+    #In order to keep supposedly "matching" warnings from being suppressed during future
+    #ingests, we need to clear the module's warning registry before each ingest
+    try:
+        EPFIngester.__warningregistry__.clear()
+    except AttributeError:
+        pass
+        
+    ingesterArgs = dict(ingesterArgs)
+    sink = ingesterArgs.pop('sink', None)
+    exportArgs = dict([(aKey, ingesterArgs.pop(aKey)) for aKey in ('exportDir', 'exportFormat', 'partitionByDate')
+        if aKey in ingesterArgs])
+    try: 
+        if exportArgs.get('exportDir'):
+            exportArgs.update(ingesterArgs)
+            ing = EPFExporter.Exporter(filePath, progressCallback=progressCallback, **exportArgs)
+        elif sink:
+            ing = EPFSink.SinkIngester(filePath, sink, progressCallback=progressCallback, **ingesterArgs)
+        else:
+            ing = EPFIngester.Ingester(filePath, progressCallback=progressCallback, **ingesterArgs)
+    except Exception, e:
+        LOGGER.error("Unable to create EPFIngester for %s", fName)
+        LOGGER.exception(e)
+        return False
+                    
+    try:
+        resumeNum, resumePos = (ing.resumePoint(resumeStatus) if resumeStatus else (0, None))
+        if resumeNum > 0:
+            LOGGER.info("Resuming %s after record %i", fName, resumeNum)
+            ing.ingestResume(fromRecord=resumeNum, fromPos=resumePos, skipKeyViolators=skipKeyViolators)
+        else:
+            ing.ingest(skipKeyViolators=skipKeyViolators)
+    except INGEST_ERRORS, e:
+        return False
+    finally:
+        if ing.profiler:
+            LOGGER.info("Wrote the profile of %s to %s", fName, ing.writeProfile())
+    return True
+    
+    
+def _ingestFileWorker(filePath, ingesterArgs, skipKeyViolators, resumeStatus, progressQueue):
+    """
+    Process pool entry point for parallel imports.
+    
+    Calls _ingestFile, passing each checkpoint back to the parent process through progressQueue
+    as a (file name, statusDict) tuple. Returns a tuple of the file name, _ingestFile's result,
+    and the number of database connections opened.
+    """
+    fName = os.path.basename(filePath)
+    startConnects = EPFIngester.connectCount()
+    
+    def sendProgress(statusDict):
+        progressQueue.put((fName, statusDict))
+        
+    didSucceed = _ingestFile(filePath, ingesterArgs,
+        skipKeyViolators=skipKeyViolators,
+        resumeStatus=resumeStatus,
+        progressCallback=sendProgress)
+    return (fName, didSucceed, EPFIngester.connectCount() - startConnects)
+
+
 def resumeImport(currentDict,
         tablePrefix=None,
         dbHost='localhost',
@@ -255,10 +502,16 @@ def resumeImport(currentDict,
         dbName='epf',
         skipKeyViolators=False,
         recordDelim='\x02\n',
-        fieldDelim='\x01'):
+        fieldDelim='\x01',
+        **importArgs):
     """
     Resume an interrupted full import based on the values in currentDict, which will normally
     be the currentDict unarchived from the EPFSnapshot.json file.
+    
+    Files which were partway through being ingested continue from the last checkpoint recorded
+    in the snapshot, reopening the file at the checkpoint's byte offset.
+    
+    importArgs are passed to doImport.
     """
     dirPath = currentDict['dirPath'].encode('ascii')
     filesLeft = currentDict['filesLeft']
@@ -276,21 +529,189 @@ def resumeImport(currentDict,
         dbName=dbName,
         whiteList=wList,
         blackList=bList,
+        skipKeyViolators=skipKeyViolators,
         recordDelim=recordDelim,
-        fieldDelim=fieldDelim)
+        fieldDelim=fieldDelim,
+        resumeDict=currentDict.get('inProgress'),
+        **importArgs)
     return failedFiles
             
 
+def scheduleImport(directoryPaths,
+        whiteList=[r'.*?'],
+        blackList=[],
+        allowExtensions=False,
+        skipKeyViolators=False,
+        jobs=1,
+        threaded=False,
+        ddlJobs=0,
+        maxConnections=0,
+        tableStates=None,
+        **ingesterArgs):
+    """
+    Import the EPF files in all the directories in directoryPaths at once, such as a full export
+    and several incremental ones, with ingesterArgs passed to each EPFIngester.Ingester.
+    
+    The files are grouped by the table they're ingested into (see EPFIngester.tableNameFor), and each table's files are
+    ingested in turn: full exports first, then incremental ones in the order of directoryPaths.
+    Different tables are ingested at once, starting with the largest files, using at most jobs
+    workers and, if maxConnections is greater than 0, about that many database connections
+    (a split full ingest counts as one per split). If a file fails, the rest of its table's files are skipped.
+    
+    whiteList, blackList and allowExtensions select the files, and threaded and ddlJobs choose
+    the workers and limit their DDL, as for doImport.
+    
+    The snapshot's "tables" entry maps each table to its state: its "files" in the order they are
+    ingested, their "exportModes", the "filesLeft" to ingest, whether it is "pending", "running",
+    "done" or "failed", and the last checkpoint ("inProgress") of the file being ingested. To resume
+    an interrupted import, pass that entry as tableStates; directoryPaths are then ignored, and
+    running and failed tables continue from the file they had reached.
+    
+    Returns a dictionary mapping the names of directories to lists of any of their files
+    for which the import failed (empty if all succeeded).
+    """
+    recordDelim = ingesterArgs.get('recordDelim', '\x02\n')
+    fieldDelim = ingesterArgs.get('fieldDelim', '\x01')
+    if tableStates is None:
+        if not allowExtensions:
+            blackList = blackList + [_extensionPattern()]
+        chains = {} #maps table names to lists of (isIncremental, directory index, file path) tuples
+        for j, aDir in enumerate(directoryPaths):
+            dirPath = os.path.abspath(aDir)
+            for fName in _matchingFiles(dirPath, whiteList, blackList):
+                filePath = os.path.join(dirPath, fName)
+                parser = EPFParser.Parser(filePath, recordDelim=recordDelim, fieldDelim=fieldDelim)
+                parser.eFile.close()
+                tableName = EPFIngester.tableNameFor(fName, ingesterArgs.get('tablePrefix'))
+                chains.setdefault(tableName, []).append(
+                    (parser.exportMode == 'INCREMENTAL', j, filePath, parser.exportMode))
+        tableStates = {}
+        for tableName, chain in chains.items():
+            chain.sort()
+            filePaths = [aLink[2] for aLink in chain]
+            tableStates[tableName] = {"files":filePaths,
+                "exportModes":dict([(aLink[2], aLink[3]) for aLink in chain]),
+                "filesLeft":copy.copy(filePaths),
+                "state":"pending",
+                "inProgress":None}
+    else:
+        for tableState in tableStates.values():
+            if tableState['state'] in ("running", "failed"):
+                tableState['state'] = "pending"
+    
+    SNAPSHOT_DICT['tablePrefix'] = ingesterArgs.get('tablePrefix')
+    SNAPSHOT_DICT['tables'] = tableStates
+    SNAPSHOT_DICT['recordSep'] = recordDelim
+    SNAPSHOT_DICT['fieldSep'] = fieldDelim
+    SNAPSHOT_DICT['dirsLeft'] = [] #they're all covered by the table states
+    SNAPSHOT_DICT['currentDict'] = {}
+    _dumpDict(SNAPSHOT_DICT, SNAPSHOT_PATH)
+    pathTables = {} #maps file paths to their tables, to route progress reports
+    for tableName, tableState in tableStates.items():
+        for aPath in tableState['files']:
+            pathTables[aPath] = tableName
+    
+    def connectionsNeeded(tableState):
+        filePath = tableState['filesLeft'][0]
+        splits = ingesterArgs.get('splits', 1)
+        if (splits > 1) and (tableState['exportModes'].get(filePath) != 'INCREMENTAL') and not EPFParser.compressionOf(filePath):
+            return splits
+        return 1
+    
+    startTime = datetime.datetime.now()
+    startConnects = EPFIngester.connectCount()
+    workerConnects = 0 #connections opened by worker processes
+    LOGGER.info("Starting scheduled import of %i tables...", len(tableStates))
+    pool = _workerPool(max(jobs, 1), threaded=threaded, ddlJobs=ddlJobs)
+    progressQueue = (Queue.Queue() if threaded else multiprocessing.Manager().Queue())
+    running = {} #maps the results of running ingests to their table names and connection counts
+    usedConnections = 0
+    try:
+        while (True):
+            #start the next file of as many ready tables as the workers and connections allow
+            ready = [aName for aName in tableStates if tableStates[aName]['state'] == "pending"]
+            ready.sort(key=lambda aName: os.path.getsize(tableStates[aName]['filesLeft'][0]), reverse=True)
+            for tableName in ready:
+                if len(running) >= max(jobs, 1):
+                    break
+                tableState = tableStates[tableName]
+                needed = connectionsNeeded(tableState)
+                if maxConnections > 0 and running and (usedConnections + needed > maxConnections):
+                    continue
+                filePath = tableState['filesLeft'][0]
+                LOGGER.info("Starting %s (%i of %i for %s)", filePath,
+                    len(tableState['files']) - len(tableState['filesLeft']) + 1, len(tableState['files']), tableName)
+                tableState['state'] = "running"
+                aResult = pool.apply_async(_ingestFileWorker,
+                    (filePath, ingesterArgs, skipKeyViolators, tableState['inProgress'], progressQueue))
+                running[aResult] = (tableName, needed)
+                usedConnections += needed
+            _dumpDict(SNAPSHOT_DICT, SNAPSHOT_PATH)
+            if not running:
+                break
+            
+            finished = [aResult for aResult in running if aResult.ready()]
+            #Record any progress sent before these files finished, so it can't overwrite their results
+            timeout = (0 if finished else 1)
+            while (True):
+                try:
+                    fName, statusDict = progressQueue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                tableStates[pathTables[statusDict['filePath']]]['inProgress'] = statusDict
+                _dumpDict(SNAPSHOT_DICT, SNAPSHOT_PATH)
+                timeout = 0
+            for aResult in finished:
+                tableName, needed = running.pop(aResult)
+                usedConnections -= needed
+                tableState = tableStates[tableName]
+                fName, didSucceed, fileConnects = aResult.get()
+                if not threaded:
+                    workerConnects += fileConnects
+                if didSucceed:
+                    tableState['inProgress'] = None
+                    tableState['filesLeft'].pop(0)
+                    tableState['state'] = ("pending" if tableState['filesLeft'] else "done")
+                else: #keep its last checkpoint, to resume from
+                    tableState['state'] = "failed"
+                    if len(tableState['filesLeft']) > 1:
+                        LOGGER.warning("Skipping the remaining files of %s after %s failed:\n %s", tableName,
+                            tableState['filesLeft'][0], ", ".join(tableState['filesLeft'][1:]))
+    finally:
+        pool.terminate()
+        pool.join()
+        if threaded:
+            EPFIngester.limitDDL(0)
+    _dumpDict(SNAPSHOT_DICT, SNAPSHOT_PATH)
+    
+    failedFilesDict = {}
+    for tableState in tableStates.values():
+        if tableState['state'] == "failed":
+            for aPath in tableState['filesLeft']:
+                failedFilesDict.setdefault(os.path.basename(os.path.dirname(aPath)), []).append(os.path.basename(aPath))
+    ts = str(datetime.datetime.now() - startTime)
+    LOGGER.info("Total time for scheduled import of %i tables: %s", len(tableStates), ts[:len(ts)-4])
+    LOGGER.info("Database connections opened: %i", EPFIngester.connectCount() - startConnects + workerConnects)
+    return failedFilesDict
+
+
 def _dumpDict(aDict, filePath):
     """
     Opens the file at filePath (creating it if it doesn't exist, overwriting if not),
     writes aDict to it in json format, then closes it
+    
+    The dictionary is written to a temporary file which then replaces filePath, so that
+    a crash while writing can never leave a truncated file behind.
     """
     LOGGER.debug("Dumping dictionary: %s", str(aDict))
     LOGGER.debug("json path: %s", str(filePath))
 
-    with open(filePath, mode='w+') as f:
+    tmpPath = filePath + ".tmp"
+    with open(tmpPath, mode='w+') as f:
         json.dump(aDict, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmpPath, filePath)
 
     
 def main():
@@ -325,7 +746,7 @@ def main():
         _dumpDict(flatOptions, FLAT_CONFIG_PATH)
         
     #Command-line parsing
-    usage = """usage: %prog [-fxrak] [-d db_host] [-u db_user] [-p db_password] [-n db_name]
+    usage = """usage: %prog [-fxrak] [-e engine] [-j jobs] [-d db_host] [-u db_user] [-p db_password] [-n db_name]
     [-s record_separator] [-t field_separator] [-w regex [-w regex2 [...]]] 
     [-b regex [-b regex2 [...]]] source_directory [source_directory2 ...]"""
     
@@ -356,6 +777,56 @@ def main():
         help="""A regular expression to add to the whiteList; repeated -b arguments will append""")
     op.add_option('-k', '--skipkeyviolators', action='store_true', dest='skipKeyViolators', default=False,
         help="""Ignore inserts which would violate a primary key constraint; only applies to full imports""")
+    op.add_option('--readmode', dest='readMode', type='choice', choices=['readline', 'block', 'mmap'], default='readline',
+        help="""How EPF files are read: 'readline' (the default), 'block', which reads large chunks and is faster on big files, or 'mmap', which finds records in a memory-mapped window of the file""")
+    op.add_option('-e', '--engine', dest='engine', type='choice', choices=['insert', 'loaddata', 'executemany'], default='insert',
+        help="""How records are written: 'insert' (the default), 'loaddata', which uses LOAD DATA LOCAL INFILE and falls back to 'insert' if the server doesn't allow it, or 'executemany', which passes the records to MySQLdb as parameters""")
+    op.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+        help="""The number of files to ingest at once, each in its own process (default is 1)""")
+    op.add_option('--threads', action='store_true', dest='threaded', default=False,
+        help="""Ingest the files of --jobs in threads of a single process, which share its database connections, rather than in separate processes""")
+    op.add_option('--ddljobs', dest='ddlJobs', type='int', default=0,
+        help="""The number of files being ingested at once which may run heavy DDL (building primary keys, or copying, renaming or dropping populated tables) at the same time (default is 0, for no limit)""")
+    op.add_option('--schedule', action='store_true', dest='isScheduled', default=False,
+        help="""Import all the source directories at once, ingesting different tables in parallel (up to --jobs at a time), and each table's files in turn: full exports first, then incremental ones in the order the directories are given""")
+    op.add_option('--maxconnections', dest='maxConnections', type='int', default=0,
+        help="""With --schedule, the most database connections the running ingests may use at once, counting one per split of a full ingest (default is 0, for no limit beyond --jobs)""")
+    op.add_option('--splits', dest='splits', type='int', default=1,
+        help="""The number of byte ranges each file is divided into and loaded at once during full ingests (default is 1)""")
+    op.add_option('--pipelinedepth', dest='pipelineDepth', type='int', default=0,
+        help="""The number of INSERT statements to build ahead of the one being executed, in a separate thread (default is 0, which builds and executes them in turn)""")
+    op.add_option('--batchmode', dest='batchMode', type='choice', choices=['rows', 'bytes'], default='rows',
+        help="""How records are grouped into INSERT statements: 'rows' (the default) puts 200 in each, while 'bytes' fills them up to a size based on the server's max_allowed_packet, adjusted as the import runs""")
+    op.add_option('--poolsize', dest='poolSize', type='int', default=4,
+        help="""The number of idle database connections each process keeps open for reuse (default is 4)""")
+    op.add_option('--mergestrategy', dest='mergeStrategy', type='choice', choices=['subquery', 'antijoin'], default='subquery',
+        help="""How large incremental imports are merged into the existing table: 'subquery' (the default) or 'antijoin', which uses keyed LEFT JOINs and is much faster on large tables""")
+    op.add_option('--incremental', dest='incrementalStrategy', type='choice', choices=['auto', 'replace', 'merge'], default='auto',
+        help="""How incremental imports update each table: 'replace' updates it in place, 'merge' merges it with the new records into a new table, and 'auto' (the default) chooses based on their estimated cost""")
+    op.add_option('--deferkeys', action='store_true', dest='deferKeys', default=False,
+        help="""During full imports, load each table without its primary key and with unique and foreign key checks off, then build the key in one pass""")
+    op.add_option('--sort', action='append', dest='sortTables',
+        help="""A regular expression for tables whose records are sorted by primary key before they are written, using temporary files if needed; repeated --sort arguments will append. Sorted imports restart from the beginning when resumed""")
+    op.add_option('--sortmemory', dest='sortMemory', type='int', default=256,
+        help="""The number of megabytes of records to sort in memory before spilling to temporary files (default is 256)""")
+    op.add_option('--typed', action='store_true', dest='typed', default=False,
+        help="""Convert numbers, decimals and dates to typed values before sending them to the database, rather than sending every field as a quoted string (always done by the executemany engine)""")
+    op.add_option('--detectchanges', action='store_true', dest='detectChanges', default=False,
+        help="""During incremental imports, only write rows which are new or have changed, by comparing their hashes with those kept in a <table>_hash side table (created on first use)""")
+    op.add_option('--profile', action='store_true', dest='profile', default=False,
+        help="""Time each stage of ingesting each file (reading, decoding, splitting, fixing up, escaping, building and executing) and write a JSON report of their times and rows and bytes per second to %s/<directory>/<file>.json""" % PROFILE_DIR)
+    op.add_option('--cache', action='store_true', dest='cache', default=False,
+        help="""Cache the parsed records of each file in %s, so that importing the same files again (such as into another database, or with --sink or --exportdir) reads them from the cache instead of parsing them; a changed file's cache entry is discarded""" % CACHE_DIR)
+    op.add_option('--cachesize', dest='cacheSize', type='int', default=10240,
+        help="""The most megabytes the --cache directory may use; the least recently used entries are deleted to stay within it (default is 10240)""")
+    op.add_option('--exportdir', dest='exportDir',
+        help="""Export the files to compressed columnar files in this directory (as <directory>/<table>.parquet) instead of ingesting them into a database; requires pyarrow""")
+    op.add_option('--exportformat', dest='exportFormat', type='choice', choices=['parquet', 'arrow'], default='parquet',
+        help="""The format of --exportdir files: 'parquet' (the default, compressed with snappy) or 'arrow' (Arrow IPC files, compressed with zstd)""")
+    op.add_option('--partitionbydate', action='store_true', dest='partitionByDate', default=False,
+        help="""With --exportdir, write each table's records to a file for each export_date, as <directory>/<table>/export_date=<date>/part-0.parquet""")
+    op.add_option('--sink', dest='sink',
+        help="""Write the files to another database instead of MySQL, given as a URL: sqlite:///<path> (an SQLite file, loaded in large transactions), postgresql://<user>:<password>@<host>/<dbname> (streamed with COPY; requires psycopg2) or mysql://<user>:<password>@<host>/<dbname>. Incremental files replace rows in place, and interrupted files start over when resumed""")
     
     (options, args) = op.parse_args() #parse command-line options
     
@@ -381,6 +852,9 @@ def main():
         if (not optDict[aKey]) and (configDict.has_key(aKey)):
             optDict[aKey] = configDict[aKey]
             
+    if not (options.sink or options.exportDir or EPFIngester.MySQLdb):
+        op.error("Importing into MySQL requires the MySQLdb module; use --sink or --exportdir without it")
+            
     failedFilesDict = {}
     
     #bind these to locals here; they will be rebound later if this is a resume
@@ -396,25 +870,60 @@ def main():
     SNAPSHOT_DICT['dirsToImport'] = copy.copy(dirsToImport)
     SNAPSHOT_DICT['dirsLeft'] = copy.copy(dirsToImport)
     
+    #the options shared by every import function; tablePrefix and the delimiters may come from the snapshot
+    importArgs = dict(dbHost=options.dbHost,
+        dbUser=options.dbUser,
+        dbPassword=options.dbPassword,
+        dbName=options.dbName,
+        skipKeyViolators=options.skipKeyViolators,
+        jobs=options.jobs,
+        threaded=options.threaded,
+        ddlJobs=options.ddlJobs,
+        readMode=options.readMode,
+        indexDir=INDEX_DIR,
+        cacheDir=(CACHE_DIR if options.cache else None),
+        cacheBytes=options.cacheSize * 1048576,
+        engine=options.engine,
+        splits=options.splits,
+        pipelineDepth=options.pipelineDepth,
+        batchMode=options.batchMode,
+        poolSize=options.poolSize,
+        mergeStrategy=options.mergeStrategy,
+        incrementalStrategy=options.incrementalStrategy,
+        deferKeys=options.deferKeys,
+        sortTables=options.sortTables,
+        sortMemory=options.sortMemory * 1048576,
+        typed=options.typed,
+        detectChanges=options.detectChanges,
+        profileDir=(PROFILE_DIR if options.profile else None),
+        sink=options.sink,
+        exportDir=options.exportDir,
+        exportFormat=options.exportFormat,
+        partitionByDate=options.partitionByDate)
+    
     startTime = datetime.datetime.now()
 
     #call the appropriate import function
+    tableStates = None #set when resuming a scheduled import
     if options.isResume:
         with open(SNAPSHOT_PATH, mode='r') as f:
             SNAPSHOT_DICT = json.load(f)
         tablePrefix = SNAPSHOT_DICT['tablePrefix']
+        tableStates = SNAPSHOT_DICT.get('tables')
+    if tableStates:
+        LOGGER.info("Resuming scheduled import of %i tables", len(tableStates))
+        recordSep = SNAPSHOT_DICT['recordSep']
+        fieldSep = SNAPSHOT_DICT['fieldSep']
+        dirsToImport = []
+    elif options.isResume:
         currentDict = SNAPSHOT_DICT['currentDict']
         LOGGER.info("Resuming import for %s", currentDict['dirPath'])
         
         failedFiles = resumeImport(currentDict,
             tablePrefix=tablePrefix,
-            dbHost=options.dbHost,
-            dbUser=options.dbUser,
-            dbPassword=options.dbPassword,
-            dbName=options.dbName,
-            skipKeyViolators=options.skipKeyViolators,
             recordDelim=recordSep,
-            fieldDelim=fieldSep)
+            fieldDelim=fieldSep,
+            **importArgs)
         if failedFiles:
             dirName = os.path.basename(currentDict['dirPath'])
             failedFilesDict[dirName] = failedFiles
@@ -424,24 +933,31 @@ def main():
         wList = SNAPSHOT_DICT['wList']
         bList = SNAPSHOT_DICT['bList']
     
+    if tableStates or (options.isScheduled and dirsToImport):
+        failedFilesDict.update(scheduleImport(dirsToImport,
+            whiteList=wList,
+            blackList=bList,
+            allowExtensions=allowExtensions,
+            maxConnections=options.maxConnections,
+            tableStates=tableStates,
+            tablePrefix=tablePrefix,
+            recordDelim=recordSep,
+            fieldDelim=fieldSep,
+            **importArgs))
     #non-resume
-    if dirsToImport:
+    elif dirsToImport:
         LOGGER.info("Beginning import for the following directories:\n    %s", "\n    ".join(dirsToImport))
         for dirPath in dirsToImport:
             dirName = os.path.basename(dirPath)
             LOGGER.info("Importing files in %s", dirPath)
             failedFiles = doImport(dirPath,
                 tablePrefix=tablePrefix,
-                dbHost=options.dbHost,
-                dbUser=options.dbUser,
-                dbPassword=options.dbPassword,
-                dbName=options.dbName,
                 whiteList=wList,
                 blackList=bList,
                 allowExtensions=allowExtensions,
-                skipKeyViolators=options.skipKeyViolators,
                 recordDelim=recordSep,
-                fieldDelim=fieldSep)
+                fieldDelim=fieldSep,
+                **importArgs)
 
             if failedFiles:
                 failedFilesDict[dirName] = failedFiles
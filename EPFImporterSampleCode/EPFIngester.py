@@ -45,20 +45,278 @@
 #
 
 import EPFParser
-import MySQLdb
+import EPFProfiler
 import os
 import datetime
+import time
+import math
+import re
+import tempfile
+import threading
+import Queue
+import multiprocessing
+import multiprocessing.pool
 import warnings
 import logging
 
+try:
+    import MySQLdb
+except ImportError:
+    MySQLdb = None #only needed for ingesting into MySQL; see EPFSink and EPFExporter for the alternatives
+
 DATETIME_FORMAT = "%y-%m-%d %H:%M:%S"
 
+#Errors returned when the server or client doesn't permit LOAD DATA LOCAL INFILE
+LOAD_DATA_REFUSED_ERRORS = (1148, 2068, 3948)
+
+#Errors returned when the server can't be reached or the connection was lost; connecting is retried after these
+RECONNECT_ERRORS = (2002, 2003, 2006, 2013)
+
 LOGGER = logging.getLogger()
 
+#The connection pools of this process, keyed by their connection arguments; see connectionPool()
+CONNECTION_POOLS = {}
+
+#Limits the number of heavy DDL statements run at once, if set; see limitDDL()
+DDL_SEMAPHORE = None
+DDL_DEPTH = threading.local() #how many DDLSlots each thread is inside
+
+
+def tableNameFor(fileName, tablePrefix=None):
+    """
+    Returns the name of the table which the EPF file named fileName is ingested into,
+    prefixed with tablePrefix if specified.
+    """
+    pref = ("%s_" % tablePrefix if tablePrefix else "")
+    tableName = (pref + fileName).replace("-", "_") #hyphens aren't allowed in table names
+    return tableName.split(".")[0]
+
+
+class RecordCountError(MySQLdb.DataError if MySQLdb else ValueError):
+    """
+    Raised when the number of records ingested from a file doesn't match the file's recordsWritten count.
+    """
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to size idle MySQLdb connections open for reuse.
+    
+    get() returns an idle connection if one passes a health check (a ping), or else opens a new one,
+    retrying up to retries times if the server can't be reached. release() rolls back any uncommitted
+    changes and returns the connection to the pool, or closes it if the pool is full.
+    
+    A pool can be shared by threads, but not by processes; see connectionPool().
+    """
+    def __init__(self, connectArgs, size=4, retries=3):
+        self.connectArgs = connectArgs #keyword arguments for MySQLdb.connect()
+        self.size = size
+        self.retries = retries
+        self.connectCount = 0 #the number of connections opened by this pool
+        self.pid = os.getpid()
+        self.idleConnections = []
+        self.lock = threading.Lock()
+        
+        
+    def get(self):
+        """
+        Returns a connection from the pool, opening one if there are no healthy idle connections.
+        """
+        while (True):
+            with self.lock:
+                if (not self.idleConnections):
+                    break
+                conn = self.idleConnections.pop()
+            try:
+                conn.ping()
+                return conn
+            except MySQLdb.Error, e:
+                LOGGER.warning("Discarding pooled connection which failed its health check: %s", str(e))
+                self._close(conn)
+        return self._connect()
+        
+        
+    def release(self, connection):
+        """
+        Returns connection to the pool, first rolling back anything not committed (as closing it would).
+        """
+        try:
+            connection.rollback()
+        except MySQLdb.Error, e:
+            self._close(connection)
+            return
+        with self.lock:
+            if len(self.idleConnections) < self.size:
+                self.idleConnections.append(connection)
+                return
+        self._close(connection)
+        
+        
+    def closeAll(self):
+        """
+        Closes all idle connections in the pool.
+        """
+        with self.lock:
+            idle = self.idleConnections
+            self.idleConnections = []
+        for aConn in idle:
+            self._close(aConn)
+        
+        
+    def _connect(self):
+        """
+        Opens a new connection, retrying with increasing delays if the server can't be reached.
+        """
+        attempt = 0
+        while (True):
+            try:
+                conn = MySQLdb.connect(**self.connectArgs)
+                break
+            except MySQLdb.OperationalError, e:
+                if (e.args[0] not in RECONNECT_ERRORS) or (attempt >= self.retries):
+                    raise
+                attempt += 1
+                LOGGER.warning("Unable to connect to the database (%s); retrying (attempt %i of %i)",
+                    e.args[-1], attempt, self.retries)
+                time.sleep(2 ** attempt)
+        with self.lock:
+            self.connectCount += 1
+        return conn
+        
+        
+    def _close(self, connection):
+        try:
+            connection.close()
+        except MySQLdb.Error:
+            pass
+        
+        
+class PooledConnection(object):
+    """
+    A connection borrowed from a ConnectionPool, which behaves like the MySQLdb connection it wraps,
+    except that close() returns it to the pool.
+    """
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+        
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+        
+    def close(self):
+        if self._connection is not None:
+            self._pool.release(self._connection)
+            self._connection = None
+            
+            
+def connectionPool(size=4, **connectArgs):
+    """
+    Returns this process's ConnectionPool for connectArgs, creating it if necessary, and sets its size.
+    
+    Connections can't be shared with processes forked from this one, so a pool is only returned
+    to the process that created it, and closeConnections() should be called before forking.
+    """
+    key = (os.getpid(), tuple(sorted(connectArgs.items())))
+    pool = CONNECTION_POOLS.get(key)
+    if pool is None:
+        pool = ConnectionPool(connectArgs, size=size)
+        CONNECTION_POOLS[key] = pool
+    pool.size = size
+    return pool
+    
+    
+def closeConnections():
+    """
+    Closes the idle connections in this process's connection pools.
+    """
+    for aPool in CONNECTION_POOLS.values():
+        if aPool.pid == os.getpid():
+            aPool.closeAll()
+            
+            
+def limitDDL(slots):
+    """
+    Limits the number of Ingesters in this process which run heavy DDL (see DDLSlot) at once to slots,
+    or removes the limit if slots is 0.
+    
+    slots can also be a semaphore, such as a multiprocessing.BoundedSemaphore passed to the
+    initializer of a process pool, so that the limit is shared with other processes.
+    """
+    global DDL_SEMAPHORE
+    if isinstance(slots, (int, long)):
+        slots = (threading.BoundedSemaphore(slots) if slots > 0 else None)
+    DDL_SEMAPHORE = slots
+    
+    
+class DDLSlot(object):
+    """
+    A context manager which holds one of the slots set by limitDDL() while an Ingester runs heavy DDL
+    on tableName, such as copying, re-keying, renaming or dropping a populated table, so that
+    the DDL of a few tables doesn't starve the other ingests of I/O. If no limit has been set, it does nothing.
+    
+    A slot is held by a thread, so DDLSlots nested inside it don't take another one.
+    """
+    def __init__(self, tableName):
+        self.tableName = tableName
+        self.semaphore = None
+        
+    def __enter__(self):
+        depth = getattr(DDL_DEPTH, "depth", 0)
+        DDL_DEPTH.depth = depth + 1
+        if (DDL_SEMAPHORE is not None) and (depth == 0):
+            t = time.time()
+            DDL_SEMAPHORE.acquire()
+            self.semaphore = DDL_SEMAPHORE #release the one acquired, even if the limit changes
+            waited = time.time() - t
+            if waited >= 1:
+                LOGGER.info("Waited %.1fs for a DDL slot for %s", waited, self.tableName)
+        return self
+        
+    def __exit__(self, excType, excValue, traceback):
+        DDL_DEPTH.depth -= 1
+        if self.semaphore is not None:
+            self.semaphore.release()
+            self.semaphore = None
+        return False
+        
+        
+def connectCount():
+    """
+    Returns the number of connections opened by this process's connection pools.
+    """
+    return sum([aPool.connectCount for aPool in CONNECTION_POOLS.values() if aPool.pid == os.getpid()])
+
+
 class Ingester(object):
     """
     Used to ingest an EPF file into a MySQL database.
+    
+    engine selects how records are written: "insert" (the default) uses multi-row INSERT/REPLACE
+    statements, while "loaddata" streams the file through LOAD DATA LOCAL INFILE, falling back
+    to INSERTs if the server or client refuses it. "executemany" passes the records as parameters
+    to cursor.executemany(), parsed as typed values (see EPFParser.Parser), rather than
+    building the statements itself.
     """
+    engines = ("insert", "loaddata", "executemany")
+    batchModes = ("rows", "bytes")
+    mergeStrategies = ("subquery", "antijoin")
+    incrementalStrategies = ("auto", "replace", "merge")
+    
+    #cost model used to plan incremental ingests; see _planIncremental()
+    pageSize = 16384 #bytes per InnoDB page
+    randomPageCost = 4.0 #cost of an uncached random page access, relative to a sequential one
+    cachedPageCost = 0.01 #cost of visiting a page of an index which is already in memory
+    mergeFixedCost = 10000.0 #cost of creating, swapping and dropping the merge's tables
+    
+    #columns left out of the row hashes used to detect changed rows; see _rowHashExpression()
+    hashExcludedColumns = ("export_date",)
+    
+    #limits for the "bytes" batch mode; see _adaptBatchBytes()
+    minBatchBytes = 65536
+    initialBatchBytes = 1048576
+    batchLatency = 0.5 #seconds; batches taking longer than this to execute are made smaller
+
     #MySQLdb turns MySQL warnings into python warnings, whose behavior is somewhat arcane
     #(as compared with python exceptions.
     #By default, turn all warnings into exceptions
@@ -75,23 +333,155 @@ class Ingester(object):
             dbPassword='epf123',
             dbName='epf',
             recordDelim='\x02\n',
-            fieldDelim='\x01'):
+            fieldDelim='\x01',
+            readMode="readline",
+            indexDir=None,
+            cacheDir=None,
+            cacheBytes=10737418240,
+            progressCallback=None,
+            checkpointGap=datetime.timedelta(0, 30, 0),
+            engine="insert",
+            loadChunkSize=67108864,
+            splits=1,
+            pipelineDepth=0,
+            batchMode="rows",
+            poolSize=4,
+            mergeStrategy="subquery",
+            incrementalStrategy="auto",
+            deferKeys=False,
+            sortTables=None,
+            sortMemory=268435456,
+            typed=False,
+            detectChanges=False,
+            profileDir=None):
         """
+        If indexDir is specified, the parser keeps a record index for the file there (see EPFParser.RecordIndex).
+        
+        If cacheDir is specified, the parser keeps the file's split records in a parse cache of at most
+        cacheBytes there, and reads them from it when the file is ingested again (see EPFParser.ParseCache).
+        
+        While a table is being populated, the rows written so far are committed at least every
+        checkpointGap, and the record number and file position following them are saved in
+        self.statusDict as a checkpoint. progressCallback, if specified, is called with
+        self.statusDict after each checkpoint, so that the caller can persist it.
+        
+        With the "loaddata" engine, records are loaded in chunks of about loadChunkSize bytes.
+        
+        If splits is greater than 1, full ingests divide the file into that many byte ranges
+        and load them into the temporary table at once, each with its own parser and connection
+        (unless the file is compressed, since that can't be divided without decompressing it).
+        Such ingests aren't checkpointed, so an interrupted one starts over when resumed.
+        
+        If pipelineDepth is greater than 0, the "insert" engine parses records and builds statements
+        in a separate thread, queueing up to pipelineDepth statements ahead of the one being executed.
+        
+        batchMode determines how many records each statement of the "insert" engine contains: with "rows"
+        (the default) it's 200, while with "bytes" the statements are filled up to a size which stays within
+        the server's max_allowed_packet, and which grows or shrinks depending on how long they take to execute.
+        
+        Connections come from a pool shared by all Ingesters in the process (see connectionPool()),
+        which keeps up to poolSize idle connections open.
+        
+        mergeStrategy determines how large incremental ingests are merged into the existing table,
+        and incrementalStrategy whether incremental ingests update the table in place ("replace")
+        or merge into a new one ("merge"); by default ("auto") this is planned for each ingest
+        (see ingestIncremental).
+        
+        If deferKeys is True, full ingests load the temporary table without a primary key, with
+        unique_checks and foreign_key_checks off, and then build the primary key in one pass.
+        
+        sortTables is a list of regular expressions; if the file name matches any of them (and the file
+        has a primary key), its records are sorted by primary key before being written, using
+        an EPFParser.RecordSorter which keeps about sortMemory bytes of records in memory.
+        Sorted ingests aren't checkpointed, so an interrupted one starts over when resumed.
+        
+        If typed is True, the "insert" engine writes the records as typed values (ints, Decimals, dates
+        and NULLs) rather than quoted strings, so that the server needn't convert them; the "executemany"
+        engine always does. Fields which can't be converted are logged and passed through as strings.
+        
+        If detectChanges is True, incremental ingests only write the rows which are new or have changed
+        (apart from their export_date), which they find by comparing the rows' hashes with those in a
+        side table (see _ingestChanges).
+        
+        If profileDir is specified, the time spent in each stage of writing the records, and the rows
+        and bytes passing through it, are accumulated in self.profiler (an EPFProfiler.Profiler,
+        shared with the parser), and writeProfile() writes its report to profileDir.
         """
+        if not MySQLdb:
+            raise ImportError("Ingesting EPF files into MySQL requires the MySQLdb module")
         self.filePath = filePath
         self.fileName = os.path.basename(filePath)
-        pref = ("%s_" % tablePrefix if tablePrefix else "")
-        self.tableName = (pref + self.fileName).replace("-", "_") #hyphens aren't allowed in table names
-        self.tableName = self.tableName.split(".")[0]
+        self.tableName = tableNameFor(self.fileName, tablePrefix)
         self.tmpTableName = self.tableName + "_tmp"
         self.incTableName = self.tableName + "_inc" #used during incremental ingests
         self.unionTableName = self.tableName + "_un" #used during incremental ingests
+        self.hashTableName = self.tableName + "_hash" #primary keys and row hashes, for detecting changes
         self.dbHost = dbHost
         self.dbUser = dbUser
         self.dbPassword = dbPassword
         self.dbName = dbName
+        self.poolSize = poolSize
         self.lastRecordIngested = -1
-        self.parser = EPFParser.Parser(filePath, recordDelim=recordDelim, fieldDelim=fieldDelim)
+        if engine == "executemany":
+            typed = True
+        elif typed and engine == "loaddata":
+            LOGGER.warning("The loaddata engine doesn't support typed records; loading them as strings")
+            typed = False
+        self.parser = EPFParser.Parser(filePath, recordDelim=recordDelim, fieldDelim=fieldDelim,
+            readMode=readMode, indexDir=indexDir, typed=typed, cacheDir=cacheDir, cacheBytes=cacheBytes)
+        self.progressCallback = progressCallback
+        if engine not in Ingester.engines:
+            raise ValueError("Unknown engine '%s'" % engine)
+        self.engine = engine
+        self.loadChunkSize = loadChunkSize #approximate size in bytes of each LOAD DATA chunk
+        self.checkpointGap = checkpointGap
+        if splits > 1 and self.parser.compression:
+            LOGGER.warning("Compressed files can't be split into byte ranges; ingesting %s whole", self.fileName)
+            splits = 1
+        self.splits = splits
+        self.pipelineDepth = pipelineDepth
+        if batchMode not in Ingester.batchModes:
+            raise ValueError("Unknown batchMode '%s'" % batchMode)
+        if engine == "executemany":
+            if batchMode == "bytes":
+                LOGGER.warning("The executemany engine only supports the rows batch mode; using it instead")
+                batchMode = "rows"
+        self.batchMode = batchMode
+        if mergeStrategy not in Ingester.mergeStrategies:
+            raise ValueError("Unknown mergeStrategy '%s'" % mergeStrategy)
+        self.mergeStrategy = mergeStrategy
+        if incrementalStrategy not in Ingester.incrementalStrategies:
+            raise ValueError("Unknown incrementalStrategy '%s'" % incrementalStrategy)
+        self.incrementalStrategy = incrementalStrategy
+        self.deferKeys = deferKeys
+        self.detectChanges = detectChanges
+        self.changeCounts = None #numbers of new, changed and unchanged rows, after detecting changes
+        self.incrementalPlan = None #"replace" or "merge", once an incremental ingest has chosen; see _planIncremental
+        sortTables = (sortTables if sortTables else [])
+        self.sortRecords = bool(self.parser.primaryKey) and any([re.search(aPattern, self.fileName) for aPattern in sortTables])
+        self.sortMemory = sortMemory
+        self.isSorting = False #True while self.parser is a RecordSorter
+        self.dedupTableName = self.tableName + "_dd" #used when building a deferred primary key
+        self.batchBytes = Ingester.initialBatchBytes #the current statement size in the "bytes" batch mode
+        self.maxBatchBytes = None #the largest allowable statement size, based on max_allowed_packet
+        self.batchStats = {} #statistics on the statements written by the last _insertRecords; see _logBatchStats()
+        self.stageTimes = {} #seconds spent in each stage of the last _insertRecords; see _logStageTimes()
+        self.profileDir = profileDir
+        self.profiler = (EPFProfiler.Profiler(filePath, self.tableName) if profileDir else None)
+        self.parser.profiler = self.profiler
+        #the arguments for creating the Ingester which loads each byte range in a split ingest
+        self.rangeIngesterArgs = dict(tablePrefix=tablePrefix, dbHost=dbHost, dbUser=dbUser,
+            dbPassword=dbPassword, dbName=dbName, recordDelim=recordDelim, fieldDelim=fieldDelim,
+            readMode=readMode, cacheDir=cacheDir, cacheBytes=cacheBytes, checkpointGap=checkpointGap,
+            engine=engine, loadChunkSize=loadChunkSize, pipelineDepth=pipelineDepth, batchMode=batchMode, poolSize=poolSize, mergeStrategy=mergeStrategy,
+            incrementalStrategy=incrementalStrategy, deferKeys=deferKeys, sortTables=sortTables,
+            sortMemory=sortMemory, typed=typed, detectChanges=detectChanges, profileDir=profileDir)
+        self.checkpointRecord = 0
+        self.checkpointPos = None
+        self.lastCheckpointTime = datetime.datetime.now()
+        fileStat = os.stat(filePath)
+        self.fileSize = fileStat.st_size
+        self.fileMTime = fileStat.st_mtime
         self.startTime = None
         self.endTime = None
         self.abortTime = None
@@ -110,6 +500,12 @@ class Ingester(object):
         self.statusDict['endTime'] = (str(self.endTime) if self.endTime else None)
         self.statusDict['abortTime'] = (str(self.abortTime) if self.abortTime else None)
         self.statusDict['didAbort'] = self.didAbort
+        self.statusDict['checkpointRecord'] = self.checkpointRecord
+        self.statusDict['checkpointPos'] = self.checkpointPos
+        self.statusDict['fileSize'] = self.fileSize
+        self.statusDict['fileMTime'] = self.fileMTime
+        self.statusDict['changeCounts'] = self.changeCounts
+        self.statusDict['incrementalPlan'] = self.incrementalPlan
 
         
     def ingest(self, skipKeyViolators=False):
@@ -120,6 +516,39 @@ class Ingester(object):
             self.ingestIncremental(skipKeyViolators=skipKeyViolators)
         else:
             self.ingestFull(skipKeyViolators=skipKeyViolators)
+            
+            
+    def resumePoint(self, statusDict):
+        """
+        Given the statusDict of an interrupted ingest of this file, returns a tuple of
+        (record number, file position) of its last checkpoint.
+        
+        Returns (0, None) if there was no checkpoint, or if the file has changed since. It does
+        the same for an interrupted incremental merge, which starts over when resumed, since its
+        checkpoints are positions in the temporary table it populates rather than in the table.
+        """
+        if (statusDict.get('fileSize') != self.fileSize) or (statusDict.get('fileMTime') != self.fileMTime):
+            return (0, None)
+        if statusDict.get('incrementalPlan') == "merge":
+            return (0, None)
+        return (statusDict.get('checkpointRecord') or 0, statusDict.get('checkpointPos'))
+        
+        
+    def ingestResume(self, fromRecord=0, fromPos=None, skipKeyViolators=False):
+        """
+        Resume an interrupted full or incremental ingest, continuing from fromRecord.
+        
+        If fromPos is specified, it must be the file position of record fromRecord, and the
+        parser starts reading there rather than seeking to the record.
+        
+        If the interrupted full ingest's temporary table no longer exists, performs a normal full ingest instead.
+        """
+        if self.parser.exportMode == 'INCREMENTAL':
+            self.ingestIncremental(fromRecord=fromRecord, fromPos=fromPos, skipKeyViolators=skipKeyViolators)
+        elif fromRecord > 0 and self.tableExists(self.tmpTableName):
+            self.ingestFullResume(fromRecord=fromRecord, fromPos=fromPos, skipKeyViolators=skipKeyViolators)
+        else:
+            self.ingestFull(skipKeyViolators=skipKeyViolators)
 
         
     def ingestFull(self, skipKeyViolators=False):
@@ -130,13 +559,22 @@ class Ingester(object):
         1. Create a new table with a temporary name
         2. Populate the new table
         3. Drop the old table and rename the new one
+        
+        If self.deferKeys is True, the table is created without its primary key,
+        which is added after populating it (see _buildPrimaryKey).
         """
-        LOGGER.info("Beginning full ingest of %s (%i records)", self.tableName, self.parser.recordsExpected)
+        LOGGER.info("Beginning full ingest of %s (%s)", self.tableName, self._recordCountString())
         self.startTime = datetime.datetime.now()
         try:
-            self._createTable(self.tmpTableName)
-            self._populateTable(self.tmpTableName, skipKeyViolators=skipKeyViolators)
+            self._createTable(self.tmpTableName, withPrimaryKey=(not self.deferKeys))
+            if self.splits > 1:
+                self._populateTableSplit(self.tmpTableName, skipKeyViolators=skipKeyViolators)
+            else:
+                self._populateTable(self.tmpTableName, skipKeyViolators=skipKeyViolators, bulkLoad=self.deferKeys)
+            if self.deferKeys:
+                self._buildPrimaryKey(self.tmpTableName, skipKeyViolators=skipKeyViolators)
             self._renameAndDrop(self.tmpTableName, self.tableName)
+            self._dropTable(self.hashTableName) #its hashes are of the replaced table
         except MySQLdb.Error, e:
             LOGGER.exception("Fatal error encountered while ingesting '%s'", self.filePath)
             LOGGER.error("Last record ingested before failure: %d", self.lastRecordIngested)
@@ -150,38 +588,57 @@ class Ingester(object):
         LOGGER.info("Full ingest of %s took %s", self.tableName, str(self.endTime - self.startTime))
         
     
-    def ingestFullResume(self, fromRecord=0, skipKeyViolators=False):
+    def ingestFullResume(self, fromRecord=0, fromPos=None, skipKeyViolators=False):
         """
-        Resume an interrupted full ingest, continuing from fromRecord.
+        Resume an interrupted full ingest, continuing from fromRecord (found at file position fromPos, if specified).
+        
+        If the interrupted ingest deferred the primary key, it is built once the table is populated.
         """
-        LOGGER.info("Resuming full ingest of %s (%i records)", self.tableName, self.parser.recordsExpected)
+        LOGGER.info("Resuming full ingest of %s (%s)", self.tableName, self._recordCountString())
         self.lastRecordIngested = fromRecord - 1
         self.startTime = datetime.datetime.now()
         try:
-            self._populateTable(self.tmpTableName, resumeNum=fromRecord, skipKeyViolators=skipKeyViolators)
+            hasKey = self._hasPrimaryKey(self.tmpTableName)
+            self._populateTable(self.tmpTableName, resumeNum=fromRecord, resumePos=fromPos,
+                skipKeyViolators=skipKeyViolators, bulkLoad=(not hasKey))
+            if not hasKey:
+                self._buildPrimaryKey(self.tmpTableName, skipKeyViolators=skipKeyViolators)
             self._renameAndDrop(self.tmpTableName, self.tableName)
+            self._dropTable(self.hashTableName) #its hashes are of the replaced table
         except MySQLdb.Error, e:
             #LOGGER.error("Error %d: %s", e.args[0], e.args[1])
             LOGGER.error("Error encountered while ingesting '%s'", self.filePath)
             LOGGER.error("Last record ingested before failure: %d", self.lastRecordIngested)
+            self.abortTime = datetime.datetime.now()
+            self.didAbort = True
+            self.updateStatusDict()
             raise #re-raise the exception
-        endTime = datetime.datetime.now()
+        self.endTime = datetime.datetime.now()
+        self.updateStatusDict()
         ts = str(self.endTime - self.startTime)
         LOGGER.info("Resumed full ingest of %s took %s", self.tableName, ts[:len(ts)-4])
     
 
-    def ingestIncremental(self, fromRecord=0, skipKeyViolators=False):
+    def ingestIncremental(self, fromRecord=0, fromPos=None, skipKeyViolators=False):
         """
         Update the table with the data in the file at filePath.
         
-        If the file to ingest has < 500,000 records, we do a simple REPLACE operation
-        on the existing table. If it's larger than that, we use the following 3-step process:
+        If the file to ingest is small relative to the table, we do a simple REPLACE operation
+        on the existing table (see _planIncremental). Otherwise, we use the following 3-step process:
         1. Create a temporary table, and populate it exactly as though it were a Full ingest
         2. Perform a SQL query which selects all rows in the old table whose primary keys *don't*
            match those in the new table, unions the result with all rows in the new table, and
            writes the resulting set to another temporary table.
         3. Swap out the old table for the new one via a rename (same as for Full ingests)
         This proves to be much faster for large files.
+        
+        With the "antijoin" merge strategy, step 2 instead creates the merged table with its primary key
+        and fills it using LEFT JOINs on the primary key (see _createMergedTable), which avoids running
+        a subquery for every row of the old table and rebuilding the primary key afterwards.
+        
+        If self.detectChanges is True (and the file has a primary key), only the new and changed rows
+        are written, using _ingestChanges. Otherwise any row hashes kept for that are dropped, since
+        they no longer match the table.
         """
         if not (self.tableExists(self.tableName)):
             #The table doesn't exist in the db; this can happen if the full ingest
@@ -195,32 +652,45 @@ class Ingester(object):
             
             if fileColCount > tableColCount: #file has "extra" columns
                 LOGGER.warn("File contains additional columns not in the existing table. These will not be imported.")
-                self.parser.columnNames = self.parser.columnNames[:tableColCount] #trim the columnNames
-                # to equal those in the existing table. This will result in the returned records
-                # also being sliced.
+                self.parser.trimColumns(tableColCount) #trim the columns to equal those in the existing table.
+                # This will result in the returned records also being sliced.
             s = ("Resuming" if fromRecord else "Beginning")
-            LOGGER.info("%s incremental ingest of %s (%i records)", s, self.tableName, self.parser.recordsExpected)
+            LOGGER.info("%s incremental ingest of %s (%s)", s, self.tableName, self._recordCountString())
             self.startTime = datetime.datetime.now()
             
             #Different ingest techniques are faster depending on the size of the input.
             #If there are a large number of records, it's much faster to do a prune-and-merge technique;
             #for fewer records, it's faster to update the existing table.
             try:
-                if self.parser.recordsExpected < 500000: #update table in place
-                    self._populateTable(self.tableName,
-                                    resumeNum=fromRecord, 
-                                    isIncremental=True, 
-                                    skipKeyViolators=skipKeyViolators)
-                else: #Import as full, then merge the proper records into a new table
-                    self._createTable(self.incTableName)
-                    LOGGER.info("Populating temporary table...")
-                    self._populateTable(self.incTableName, skipKeyViolators=skipKeyViolators)
-                    LOGGER.info("Creating merged table...")
-                    self._createUnionTable()
-                    self._dropTable(self.incTableName)
-                    LOGGER.info("Applying primary key constraints...")
-                    self._applyPrimaryKeyConstraints(self.unionTableName)
-                    self._renameAndDrop(self.unionTableName, self.tableName)
+                if self.detectChanges and not self.parser.primaryKey:
+                    LOGGER.warning("%s has no primary key, so changed rows can't be detected", self.fileName)
+                if self.detectChanges and self.parser.primaryKey:
+                    self._ingestChanges(skipKeyViolators=skipKeyViolators)
+                else:
+                    self.incrementalPlan = self._planIncremental(fromRecord)
+                    self.updateStatusDict() #so that a resumed ingest knows which strategy was used
+                    if self.incrementalPlan == "replace": #update table in place
+                        self._populateTable(self.tableName,
+                                        resumeNum=fromRecord, 
+                                        resumePos=fromPos,
+                                        isIncremental=True, 
+                                        skipKeyViolators=skipKeyViolators)
+                    else: #Import as full, then merge the proper records into a new table
+                        self._createTable(self.incTableName)
+                        LOGGER.info("Populating temporary table...")
+                        self._populateTable(self.incTableName, skipKeyViolators=skipKeyViolators)
+                        LOGGER.info("Creating merged table...")
+                        if self.mergeStrategy == "antijoin":
+                            self._createMergedTable()
+                            self._dropTable(self.incTableName)
+                        else:
+                            self._createUnionTable()
+                            self._dropTable(self.incTableName)
+                            LOGGER.info("Applying primary key constraints...")
+                            with DDLSlot(self.unionTableName):
+                                self._applyPrimaryKeyConstraints(self.unionTableName)
+                        self._renameAndDrop(self.unionTableName, self.tableName)
+                    self._dropTable(self.hashTableName) #its hashes may no longer match the table
             
             except MySQLdb.Error, e:
                 #LOGGER.error("Error %d: %s", e.args[0], e.args[1])
@@ -237,12 +707,194 @@ class Ingester(object):
         self.updateStatusDict()
                 
         
+    def _ingestChanges(self, skipKeyViolators=False):
+        """
+        Updates the table with only those rows of the file which are new or have changed:
+        1. Populate self.incTableName with the file's records, as for a merge
+        2. If it doesn't exist yet, create self.hashTableName, holding the primary key and a hash
+           of every row of the table (see _createHashTable)
+        3. Count the incoming rows with no hash (new) and with a different hash (changed),
+           using a LEFT JOIN on the primary key
+        4. REPLACE just those rows into the table, and their hashes into self.hashTableName
+        
+        The hashes leave out export_date (see _rowHashExpression), which changes with every export,
+        so rows differing only in their export_date count as unchanged and aren't written.
+        
+        Sets self.changeCounts to a dictionary of the numbers of "new", "changed" and "unchanged" rows.
+        
+        An interrupted change-detecting ingest starts over when resumed; since the rows it had
+        already written have matching hashes, they count as unchanged the second time.
+        """
+        self._createTable(self.incTableName)
+        LOGGER.info("Populating temporary table...")
+        self._populateTable(self.incTableName, skipKeyViolators=skipKeyViolators)
+        if not self.tableExists(self.hashTableName):
+            self._createHashTable()
+        
+        LOGGER.info("Comparing row hashes...")
+        colNames = self.parser.columnNames
+        pCols = self.parser.primaryKey
+        hashExpr = self._rowHashExpression(self.incTableName)
+        joinStr = "%s LEFT JOIN %s ON %s" % (self.incTableName, self.hashTableName,
+            self._primaryKeyJoin(self.incTableName, self.hashTableName))
+        whereStr = "WHERE %s.%s IS NULL OR %s.row_hash <> %s" % (self.hashTableName, pCols[0],
+            self.hashTableName, hashExpr)
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute("""SELECT COUNT(*), SUM(%s.%s IS NULL), SUM(%s.row_hash <> %s) FROM %s""" % (
+            self.hashTableName, pCols[0], self.hashTableName, hashExpr, joinStr))
+        rowCount, newCount, changedCount = [int(aCount or 0) for aCount in cur.fetchone()]
+        self.changeCounts = {"new":newCount, "changed":changedCount,
+            "unchanged":rowCount - newCount - changedCount}
+        
+        #the table must be written first, while the hashes still identify the rows to write
+        cur.execute("""REPLACE INTO %s (%s) SELECT %s FROM %s %s""" % (self.tableName, ", ".join(colNames),
+            ", ".join(["%s.%s" % (self.incTableName, aCol) for aCol in colNames]), joinStr, whereStr))
+        cur.execute("""REPLACE INTO %s (%s, row_hash) SELECT %s, %s FROM %s %s""" % (self.hashTableName,
+            ", ".join(pCols), ", ".join(["%s.%s" % (self.incTableName, aCol) for aCol in pCols]),
+            hashExpr, joinStr, whereStr))
+        conn.commit()
+        conn.close()
+        self._dropTable(self.incTableName)
+        LOGGER.info("Incremental rows for %s: %i new, %i changed, %i unchanged (not written)", self.tableName,
+            self.changeCounts["new"], self.changeCounts["changed"], self.changeCounts["unchanged"])
+        
+        
+    def _createHashTable(self):
+        """
+        Creates self.hashTableName, with the table's primary key columns and a row_hash column,
+        and fills it with the hash of every row of the table.
+        """
+        with DDLSlot(self.hashTableName):
+            LOGGER.info("Hashing the rows of %s...", self.tableName)
+            pCols = self.parser.primaryKey
+            conn = self.connect()
+            cur = conn.cursor()
+            cur.execute("""DROP TABLE IF EXISTS %s""" % self.hashTableName)
+            colStr = ", ".join(["%s %s" % (aCol, self.parser.typeMap[aCol]) for aCol in pCols])
+            cur.execute("""CREATE TABLE %s (%s, row_hash BINARY(16) NOT NULL)""" % (self.hashTableName, colStr))
+            conn.close()
+            self._applyPrimaryKeyConstraints(self.hashTableName)
+            conn = self.connect()
+            cur = conn.cursor()
+            cur.execute("""INSERT INTO %s (%s, row_hash) SELECT %s, %s FROM %s""" % (self.hashTableName,
+                ", ".join(pCols), ", ".join(pCols), self._rowHashExpression(self.tableName), self.tableName))
+            conn.commit()
+            conn.close()
+        
+        
+    def _rowHashExpression(self, tableName):
+        """
+        Returns the SQL expression for the 16-byte MD5 hash of a row of tableName, over all of its
+        columns except those in Ingester.hashExcludedColumns.
+        
+        The fields are separated by CHAR(1), which EPF fields never contain, and NULLs are replaced
+        with CHAR(0), so that they hash differently from empty strings.
+        """
+        colNames = [aCol for aCol in self.parser.columnNames if aCol not in Ingester.hashExcludedColumns]
+        fieldStr = ", ".join(["IFNULL(%s.%s, CHAR(0))" % (tableName, aCol) for aCol in colNames])
+        return "UNHEX(MD5(CONCAT_WS(CHAR(1), %s)))" % fieldStr
+        
+        
+    def _recordCountString(self):
+        """
+        Describes the number of records in the file for log messages, without reading through
+        a compressed file to find it.
+        """
+        recordCount = self.parser.knownRecordCount()
+        return ("%i records" % recordCount if recordCount is not None else "compressed")
+        
+        
+    def _planIncremental(self, fromRecord=0):
+        """
+        Returns the strategy for an incremental ingest: "replace" to update the table in place,
+        or "merge" to merge it with the new records into a new table.
+        
+        Unless self.incrementalStrategy forces one, this compares estimated costs, in units of
+        sequential page accesses:
+        - replacing costs a random read and write of a leaf page of the table's primary key
+          for each record, plus traversing the (cached) upper levels of the index, while
+        - merging costs reading and writing the whole table, writing, reading and copying the
+          new records, a cached index lookup per row for the joins, and a fixed cost for creating
+          and swapping the tables; the "subquery" merge
+          strategy also rebuilds the primary key, which costs another pass over the table.
+        The table's size comes from information_schema.tables, and the index depth from
+        its row count and the declared width of the primary key.
+        
+        A resumed ingest (fromRecord > 0) continues with "replace", since an interrupted merge is
+        started over instead (see resumePoint).
+        """
+        if self.incrementalStrategy != "auto":
+            LOGGER.info("Using %s for incremental ingest of %s, as specified", self.incrementalStrategy, self.tableName)
+            return self.incrementalStrategy
+        if fromRecord > 0:
+            LOGGER.info("Continuing with replace for resumed incremental ingest of %s", self.tableName)
+            return "replace"
+        
+        tableRows, tableBytes, avgRowBytes = self._tableStats()
+        recordCount = self.parser.recordsExpected
+        if not avgRowBytes:
+            #the parser's positions are in the decompressed data, whose size the file's doesn't reflect if it's compressed
+            avgRowBytes = float(self.parser.dataEndPos - self.parser.dataStartPos) / max(recordCount, 1)
+        keyWidth = self._primaryKeyWidth()
+        fanout = Ingester.pageSize / (keyWidth + 6.0) #6 bytes per child page pointer
+        depth = max(1, int(math.ceil(math.log(max(tableRows, 2)) / math.log(fanout))))
+        tablePages = float(tableBytes) / Ingester.pageSize
+        newPages = recordCount * avgRowBytes / Ingester.pageSize
+        
+        replaceCost = recordCount * (2 * Ingester.randomPageCost + depth * Ingester.cachedPageCost)
+        mergeCost = (Ingester.mergeFixedCost + 2 * tablePages + 3 * newPages +
+            (tableRows + recordCount) * depth * Ingester.cachedPageCost)
+        if self.mergeStrategy == "subquery":
+            mergeCost += 2 * tablePages
+        plan = ("replace" if replaceCost <= mergeCost else "merge")
+        LOGGER.info("Planning incremental ingest of %i records into %s (%i rows, %.1f MB, %i byte key): "
+            "estimated cost of replace %.0f, merge %.0f; using %s", recordCount, self.tableName,
+            tableRows, tableBytes / 1048576.0, keyWidth, replaceCost, mergeCost, plan)
+        return plan
+        
+        
+    def _tableStats(self, tableName=None):
+        """
+        Returns a tuple of the (approximate) row count, the total size in bytes of the data and indexes,
+        and the average row length of tableName (by default self.tableName), from information_schema.tables.
+        """
+        tableName = (tableName if tableName else self.tableName)
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute("""SELECT table_rows, data_length, index_length, avg_row_length FROM information_schema.tables
+                    WHERE table_schema = %s
+                    AND table_name = %s""", (self.dbName, tableName))
+        fet = (cur.fetchone() or (0, 0, 0, 0)) #the values are NULL for views
+        cur.close()
+        conn.close()
+        tableRows, dataLength, indexLength, avgRowLength = [int(aVal or 0) for aVal in fet]
+        return (tableRows, dataLength + indexLength, avgRowLength)
+        
+        
+    def _primaryKeyWidth(self):
+        """
+        Returns the width in bytes of the primary key, based on the declared types of its columns
+        (taking the maximum length of character columns).
+        """
+        widths = {"TINYINT": 1, "INT": 4, "INTEGER": 4, "BIGINT": 8, "DATE": 3, "DATETIME": 8}
+        keyWidth = 0
+        for aCol in self.parser.primaryKey:
+            dType = self.parser.typeMap.get(aCol, "")
+            match = re.search(r"\((\d+)\)", dType)
+            keyWidth += (int(match.group(1)) if match else widths.get(dType.upper(), 8))
+        return max(keyWidth, 1)
+        
+        
     def connect(self):
         """
         Establish a connection to the database, returning the connection object.
+        
+        The connection is borrowed from the process's connection pool, and closing it returns it there.
         """
-        conn = MySQLdb.connect(host=self.dbHost, user=self.dbUser, passwd=self.dbPassword, db=self.dbName)
-        return conn
+        pool = connectionPool(size=self.poolSize, host=self.dbHost, user=self.dbUser, passwd=self.dbPassword,
+            db=self.dbName, local_infile=(1 if self.engine == "loaddata" else 0))
+        return PooledConnection(pool, pool.get())
             
     
     def tableExists(self, tableName=None, connection=None):
@@ -292,11 +944,11 @@ class Ingester(object):
         return colCount
 
     
-    def _createTable(self, tableName):
+    def _createTable(self, tableName, withPrimaryKey=True):
         """
         Connect to the db and create a table named self.tableName_TMP, dropping previous one if it exists.
         
-        Also adds primary key constraint to the new table.
+        Also adds primary key constraint to the new table, unless withPrimaryKey is False.
         """
         conn = self.connect()
         cur = conn.cursor()
@@ -310,7 +962,8 @@ class Ingester(object):
         cur.execute(exStr) #create the table in the database
         #set the primary key
         conn.close()
-        self._applyPrimaryKeyConstraints(tableName)
+        if withPrimaryKey:
+            self._applyPrimaryKeyConstraints(tableName)
         
 
     def _applyPrimaryKeyConstraints(self, tableName):
@@ -328,6 +981,71 @@ class Ingester(object):
             conn.close()
         
 
+    def _hasPrimaryKey(self, tableName):
+        """
+        Returns True if tableName has a primary key, or if the file doesn't specify one
+        (so that there is nothing to add).
+        """
+        if not self.parser.primaryKey:
+            return True
+        conn = self.connect()
+        cur = conn.cursor()
+        keyCount = cur.execute("""SHOW KEYS FROM %s WHERE Key_name = 'PRIMARY'""" % tableName)
+        cur.close()
+        conn.close()
+        return bool(keyCount)
+        
+
+    def _buildPrimaryKey(self, tableName, skipKeyViolators=False):
+        """
+        Adds the primary key to tableName after it has been populated without one.
+        
+        If the table contains duplicate keys, it is copied into a new table which has the primary key,
+        keeping only the first row with each key, and replaced with that. As when inserting into a table
+        which already has its primary key, the duplicates are logged as errors unless skipKeyViolators is True.
+        """
+        with DDLSlot(tableName):
+            LOGGER.info("Building primary key of %s...", tableName)
+            try:
+                self._applyPrimaryKeyConstraints(tableName)
+                return
+            except MySQLdb.IntegrityError, e:
+                if not skipKeyViolators:
+                    LOGGER.error("Error %d: %s", e.args[0], e.args[1])
+        
+            conn = self.connect()
+            cur = conn.cursor()
+            cur.execute("""DROP TABLE IF EXISTS %s""" % self.dedupTableName)
+            cur.execute("""CREATE TABLE %s LIKE %s""" % (self.dedupTableName, tableName))
+            self._applyPrimaryKeyConstraints(self.dedupTableName)
+            try:
+                cur.execute("""INSERT IGNORE INTO %s SELECT * FROM %s""" % (self.dedupTableName, tableName))
+            except MySQLdb.Warning:
+                pass #the skipped duplicates; they're counted below
+            conn.commit()
+            cur.execute("""SELECT COUNT(*) FROM %s""" % tableName)
+            rowCount = cur.fetchone()[0]
+            cur.execute("""SELECT COUNT(*) FROM %s""" % self.dedupTableName)
+            dupCount = rowCount - cur.fetchone()[0]
+            if not skipKeyViolators:
+                LOGGER.error("Skipped %i records of %s which duplicate the primary key of earlier records",
+                    dupCount, self.tableName)
+            cur.execute("""DROP TABLE %s""" % tableName)
+            cur.execute("""ALTER TABLE %s RENAME %s""" % (self.dedupTableName, tableName))
+            conn.close()
+        
+
+    def _setBulkLoad(self, connection, isEnabled):
+        """
+        Turns the session's unique_checks and foreign_key_checks off (if isEnabled is True) or back on,
+        for loading a table which has no primary key yet.
+        """
+        val = (0 if isEnabled else 1)
+        cur = connection.cursor()
+        cur.execute("""SET unique_checks = %i, foreign_key_checks = %i""" % (val, val))
+        cur.close()
+        
+
     def _escapeRecords(self, recordList, connection=None):
         """
         Appropriately escape the contents of a list of records (as returned by the parser)
@@ -335,21 +1053,213 @@ class Ingester(object):
         
         This is done here rather than in the parser because it uses the literal() method of the
         connection object.
+        
+        If a connection object is specified, this method uses it; if not, it creates one
+        using connect(), uses it, and then closes it.
         """
         conn = (connection if connection else self.connect())
+        literal = conn.literal
         escapedRecords = []
         for aRec in recordList:
-            escRec = [conn.literal(aField) for aField in aRec]
+            escRec = [literal(aField) for aField in aRec]
             escapedRecords.append(escRec)
+        if not connection:
+            conn.close()
         return escapedRecords
         
 
-    def _populateTable(self, tableName, resumeNum=0, isIncremental=False, skipKeyViolators=False):
+    def _populateTable(self, tableName, resumeNum=0, resumePos=None, isIncremental=False, skipKeyViolators=False,
+            bulkLoad=False):
         """
-        Populate tableName with data fetched by the parser, first advancing to resumePos.
+        Populate tableName with data fetched by the parser, first advancing to record resumeNum.
+        If resumePos is specified, it is taken to be the file position of that record.
         
         For Full imports, if skipKeyViolators is True, any insertions which would violate the primary key constraint
         will be skipped and won't log errors.
+        
+        If bulkLoad is True, unique and foreign key checks are turned off while populating (see _setBulkLoad).
+        
+        If self.sortRecords is True, the records are sorted before being written (see _sortRecords).
+        """
+        if resumePos is None:
+            self.parser.seekToRecord(resumeNum) #advance to resumeNum
+        else:
+            self.parser.seekPos = resumePos
+            self.parser.latestRecordNum = resumeNum
+        self.checkpointRecord = resumeNum
+        self.checkpointPos = self.parser.seekPos
+        parser = self.parser
+        if self.sortRecords:
+            self._sortRecords()
+        try:
+            conn = self.connect()
+            if bulkLoad:
+                self._setBulkLoad(conn, True)
+            
+            isLoaded = False
+            if self.engine == "loaddata":
+                isLoaded = self._loadData(conn, tableName, isIncremental=isIncremental, skipKeyViolators=skipKeyViolators)
+            if not isLoaded:
+                self._insertRecords(conn, tableName, isIncremental=isIncremental, skipKeyViolators=skipKeyViolators)
+            
+            self._checkpoint(conn)
+            if bulkLoad:
+                self._setBulkLoad(conn, False) #the connection goes back to the pool
+            conn.close()
+        finally:
+            if self.isSorting:
+                LOGGER.info("Merging sorted records of %s took %.2fs", self.tableName, self.parser.mergeTime)
+                self.parser.close()
+                self.parser = parser
+                self.isSorting = False
+        
+        
+    def _sortRecords(self):
+        """
+        Replaces self.parser with an EPFParser.RecordSorter which has sorted the parser's remaining records,
+        logging the time taken; _populateTable restores the parser afterwards.
+        
+        The time saved can be judged from the "execute" stage time logged by _insertRecords,
+        compared with an unsorted ingest.
+        """
+        LOGGER.info("Sorting records of %s by primary key...", self.tableName)
+        sorter = EPFParser.RecordSorter(self.parser, memoryLimit=self.sortMemory)
+        try:
+            sorter.sort()
+        except:
+            sorter.close()
+            raise
+        self.parser = sorter
+        self.isSorting = True
+        LOGGER.info("Sorted %i records of %s in %.2fs (%i runs, %.1f MB spilled)", sorter.recordCount,
+            self.tableName, sorter.sortTime, max(len(sorter.runPaths), 1), sorter.spilledBytes / 1048576.0)
+        
+        
+    def _populateTableSplit(self, tableName, skipKeyViolators=False):
+        """
+        Populate tableName by dividing the file into self.splits byte ranges (see EPFParser.Parser.byteRanges)
+        and loading them at once, each in its own worker with its own connection.
+        
+        The workers are processes, unless this is already running in a daemonic process
+        (such as a worker of EPFImporter's process pool), which can't have children, or in a thread
+        other than the main one (such as one of EPFImporter's threaded workers), which shares the
+        process's connection pools with other threads; then they're threads.
+        
+        Raises RecordCountError if the total number of records loaded doesn't match self.parser.recordsExpected.
+        """
+        ranges = self.parser.byteRanges(self.splits)
+        LOGGER.info("Populating %s from %i byte ranges", tableName, len(ranges))
+        if multiprocessing.current_process().daemon or not isinstance(threading.current_thread(), threading._MainThread):
+            pool = multiprocessing.pool.ThreadPool(processes=len(ranges))
+        else:
+            closeConnections() #the worker processes can't share them
+            pool = multiprocessing.Pool(processes=len(ranges))
+        try:
+            results = [pool.apply_async(_populateRange,
+                (self.filePath, self.rangeIngesterArgs, tableName, startPos, endPos,
+                "%i/%i" % (j + 1, len(ranges)), skipKeyViolators))
+                for j, (startPos, endPos) in enumerate(ranges)]
+            recordCount = 0
+            for aResult in results:
+                rangeCount, rangeStages = aResult.get()
+                recordCount += rangeCount
+                if self.profiler:
+                    self.profiler.merge(rangeStages)
+        finally:
+            pool.terminate()
+            pool.join()
+        self.lastRecordIngested = recordCount
+        if recordCount != self.parser.recordsExpected:
+            raise RecordCountError(0, "Loaded %i records from %s, but it contains %i" %
+                (recordCount, self.fileName, self.parser.recordsExpected))
+        
+        
+    def _populateRange(self, tableName, startPos, endPos, rangeName, skipKeyViolators=False):
+        """
+        Populate tableName with the records between file positions startPos and endPos,
+        logging progress under rangeName at each checkpoint.
+        
+        Returns the number of records written.
+        """
+        startTime = datetime.datetime.now()
+        self.parser.endPos = endPos
+        self.parser.dataEndPos = min(self.parser.dataEndPos, endPos) #where LOAD DATA's raw chunks stop
+        self.progressCallback = (lambda statusDict:
+            LOGGER.info("...%s range %s at record %i...", self.tableName, rangeName, statusDict['checkpointRecord']))
+        self._populateTable(tableName, resumePos=startPos, skipKeyViolators=skipKeyViolators, bulkLoad=self.deferKeys)
+        ts = str(datetime.datetime.now() - startTime)
+        LOGGER.info("Range %s of %s (%i records) took %s", rangeName, self.tableName,
+            self.parser.latestRecordNum, ts[:len(ts)-4])
+        return self.parser.latestRecordNum
+        
+        
+    def _insertRecords(self, connection, tableName, isIncremental=False, skipKeyViolators=False):
+        """
+        Writes the parser's remaining records to tableName using multi-row INSERT
+        (or for incremental ingests, REPLACE) statements, or with the "executemany" engine,
+        parameterized ones passed to executemany().
+        
+        If self.pipelineDepth is greater than 0, the statements are built in a separate thread
+        (see _pipelined) while this one executes them. MySQLdb connections can't be shared by threads,
+        so that thread escapes the records with a connection of its own from the pool.
+        """
+        conn = connection
+        self.stageTimes = dict.fromkeys(["parse", "escape", "build", "execute"], 0.0)
+        self.batchStats = dict.fromkeys(["statements", "rows", "bytes", "maxRows", "maxBytes", "grown", "shrunk"], 0)
+        if self.batchMode == "bytes":
+            self.maxBatchBytes = self._maxStatementBytes(conn)
+            self.batchBytes = min(self.batchBytes, self.maxBatchBytes)
+        lastRecordNum = self.parser.latestRecordNum
+        escapeConn = None #the connection used to escape records, if not conn
+        if self.engine == "executemany":
+            statements = self._executeManyStatements(tableName, isIncremental=isIncremental,
+                skipKeyViolators=skipKeyViolators)
+        else:
+            if self.pipelineDepth > 0:
+                escapeConn = self.connect()
+            statements = self._insertStatements((escapeConn or conn), tableName, isIncremental=isIncremental,
+                skipKeyViolators=skipKeyViolators)
+        if self.pipelineDepth > 0:
+            statements = self._pipelined(statements)
+        
+        try:
+            for exStr, params, recordNum, pos in statements:
+                cur = conn.cursor()
+                t = time.time()
+                try:
+                    if params is None:
+                        cur.execute(exStr)
+                    else:
+                        cur.executemany(exStr, params)
+                except MySQLdb.Warning, e:
+                    LOGGER.warning(str(e))
+                except MySQLdb.IntegrityError, e:
+                #This is likely a primary key constraint violation; should only be hit if skipKeyViolators is False
+                    LOGGER.error("Error %d: %s", e.args[0], e.args[1])
+                latency = time.time() - t
+                rowCount = recordNum - lastRecordNum
+                byteCount = (len(exStr) if params is None else 0)
+                self._addStageTime("execute", latency, rowCount, byteCount)
+                self._recordBatch(rowCount, byteCount)
+                lastRecordNum = recordNum
+                if self.batchMode == "bytes":
+                    self._adaptBatchBytes(latency)
+                self._batchWritten(conn, recordNum=recordNum, pos=pos)
+        finally:
+            statements.close() #stops the producer thread, if any
+            if escapeConn:
+                escapeConn.close()
+        self._logStageTimes()
+        self._logBatchStats()
+            
+            
+    def _insertStatements(self, connection, tableName, isIncremental=False, skipKeyViolators=False):
+        """
+        A generator which parses the remaining records in batches and yields, for each batch,
+        a tuple of the INSERT or REPLACE statement that writes it, None (since it has no parameters),
+        and the parser's record number and file position following it.
+        
+        Adds the time spent parsing, escaping and building the statements to self.stageTimes (see _addStageTime).
         """
         #REPLACE is a MySQL extension which inserts if the key is new, or deletes and inserts if the key is a duplicate
         commandString = ("REPLACE" if isIncremental else "INSERT")
@@ -357,42 +1267,464 @@ class Ingester(object):
         exStrTemplate = """%s %s INTO %s %s VALUES %s"""
         colNamesStr = "(%s)" % (", ".join(self.parser.columnNames))
         
-        self.parser.seekToRecord(resumeNum) #advance to resumeNum
-        conn = self.connect()
+        if self.batchMode == "bytes":
+            batches = self._byteBatches(connection)
+        else:
+            batches = self._rowBatches(connection)
+        for stringList, recordNum, pos in batches:
+            t0 = time.time()
+            #Although EPF specifies its exports as utf-8, for some reason Python sometimes complains
+            #about out-of-ASCII characters unless we reencode as latin-1.
+            colVals = unicode(", ".join(stringList), 'latin-1')
+            exStr = exStrTemplate % (commandString, ignoreString, tableName, colNamesStr, colVals)
+            #unquote NULLs
+            exStr = exStr.replace("'NULL'", "NULL")
+            exStr = exStr.replace("'null'", "NULL")
+            self._addStageTime("build", time.time() - t0, len(stringList), len(exStr))
+            yield (exStr, None, recordNum, pos)
+            
+            
+    def _executeManyStatements(self, tableName, isIncremental=False, skipKeyViolators=False):
+        """
+        Counterpart of _insertStatements for the "executemany" engine, which yields the same
+        parameterized statement for each batch of 200 records, with the records as its parameters.
+        
+        The parser is typed, so empty fields are None, and the fields of numeric and date columns are
+        Python values (or strings if they aren't valid ones, for the server to deal with).
         
+        MySQLdb has no server-side prepared statements; executemany() fills in the parameters
+        and sends the batch as a single multi-row statement.
+        """
+        commandString = ("REPLACE" if isIncremental else "INSERT")
+        ignoreString = ("IGNORE" if (skipKeyViolators and not isIncremental) else "")
+        exStr = """%s %s INTO %s (%s) VALUES (%s)""" % (commandString, ignoreString, tableName,
+            ", ".join(self.parser.columnNames), ", ".join(["%s"] * len(self.parser.columnNames)))
+        
+        while (True):
+            t0 = time.time()
+            records = self.parser.nextRecords(maxNum=200)
+            if (not records):
+                break
+            self._addStageTime("parse", time.time() - t0)
+            yield (exStr, records, self.parser.latestRecordNum, self.parser.seekPos)
+            
+            
+    def _rowBatches(self, connection):
+        """
+        A generator which yields the remaining records in batches of 200, each as a tuple of the list of
+        escaped row strings (e.g. "(1, 'abc')"), and the parser's record number and file position following it.
+        """
         while (True):
             #By default, we concatenate 200 inserts into a single INSERT statement.
             #a large batch size per insert improves performance, until you start hitting max_packet_size issues.
-            #If you increase MySQL server's max_packet_size, you may get increased performance by increasing maxNum
+            #If you increase MySQL server's max_packet_size, you may get increased performance by increasing maxNum,
+            #or use the "bytes" batch mode
+            t0 = time.time()
             records = self.parser.nextRecords(maxNum=200)
             if (not records):
                 break
-            
-            escapedRecords = self._escapeRecords(records) #This will sanitize the records
+            t1 = time.time()
+            escapedRecords = self._escapeRecords(records, connection) #This will sanitize the records
             stringList = ["(%s)" % (", ".join(aRecord)) for aRecord in escapedRecords]
+            t2 = time.time()
+            self._addStageTime("parse", t1 - t0)
+            self._addStageTime("escape", t2 - t1, len(records),
+                (sum([len(aString) for aString in stringList]) if self.profiler else 0))
+            yield (stringList, self.parser.latestRecordNum, self.parser.seekPos)
             
-            cur = conn.cursor()
-            #Although EPF specifies its exports as utf-8, for some reason Python sometimes complains
-            #about out-of-ASCII characters unless we reencode as latin-1.
-            colVals = unicode(", ".join(stringList), 'latin-1')
-            exStr = exStrTemplate % (commandString, ignoreString, tableName, colNamesStr, colVals)
-            #unquote NULLs
-            exStr = exStr.replace("'NULL'", "NULL")
-            exStr = exStr.replace("'null'", "NULL")
-
+            
+    def _byteBatches(self, connection):
+        """
+        Counterpart of _rowBatches for the "bytes" batch mode: each batch holds as many records as fit
+        in self.batchBytes (but always at least one).
+        
+        Records are read and escaped 200 at a time (see _escapedChunk), and packed into batches by
+        size; since a batch is only known to be full once the next record has been read, the rows
+        left over are carried over into the following batch. Each batch is yielded with the record
+        number and file position following its last row.
+        """
+        rowStrings = [] #the escaped rows of the current chunk
+        positions = [] #the file position following each of them
+        chunkStart = 0 #the record number preceding the chunk
+        i = 0 #the index of the next row of the chunk to batch
+        while (True):
+            stringList = []
+            batchSize = 0
+            while (True):
+                if (i >= len(rowStrings)):
+                    if stringList:
+                        #the batch continues past this chunk, whose end follows the rows batched so far
+                        recordNum, pos = chunkStart + i, positions[i - 1]
+                    chunkStart = self.parser.latestRecordNum
+                    rowStrings, positions = self._escapedChunk(connection)
+                    i = 0
+                    if (not rowStrings):
+                        break
+                rowString = rowStrings[i]
+                if stringList and (batchSize + len(rowString) + 2 > self.batchBytes):
+                    break
+                stringList.append(rowString)
+                batchSize += len(rowString) + 2 #include the separating ", "
+                i += 1
+            if (not stringList):
+                break
+            if (i > 0): #the batch ends in the current chunk
+                recordNum, pos = chunkStart + i, positions[i - 1]
+            yield (stringList, recordNum, pos)
+            
+            
+    def _escapedChunk(self, connection):
+        """
+        Reads the next 200 records and escapes them as in _rowBatches, returning a tuple of the list
+        of row strings and the list of the file positions following each record (both empty at the end).
+        """
+        t0 = time.time()
+        positions = []
+        records = self.parser.nextRecords(maxNum=200, positions=positions)
+        if (not records):
+            return ([], [])
+        t1 = time.time()
+        escapedRecords = self._escapeRecords(records, connection)
+        rowStrings = ["(%s)" % (", ".join(aRecord)) for aRecord in escapedRecords]
+        t2 = time.time()
+        self._addStageTime("parse", t1 - t0)
+        self._addStageTime("escape", t2 - t1, len(records),
+            (sum([len(aString) for aString in rowStrings]) if self.profiler else 0))
+        return (rowStrings, positions)
+            
+            
+    def _maxStatementBytes(self, connection):
+        """
+        Returns the largest statement size, in characters, that the "bytes" batch mode should use,
+        based on the server's max_allowed_packet.
+        
+        This is half of max_allowed_packet, since statements are sent in the connection's character set,
+        in which a (latin-1 decoded) character may take up two bytes.
+        """
+        cur = connection.cursor()
+        cur.execute("""SHOW VARIABLES LIKE 'max_allowed_packet'""")
+        fet = cur.fetchone()
+        cur.close()
+        maxPacket = int(fet[1])
+        #leave room for the rest of the statement
+        return max(maxPacket // 2 - 1024, Ingester.minBatchBytes)
+        
+        
+    def _adaptBatchBytes(self, latency):
+        """
+        Adjusts self.batchBytes after a statement took latency seconds to execute: it's halved (but not below
+        Ingester.minBatchBytes) if that's longer than Ingester.batchLatency, or doubled (but not above
+        self.maxBatchBytes) if it's less than half of it.
+        """
+        if (latency > Ingester.batchLatency) and (self.batchBytes > Ingester.minBatchBytes):
+            self.batchBytes = max(self.batchBytes // 2, Ingester.minBatchBytes)
+            self.batchStats["shrunk"] += 1
+        elif (latency < Ingester.batchLatency / 2) and (self.batchBytes < self.maxBatchBytes):
+            self.batchBytes = min(self.batchBytes * 2, self.maxBatchBytes)
+            self.batchStats["grown"] += 1
+            
+            
+    def _recordBatch(self, rowCount, byteCount):
+        """
+        Adds a statement of rowCount rows and byteCount characters to self.batchStats.
+        """
+        stats = self.batchStats
+        stats["statements"] += 1
+        stats["rows"] += rowCount
+        stats["bytes"] += byteCount
+        stats["maxRows"] = max(stats["maxRows"], rowCount)
+        stats["maxBytes"] = max(stats["maxBytes"], byteCount)
+        
+        
+    def _logBatchStats(self):
+        """
+        Logs the statistics in self.batchStats.
+        """
+        stats = self.batchStats
+        count = stats["statements"]
+        if (not count):
+            return
+        if (not stats["bytes"]): #statement sizes aren't known for executemany()
+            LOGGER.info("Batches for %s: %i statements of %i rows on average, at most %i rows",
+                self.tableName, count, stats["rows"] // count, stats["maxRows"])
+            return
+        LOGGER.info("Batches for %s: %i statements of %i rows and %i bytes on average, at most %i rows and %i bytes",
+            self.tableName, count, stats["rows"] // count, stats["bytes"] // count, stats["maxRows"], stats["maxBytes"])
+        if self.batchMode == "bytes":
+            LOGGER.info("Batch size for %s grew %i times and shrank %i times, ending at %i bytes",
+                self.tableName, stats["grown"], stats["shrunk"], self.batchBytes)
+            
+            
+    def _pipelined(self, statements):
+        """
+        A generator which yields the items of the generator statements, running that generator in
+        a producer thread which stays at most self.pipelineDepth items ahead.
+        
+        Adds the time the producer spends blocked on a full queue ("produceWait") and the time
+        the consumer spends blocked on an empty one ("consumeWait") to self.stageTimes.
+        """
+        itemQueue = Queue.Queue(maxsize=self.pipelineDepth)
+        stopEvent = threading.Event()
+        self.stageTimes["produceWait"] = 0.0
+        self.stageTimes["consumeWait"] = 0.0
+        
+        def produce():
+            #Each item is a (isFinished, value) tuple; the last value is None, or the exception that stopped the producer
+            item = None
             try:
-                cur.execute(exStr)
-            except MySQLdb.Warning, e:
-                LOGGER.warning(str(e))
-            except MySQLdb.IntegrityError, e:
-            #This is likely a primary key constraint violation; should only be hit if skipKeyViolators is False
-                LOGGER.error("Error %d: %s", e.args[0], e.args[1])
-            self.lastRecordIngested = self.parser.latestRecordNum
-            recCheck = self._checkProgress()
-            if recCheck:
-                LOGGER.info("...at record %i...", recCheck)
-
-        conn.close()
+                for aStatement in statements:
+                    item = (False, aStatement)
+                    t = time.time()
+                    while not stopEvent.is_set():
+                        try:
+                            itemQueue.put(item, timeout=1)
+                            break
+                        except Queue.Full:
+                            pass
+                    self.stageTimes["produceWait"] += time.time() - t
+                    if stopEvent.is_set():
+                        return
+                item = (True, None)
+            except Exception, e:
+                item = (True, e)
+            itemQueue.put(item)
+        
+        producer = threading.Thread(target=produce, name="%s producer" % self.tableName)
+        producer.daemon = True
+        producer.start()
+        try:
+            while (True):
+                t = time.time()
+                isFinished, value = itemQueue.get()
+                self.stageTimes["consumeWait"] += time.time() - t
+                if isFinished:
+                    if value:
+                        raise value
+                    break
+                yield value
+        finally:
+            #If the consumer stopped early, unblock the producer so it can exit
+            stopEvent.set()
+            while producer.is_alive():
+                try:
+                    itemQueue.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+            producer.join()
+            
+            
+    def _addStageTime(self, stage, seconds, rows=0, byteCount=0):
+        """
+        Adds seconds to stage's entry in self.stageTimes, and if profiling, adds them along with
+        rows and byteCount to self.profiler. The parser adds the stages which make up "parse" itself.
+        """
+        self.stageTimes[stage] += seconds
+        if self.profiler and (stage in EPFProfiler.STAGES):
+            self.profiler.add(stage, seconds, rows, byteCount)
+            
+            
+    def writeProfile(self):
+        """
+        Writes the report of self.profiler (see EPFProfiler.Profiler.report) as JSON to
+        <profileDir>/<the file's directory name>/<file name>.json, and returns its path.
+        """
+        dirName = os.path.basename(os.path.dirname(os.path.abspath(self.filePath)))
+        profilePath = os.path.join(self.profileDir, dirName, self.fileName + ".json")
+        self.profiler.write(profilePath,
+            records=max(self.lastRecordIngested, 0),
+            exportMode=self.parser.exportMode,
+            engine=self.engine,
+            readMode=self.parser.readMode,
+            fileSize=self.fileSize,
+            didAbort=self.didAbort)
+        return profilePath
+        
+        
+    def _logStageTimes(self):
+        """
+        Logs the seconds spent in each stage of the last _insertRecords, slowest first.
+        """
+        stages = sorted(self.stageTimes.items(), key=lambda anItem: anItem[1], reverse=True)
+        LOGGER.info("Stage times for %s: %s", self.tableName,
+            ", ".join(["%s %.2fs" % aStage for aStage in stages]))
+            
+            
+    def _loadData(self, connection, tableName, isIncremental=False, skipKeyViolators=False):
+        """
+        Writes the parser's remaining records to tableName using LOAD DATA LOCAL INFILE,
+        one temporary file of about self.loadChunkSize bytes at a time.
+        
+        If the delimiters allow it (and the file is neither compressed nor being sorted), the chunks
+        are copied straight from the EPF file without being parsed; otherwise they are written from the parser's records. Either way, the
+        statement's SET clause gives the same NULL and date handling as the parser and INSERT path.
+        
+        Returns False if LOAD DATA LOCAL INFILE is refused, leaving the parser positioned at
+        the first record which wasn't loaded; otherwise returns True.
+        """
+        useRawFile = ((self.parser.fieldDelim not in self.parser.recordDelim) and not self.isSorting
+            and not self.parser.compression)
+        fieldCount = (len(self.parser.dataTypes) if useRawFile else len(self.parser.columnNames))
+        exStr = self._loadDataStatement(connection, tableName, fieldCount,
+            isIncremental=isIncremental, skipKeyViolators=skipKeyViolators)
+        fd, tmpPath = tempfile.mkstemp(prefix="%s_" % tableName)
+        os.close(fd)
+        rawFile = (open(self.filePath, mode="rb") if useRawFile else None)
+        try:
+            while (True):
+                chunkStart = (self.parser.seekPos, self.parser.latestRecordNum)
+                if useRawFile:
+                    recordCount = self._writeRawChunk(rawFile, tmpPath)
+                else:
+                    recordCount = self._writeRecordChunk(tmpPath)
+                if (not recordCount):
+                    break
+                
+                cur = connection.cursor()
+                t = time.time()
+                try:
+                    cur.execute(exStr, (tmpPath, self.parser.fieldDelim, self.parser.recordDelim))
+                except MySQLdb.Warning, e:
+                    LOGGER.warning(str(e))
+                except MySQLdb.Error, e:
+                    if e.args[0] not in LOAD_DATA_REFUSED_ERRORS:
+                        raise
+                    LOGGER.warning("LOAD DATA LOCAL INFILE was refused (%s); using INSERT statements instead", e.args[1])
+                    if self.isSorting:
+                        self.parser.rewind() #refusals happen on the first chunk, before anything is loaded
+                    else:
+                        self.parser.seekPos, self.parser.latestRecordNum = chunkStart
+                    return False
+                if self.profiler:
+                    self.profiler.add("execute", time.time() - t, recordCount, os.path.getsize(tmpPath))
+                self._batchWritten(connection)
+        finally:
+            if rawFile:
+                rawFile.close()
+            os.remove(tmpPath)
+        return True
+        
+        
+    def _loadDataStatement(self, connection, tableName, fieldCount, isIncremental=False, skipKeyViolators=False):
+        """
+        Returns the LOAD DATA LOCAL INFILE statement for loading a file with fieldCount fields
+        per record into tableName. The statement has placeholders for the file path,
+        field delimiter and record delimiter.
+        """
+        #As with LOCAL loads in general, duplicate keys are skipped (with a warning) unless replacing
+        modifier = ("REPLACE" if isIncremental else ("IGNORE" if skipKeyViolators else ""))
+        varNames = ["@f%i" % j for j in range(fieldCount)]
+        assignments = []
+        for j in range(len(self.parser.columnNames)):
+            var = varNames[j]
+            val = var
+            if j in self.parser.dateColumns:
+                #the same massaging as Parser.nextRecord: '2009 06 21' -> '2009-06-21', '2009' -> '2009-01-01'
+                val = ("IF(TRIM(%s) REGEXP '^[0-9]{4}$', CONCAT(TRIM(%s), '-01-01'), LEFT(REPLACE(TRIM(%s), ' ', '-'), 19))" %
+                    (var, var, var))
+            #empty fields, and the strings the INSERT path unquotes, become NULL
+            assignments.append("%s = IF(BINARY %s IN ('', 'NULL', 'null'), NULL, %s)" %
+                (self.parser.columnNames[j], var, val))
+        exStr = """LOAD DATA LOCAL INFILE %%s %s INTO TABLE %s CHARACTER SET %s
+            FIELDS TERMINATED BY %%s ESCAPED BY '' LINES TERMINATED BY %%s
+            (%s) SET %s""" % (modifier, tableName, connection.character_set_name(),
+                ", ".join(varNames), ", ".join(assignments))
+        return exStr
+        
+        
+    def _writeRawChunk(self, rawFile, tmpPath):
+        """
+        Copies the next whole records, about self.loadChunkSize bytes' worth, from rawFile
+        (the EPF file, opened in binary mode) to tmpPath, and advances the parser past them.
+        
+        Returns the number of records copied.
+        """
+        delim = self.parser.recordDelim
+        start = max(self.parser.seekPos, self.parser.dataStartPos)
+        end = self.parser.dataEndPos
+        if (start >= end):
+            return 0
+        t = time.time()
+        rawFile.seek(start)
+        chunk = rawFile.read(min(self.loadChunkSize, end - start))
+        if (start + len(chunk) < end):
+            #trim the chunk to the last full record, reading further if it doesn't contain one
+            ix = chunk.rfind(delim)
+            while (ix == -1) and (start + len(chunk) < end):
+                chunk += rawFile.read(min(self.loadChunkSize, end - start - len(chunk)))
+                ix = chunk.rfind(delim)
+            if (ix != -1):
+                chunk = chunk[:ix + len(delim)]
+        recordCount = chunk.count(delim) + (0 if chunk.endswith(delim) else 1)
+        if self.profiler:
+            self.profiler.add("read", time.time() - t, recordCount, len(chunk))
+        with open(tmpPath, mode="wb") as f:
+            f.write(chunk)
+        self.parser.seekPos = start + len(chunk)
+        self.parser.latestRecordNum += recordCount
+        return recordCount
+        
+        
+    def _writeRecordChunk(self, tmpPath):
+        """
+        Writes the parser's next records, about self.loadChunkSize bytes' worth, to tmpPath
+        using the file's own delimiters.
+        
+        Returns the number of records written.
+        """
+        recordCount = 0
+        chunkSize = 0
+        fieldDelim = self.parser.fieldDelim
+        recordDelim = self.parser.recordDelim
+        with open(tmpPath, mode="wb") as f:
+            while (chunkSize < self.loadChunkSize):
+                records = self.parser.nextRecords(maxNum=1000)
+                if (not records):
+                    break
+                t = time.time()
+                #Re-encode as latin-1, reversing the parser's decoding
+                data = "".join([fieldDelim.join(aRecord) + recordDelim for aRecord in records]).encode('latin-1')
+                f.write(data)
+                if self.profiler:
+                    self.profiler.add("build", time.time() - t, len(records), len(data))
+                chunkSize += len(data)
+                recordCount += len(records)
+        return recordCount
+        
+        
+    def _batchWritten(self, connection, recordNum=None, pos=None):
+        """
+        Called after each batch of records is written to the db; updates lastRecordIngested,
+        logs progress, and checkpoints if self.checkpointGap has elapsed since the last checkpoint.
+        
+        recordNum and pos are the record number and file position following the batch;
+        they default to the parser's, which may be further ahead if statements are pipelined.
+        """
+        recordNum = (self.parser.latestRecordNum if recordNum is None else recordNum)
+        self.lastRecordIngested = recordNum
+        recCheck = self._checkProgress()
+        if recCheck:
+            LOGGER.info("...at record %i...", recCheck)
+        if datetime.datetime.now() - self.lastCheckpointTime >= self.checkpointGap:
+            self._checkpoint(connection, recordNum=recordNum, pos=pos)
+        
+        
+    def _checkpoint(self, connection, recordNum=None, pos=None):
+        """
+        Commits the rows written so far on connection, then records the record number and
+        file position following them (by default, the parser's current ones) as the point
+        from which an interrupted ingest can resume.
+        """
+        connection.commit()
+        self.checkpointRecord = (self.parser.latestRecordNum if recordNum is None else recordNum)
+        self.checkpointPos = (self.parser.seekPos if pos is None else pos)
+        if self.isSorting:
+            #the rows written so far aren't the first records of the file, so there's nothing to resume from
+            self.checkpointRecord = 0
+            self.checkpointPos = None
+        self.lastCheckpointTime = datetime.datetime.now()
+        self.updateStatusDict()
+        if self.progressCallback:
+            self.progressCallback(self.statusDict)
 
         
     def _checkProgress(self, recordGap=5000, timeGap=datetime.timedelta(0, 120, 0)):
@@ -413,10 +1745,11 @@ class Ingester(object):
 
     def _dropTable(self, tableName):
         """A convenience method that just connects, drops tableName if it exists, and disconnects"""
-        conn = self.connect()
-        cur = conn.cursor()
-        cur.execute("""DROP TABLE IF EXISTS %s""" % tableName)
-        conn.close()
+        with DDLSlot(tableName):
+            conn = self.connect()
+            cur = conn.cursor()
+            cur.execute("""DROP TABLE IF EXISTS %s""" % tableName)
+            conn.close()
         
 
     def _renameAndDrop(self, sourceTable, targetTable):
@@ -424,24 +1757,26 @@ class Ingester(object):
         Temporarily rename targetTable, then rename sourceTable to targetTable.
         If this succeeds, drop the renamed targetTable; otherwise revert it and drop sourceTable.
         """
-        conn = self.connect()
-        cur = conn.cursor()
-        #first, rename the existing "real" table, so we can restore it if something goes wrong
-        targetOld = targetTable + "_old"
-        cur.execute("""DROP TABLE IF EXISTS %s""" % targetOld)
-        if (self.tableExists(targetTable, connection=conn)):
-            cur.execute("""ALTER TABLE %s RENAME %s""" % (targetTable, targetOld))
-        #now rename the new table to replace the old table
-        try:
-            cur.execute("""ALTER TABLE %s RENAME %s""" % (sourceTable, targetTable))
-        except MySQLdb.Error, e:
-            LOGGER.error("Error %d: %s", e.args[0], e.args[1])
-            LOGGER.error("Could not rename tmp table; reverting to original table (if it exists).")
-            if (self.tableExists(targetOld, connection=conn)):
-                cur.execute("""ALTER TABLE %s RENAME %s""" % (targetOld, targetTable))
-        #Drop sourceTable so it's not hanging around
-        #drop the old table
-        cur.execute("""DROP TABLE IF EXISTS %s""" % targetOld)
+        with DDLSlot(targetTable):
+            conn = self.connect()
+            cur = conn.cursor()
+            #first, rename the existing "real" table, so we can restore it if something goes wrong
+            targetOld = targetTable + "_old"
+            cur.execute("""DROP TABLE IF EXISTS %s""" % targetOld)
+            if (self.tableExists(targetTable, connection=conn)):
+                cur.execute("""ALTER TABLE %s RENAME %s""" % (targetTable, targetOld))
+            #now rename the new table to replace the old table
+            try:
+                cur.execute("""ALTER TABLE %s RENAME %s""" % (sourceTable, targetTable))
+            except MySQLdb.Error, e:
+                LOGGER.error("Error %d: %s", e.args[0], e.args[1])
+                LOGGER.error("Could not rename tmp table; reverting to original table (if it exists).")
+                if (self.tableExists(targetOld, connection=conn)):
+                    cur.execute("""ALTER TABLE %s RENAME %s""" % (targetOld, targetTable))
+            #Drop sourceTable so it's not hanging around
+            #drop the old table
+            cur.execute("""DROP TABLE IF EXISTS %s""" % targetOld)
+            conn.close()
         
         
     def _createUnionTable(self):
@@ -449,12 +1784,57 @@ class Ingester(object):
         After incremental ingest data has been written to self.incTableName, union the pruned
         original table and the new table into a tmp table
         """
-        conn = self.connect()
-        cur = conn.cursor()
-        cur.execute("""DROP TABLE IF EXISTS %s""" % self.unionTableName)
-        exStr = """CREATE TABLE %s %s""" % (self.unionTableName, self._incrementalUnionString())
-        cur.execute(exStr)
-        conn.close()
+        with DDLSlot(self.unionTableName):
+            conn = self.connect()
+            cur = conn.cursor()
+            cur.execute("""DROP TABLE IF EXISTS %s""" % self.unionTableName)
+            exStr = """CREATE TABLE %s %s""" % (self.unionTableName, self._incrementalUnionString())
+            cur.execute(exStr)
+            conn.close()
+        
+
+    def _createMergedTable(self):
+        """
+        The "antijoin" counterpart of _createUnionTable: creates self.unionTableName with the same
+        columns and primary key as self.incTableName, then fills it with
+        1. the rows of the original table which have no match in self.incTableName, or whose
+           export_date is later than their match's, and
+        2. the rows of self.incTableName which have no such later match in the original table.
+        Each step is a LEFT JOIN on the primary key, keeping the rows with no match.
+        """
+        with DDLSlot(self.unionTableName):
+            conn = self.connect()
+            cur = conn.cursor()
+            cur.execute("""DROP TABLE IF EXISTS %s""" % self.unionTableName)
+            cur.execute("""CREATE TABLE %s LIKE %s""" % (self.unionTableName, self.incTableName))
+            colNames = self.parser.columnNames
+            pCols = self.parser.primaryKey
+        
+            exStr = """INSERT INTO %s (%s) SELECT %s FROM %s LEFT JOIN %s ON %s
+                WHERE %s.%s IS NULL OR %s.export_date > %s.export_date""" % (
+                self.unionTableName, ", ".join(colNames),
+                ", ".join(["%s.%s" % (self.tableName, aCol) for aCol in colNames]),
+                self.tableName, self.incTableName, self._primaryKeyJoin(self.tableName, self.incTableName),
+                self.incTableName, pCols[0], self.tableName, self.incTableName)
+            cur.execute(exStr)
+        
+            exStr = """INSERT INTO %s (%s) SELECT %s FROM %s LEFT JOIN %s ON %s
+                AND %s.export_date > %s.export_date WHERE %s.%s IS NULL""" % (
+                self.unionTableName, ", ".join(colNames),
+                ", ".join(["%s.%s" % (self.incTableName, aCol) for aCol in colNames]),
+                self.incTableName, self.tableName, self._primaryKeyJoin(self.incTableName, self.tableName),
+                self.tableName, self.incTableName, self.tableName, pCols[0])
+            cur.execute(exStr)
+            conn.commit()
+            conn.close()
+        
+        
+    def _primaryKeyJoin(self, leftTable, rightTable):
+        """
+        Returns the join condition matching the primary key columns of leftTable and rightTable.
+        """
+        substrings = ["%s.%s=%s.%s" % (leftTable, aCol, rightTable, aCol) for aCol in self.parser.primaryKey]
+        return " AND ".join(substrings)
         
 
     def _incrementalWhereClause(self):
@@ -490,3 +1870,16 @@ class Ingester(object):
         selectString = self._incrementalSelectString()
         unionString = "IGNORE SELECT * FROM %s UNION ALL %s" % (self.incTableName, selectString)
         return unionString
+
+
+def _populateRange(filePath, ingesterArgs, tableName, startPos, endPos, rangeName, skipKeyViolators=False):
+    """
+    Worker entry point for split ingests (see Ingester._populateTableSplit).
+    
+    Creates an Ingester for filePath with ingesterArgs and populates tableName with the
+    records between startPos and endPos. Returns a tuple of the number of records written and,
+    if profiling, the stage totals of the Ingester's profiler (or else None).
+    """
+    ing = Ingester(filePath, **ingesterArgs)
+    recordCount = ing._populateRange(tableName, startPos, endPos, rangeName, skipKeyViolators=skipKeyViolators)
+    return (recordCount, (ing.profiler.stages if ing.profiler else None))
@@ -46,10 +46,54 @@
 
 import os
 import re
+import bz2
+import gzip
+import json
+import mmap
+import time
+import heapq
+import struct
+import bisect
+import marshal
+import cPickle
+import decimal
+import hashlib
+import datetime
+import tempfile
 import logging
 
 LOGGER = logging.getLogger()
 
+YEAR_PATTERN = re.compile(r"^\d\d\d\d$") #date values which are only a year
+
+#File name extensions of the compressed EPF files a Parser can read directly, and the classes which read them
+COMPRESSED_FILE_TYPES = {".gz":gzip.GzipFile, ".bz2":bz2.BZ2File}
+
+
+def compressionOf(filePath):
+    """
+    Returns the extension (e.g. ".gz") of filePath if it's a compressed EPF file, otherwise None.
+    """
+    ext = os.path.splitext(filePath)[1].lower()
+    return (ext if ext in COMPRESSED_FILE_TYPES else None)
+
+
+def _toDate(val):
+    """
+    Converts a massaged date value such as '2009-06-21' to a datetime.date.
+    """
+    return datetime.date(int(val[0:4]), int(val[5:7]), int(val[8:10]))
+
+
+def _toDatetime(val):
+    """
+    Converts a massaged date value such as '2009-06-21' or '2005-09-06-00:00:00' to a datetime.datetime.
+    """
+    if (len(val) <= 10):
+        return datetime.datetime(int(val[0:4]), int(val[5:7]), int(val[8:10]))
+    return datetime.datetime(int(val[0:4]), int(val[5:7]), int(val[8:10]),
+        int(val[11:13]), int(val[14:16]), int(val[17:19]))
+
 
 class SubstringNotFoundException(Exception):
     """
@@ -57,6 +101,386 @@ class SubstringNotFoundException(Exception):
     """
     
 
+class RecordIndex(object):
+    """
+    An on-disk index of the seek position of every intervalth record in an EPF file,
+    which lets a Parser seek to a record without reading every record before it.
+    
+    The index is stored as json in indexDir. It records the size and modification time of
+    the EPF file it was built from, and is discarded when loaded if either has changed.
+    Since a Parser only adds entries as it reads, the index may cover just the first part
+    of the file; seeks beyond the indexed part read forward from the last entry.
+    """
+    def __init__(self, filePath, indexDir, interval=10000, recordDelim='\x02\n', fieldDelim='\x01', flushInterval=100):
+        self.filePath = os.path.abspath(filePath)
+        pathHash = hashlib.md5(self.filePath).hexdigest()[:12] #distinguishes same-named files in different directories
+        self.indexPath = os.path.join(indexDir, "%s_%s.json" % (os.path.basename(filePath), pathHash))
+        self.interval = interval
+        self.flushInterval = flushInterval #number of new entries after which the index is re-saved
+        fileStat = os.stat(self.filePath)
+        self.validityKey = {"filePath":self.filePath,
+            "fileSize":fileStat.st_size,
+            "mtime":fileStat.st_mtime,
+            "interval":interval,
+            "recordDelim":recordDelim,
+            "fieldDelim":fieldDelim}
+        self.offsets = [] #offsets[k] is the seek position of the beginning of record k*interval
+        self.isComplete = False
+        self.unsavedCount = 0
+        self.load()
+        
+        
+    def load(self):
+        """
+        Reads the index from disk, if it exists and is valid for the EPF file.
+        """
+        try:
+            with open(self.indexPath) as f:
+                indexDict = json.load(f)
+        except (IOError, ValueError):
+            return
+        if indexDict.get('validityKey') != self.validityKey:
+            LOGGER.info("Discarding stale record index %s", self.indexPath)
+            return
+        self.offsets = indexDict['offsets']
+        self.isComplete = indexDict['isComplete']
+        
+        
+    def save(self):
+        """
+        Writes the index to disk if it has changed since it was last saved.
+        
+        The index is written to a temporary file which is then renamed, so a reader
+        never sees a partially-written index.
+        """
+        if not self.unsavedCount:
+            return
+        indexDir = os.path.dirname(self.indexPath)
+        if indexDir and not os.path.exists(indexDir):
+            os.makedirs(indexDir)
+        indexDict = dict(validityKey=self.validityKey, offsets=self.offsets, isComplete=self.isComplete)
+        tmpPath = self.indexPath + ".tmp"
+        with open(tmpPath, mode='w') as f:
+            json.dump(indexDict, f)
+        os.rename(tmpPath, self.indexPath)
+        self.unsavedCount = 0
+        
+        
+    def addOffset(self, recordNum, pos):
+        """
+        Adds pos as the seek position of record number recordNum (a multiple of self.interval)
+        if it is the next entry in the index; other positions are ignored.
+        
+        Saves the index every flushInterval entries.
+        """
+        if (recordNum // self.interval == len(self.offsets)):
+            self.offsets.append(pos)
+            self.unsavedCount += 1
+            if self.unsavedCount >= self.flushInterval:
+                self.save()
+                
+                
+    def markComplete(self, recordCount):
+        """
+        Called when a Parser reaches the end of the file after recordCount records.
+        
+        If every entry up to that point is present, marks the index as covering the whole file.
+        Saves the index in any case.
+        """
+        if not self.isComplete and (len(self.offsets) * self.interval >= recordCount):
+            self.isComplete = True
+            self.unsavedCount += 1
+        self.save()
+        
+        
+    def nearestOffset(self, recordNum):
+        """
+        Returns a tuple of (record number, seek position) for the indexed record
+        closest to, but not after, recordNum.
+        """
+        k = min(recordNum // self.interval, len(self.offsets) - 1)
+        if k < 0:
+            return (0, 0)
+        return (k * self.interval, self.offsets[k])
+    
+
+class ParseCache(object):
+    """
+    An on-disk cache of the split records of an EPF file, which lets later Parsers of the
+    file return its records without reading, decoding and splitting it again.
+    
+    An entry is written by a Parser which reads the whole file in order from its first record.
+    The records (lists of fields, before any fixups) are marshalled in blocks of blockRecords,
+    each preceded by its length, together with the file position following each record, so that
+    a Parser reading from the cache reports the same seekPos as one reading the file. A footer
+    indexes the blocks, and holds the record count. The entry is written under a temporary name,
+    which is renamed once it is complete.
+    
+    Entries are kept in cacheDir, named after the EPF file's path. Each records the size and
+    modification time of the file it was built from (and the delimiters it was split with),
+    and is deleted when opened if any have changed. An entry's modification time is updated
+    whenever it is opened, and when an entry is added, the least recently used ones are deleted
+    until the cache is no larger than maxBytes.
+    """
+    version = 1
+    suffix = ".epfcache"
+    lengthFormat = "<Q"
+    blockRecords = 1000
+    orphanAge = 3600 #seconds after which an abandoned temporary entry is deleted
+    
+    def __init__(self, filePath, cacheDir, maxBytes=10737418240, recordDelim='\x02\n', fieldDelim='\x01'):
+        self.filePath = os.path.abspath(filePath)
+        pathHash = hashlib.md5(self.filePath).hexdigest()[:12] #distinguishes same-named files in different directories
+        self.cacheDir = cacheDir
+        self.cachePath = os.path.join(cacheDir, "%s_%s%s" % (os.path.basename(filePath), pathHash, ParseCache.suffix))
+        self.maxBytes = maxBytes
+        fileStat = os.stat(self.filePath)
+        self.validityKey = {"filePath":self.filePath,
+            "fileSize":fileStat.st_size,
+            "mtime":fileStat.st_mtime,
+            "recordDelim":recordDelim,
+            "fieldDelim":fieldDelim,
+            "version":ParseCache.version,
+            "marshalVersion":marshal.version}
+        self.isComplete = False
+        self.blockIndex = [] #a (first record number, file position before it, offset in the entry) tuple for each block
+        self.blockFirsts = [] #the first record number of each block, for bisecting
+        self.blockStarts = [] #the file position before each block, for bisecting
+        self.recordCount = None
+        self.dataEndPos = None
+        self.recordsExpected = None #as given by the file's recordsWritten trailer
+        self.cacheFile = None
+        self.cursor = None #the number of the next record to be read from the entry, if reading it
+        self._block = None #the number, records and positions of the block most recently read
+        self._writer = None #the temporary file of the entry being written, if writing one
+        self._pending = ([], []) #the records of the block being written, and the positions following them
+        self.writtenCount = 0
+        self.lastPos = None
+        self.load()
+        
+        
+    def load(self):
+        """
+        Opens the entry for reading, if it exists and is valid for the EPF file; deletes it if it's stale.
+        """
+        try:
+            cacheFile = open(self.cachePath, mode="rb")
+        except IOError:
+            return
+        try:
+            validityKey = self._readBlock(cacheFile, 0)
+            if validityKey != self.validityKey:
+                LOGGER.info("Discarding stale parse cache %s", self.cachePath)
+                cacheFile.close()
+                self._remove(self.cachePath)
+                return
+            lengthSize = struct.calcsize(ParseCache.lengthFormat)
+            cacheFile.seek(-lengthSize, os.SEEK_END)
+            footerOffset = struct.unpack(ParseCache.lengthFormat, cacheFile.read(lengthSize))[0]
+            self.blockIndex, self.recordCount, self.dataEndPos, self.recordsExpected = self._readBlock(cacheFile, footerOffset)
+        except (IOError, EOFError, ValueError, TypeError, struct.error):
+            LOGGER.warning("Discarding unreadable parse cache %s", self.cachePath)
+            cacheFile.close()
+            self._remove(self.cachePath)
+            return
+        self.blockFirsts = [anEntry[0] for anEntry in self.blockIndex]
+        self.blockStarts = [anEntry[1] for anEntry in self.blockIndex]
+        self.cacheFile = cacheFile
+        self.isComplete = True
+        os.utime(self.cachePath, None) #mark it as recently used
+        
+        
+    def _readBlock(self, cacheFile, offset):
+        cacheFile.seek(offset)
+        lengthSize = struct.calcsize(ParseCache.lengthFormat)
+        length = struct.unpack(ParseCache.lengthFormat, cacheFile.read(lengthSize))[0]
+        return marshal.loads(cacheFile.read(length))
+        
+        
+    def seekRecord(self, recordNum):
+        """
+        Positions the entry to read record recordNum next (or to its end, if recordNum is past it),
+        and returns the file position before that record.
+        """
+        recordNum = max(0, min(recordNum, self.recordCount))
+        self.cursor = recordNum
+        if recordNum == self.recordCount:
+            return self.dataEndPos
+        b = bisect.bisect_right(self.blockFirsts, recordNum) - 1
+        firstRecord, startPos = self.blockIndex[b][:2]
+        if recordNum == firstRecord:
+            return startPos
+        return self._loadBlock(b)[2][recordNum - firstRecord - 1]
+        
+        
+    def recordAt(self, pos, dataStartPos):
+        """
+        Returns the number of the record which begins at file position pos (for which
+        any position up to dataStartPos counts as the first record), or None if none does.
+        """
+        if pos <= dataStartPos:
+            return 0
+        if pos == self.dataEndPos:
+            return self.recordCount
+        b = bisect.bisect_right(self.blockStarts, pos) - 1
+        if b < 0:
+            return None
+        firstRecord, startPos = self.blockIndex[b][:2]
+        if pos == startPos:
+            return firstRecord
+        ends = self._loadBlock(b)[2]
+        try:
+            return firstRecord + ends.index(pos) + 1
+        except ValueError:
+            return None
+        
+        
+    def nextRecord(self):
+        """
+        Returns a tuple of the next record's fields and the file position following it,
+        or None if the entry has no more records.
+        """
+        recordNum = self.cursor
+        if recordNum >= self.recordCount:
+            return None
+        block = self._block
+        if (block is None) or not (block[0] <= recordNum < block[0] + len(block[1])):
+            block = self._loadBlock(bisect.bisect_right(self.blockFirsts, recordNum) - 1)
+        j = recordNum - block[0]
+        self.cursor = recordNum + 1
+        return (block[1][j], block[2][j])
+        
+        
+    def _loadBlock(self, b):
+        """
+        Reads block number b, and returns it as a tuple of (first record number, records, positions).
+        """
+        if (self._block is None) or (self._block[3] != b):
+            firstRecord, startPos, offset = self.blockIndex[b]
+            records, ends = self._readBlock(self.cacheFile, offset)
+            self._block = (firstRecord, records, ends, b)
+        return self._block
+        
+        
+    def startWriting(self, startPos):
+        """
+        Begins a new entry, whose first record follows file position startPos.
+        """
+        if not os.path.exists(self.cacheDir):
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError:
+                pass #another process created it
+        #several parsers may be writing the same entry at once, so each uses its own temporary file
+        tmpPath = "%s.%i.%i.tmp" % (self.cachePath, os.getpid(), id(self))
+        self._writer = open(tmpPath, mode="wb")
+        self._writeBlock(self.validityKey)
+        self.blockIndex = []
+        self._pending = ([], [])
+        self.writtenCount = 0
+        self.lastPos = startPos
+        
+        
+    def isWriting(self):
+        return (self._writer is not None)
+        
+        
+    def addRecord(self, rec, pos):
+        """
+        Adds the split record rec, which is followed by file position pos, to the entry being written.
+        """
+        records, ends = self._pending
+        if not records:
+            self.blockIndex.append((self.writtenCount, self.lastPos, self._writer.tell()))
+        records.append(rec)
+        ends.append(pos)
+        self.writtenCount += 1
+        self.lastPos = pos
+        if len(records) >= ParseCache.blockRecords:
+            self._writeBlock(self._pending)
+            self._pending = ([], [])
+            if self._writer.tell() > self.maxBytes:
+                LOGGER.info("Not caching %s, which is larger than the parse cache", os.path.basename(self.filePath))
+                self.abandon()
+        
+        
+    def finish(self, dataEndPos, recordsExpected):
+        """
+        Completes the entry being written, recording the file's dataEndPos and recordsExpected (see Parser),
+        moves it into place, and evicts old entries until the cache fits in maxBytes. The entry is
+        then opened, so that the parser can read from it if it goes back.
+        """
+        if self._pending[0]:
+            self._writeBlock(self._pending)
+        footerOffset = self._writer.tell()
+        self._writeBlock((self.blockIndex, self.writtenCount, dataEndPos, recordsExpected))
+        self._writer.write(struct.pack(ParseCache.lengthFormat, footerOffset))
+        tmpPath = self._writer.name
+        self._writer.close()
+        self._writer = None
+        if os.path.getsize(tmpPath) > self.maxBytes:
+            LOGGER.info("Not caching %s, which is larger than the parse cache", os.path.basename(self.filePath))
+            self._remove(tmpPath)
+            return
+        os.rename(tmpPath, self.cachePath)
+        LOGGER.info("Cached the %i parsed records of %s in %s", self.writtenCount,
+            os.path.basename(self.filePath), self.cachePath)
+        self.evict(keep=self.cachePath)
+        self.load()
+        
+        
+    def abandon(self):
+        """
+        Stops writing the entry, and deletes it.
+        """
+        if self._writer is not None:
+            tmpPath = self._writer.name
+            self._writer.close()
+            self._writer = None
+            self._remove(tmpPath)
+            
+            
+    def evict(self, keep=None):
+        """
+        Deletes the least recently used entries (other than the one at path keep) until the cache
+        is no larger than maxBytes, along with any temporary entries abandoned by interrupted parsers.
+        """
+        entries = []
+        now = time.time()
+        for aName in os.listdir(self.cacheDir):
+            aPath = os.path.join(self.cacheDir, aName)
+            try:
+                aStat = os.stat(aPath)
+            except OSError:
+                continue #deleted by another process
+            if aName.endswith(ParseCache.suffix):
+                entries.append((aStat.st_mtime, aStat.st_size, aPath))
+            elif aName.endswith(".tmp") and (now - aStat.st_mtime > ParseCache.orphanAge):
+                self._remove(aPath)
+        entries.sort()
+        totalSize = sum([anEntry[1] for anEntry in entries])
+        for (mtime, size, aPath) in entries:
+            if totalSize <= self.maxBytes:
+                break
+            if aPath != keep:
+                LOGGER.info("Evicting %s from the parse cache", os.path.basename(aPath))
+                self._remove(aPath)
+                totalSize -= size
+        
+        
+    def _writeBlock(self, obj):
+        data = marshal.dumps(obj)
+        self._writer.write(struct.pack(ParseCache.lengthFormat, len(data)))
+        self._writer.write(data)
+        
+        
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass #already gone
+    
+
 class Parser(object):
     """
     Parses an EPF file.
@@ -68,6 +492,36 @@ class Parser(object):
     
     typeMap is a dictionary mapping datatype strings in the file to corresponding
     types for the database being used. The default map is for MySQL.
+    
+    readMode selects how rows are pulled from the file. "readline" (the default) reads one
+    physical line at a time; "block" reads blockSize bytes at a time and splits directly on
+    recordDelim, which is considerably faster on large files and yields identical rows. "mmap" is
+    like "block", but finds the delimiters in a memory-mapped window of blockSize bytes (or more,
+    for longer records) which moves along the file, so that rows are sliced out of the file's pages
+    without copying them into a buffer first, and memory use stays flat however large the file.
+    Compressed files can't be mapped, so they're read in block mode instead.
+    
+    If indexDir is specified, the Parser maintains a RecordIndex for the file there,
+    adding to it as records are read, and uses it to make seekToRecord fast.
+    
+    Files ending in .gz or .bz2 are decompressed as they're read (but not tar archives, which
+    contain several files). Seek positions are then offsets into the decompressed data; seeking
+    backwards rewinds the stream, and seeking forwards decompresses up to the new position. Since a
+    stream can't be read from the end, the recordsWritten trailer is read when the parser reaches it,
+    or by a separate pass through the file if recordsExpected or dataEndPos is needed before then.
+    
+    If typed is True, fields are returned as Python values rather than strings: ints for
+    integer columns, Decimals for DECIMAL columns, dates and datetimes for DATE and DATETIME
+    columns, and None for empty fields. The converter for each column is chosen from the
+    dbTypes header when the file is opened.
+    
+    If the profiler attribute is set to an EPFProfiler.Profiler, the time spent reading, decoding,
+    splitting and fixing up records (but not the header) is added to it.
+    
+    If cacheDir is specified, the split records are kept in a ParseCache there, of at most cacheBytes.
+    A parser which reads the whole file in order writes its entry, and later parsers of the unchanged
+    file read their records from the entry instead (from any record, or any position at which one begins),
+    which skips reading, decoding and splitting the rows, and for compressed files, decompressing them.
     """
     commentChar = "#"
     recordDelim = "\x02\n"
@@ -76,10 +530,17 @@ class Parser(object):
     dataTypesTag = "dbTypes:"
     exportModeTag = "exportMode:"
     recordCountTag = "recordsWritten:"
+    readModes = ("readline", "block", "mmap")
+    dateCacheSize = 100000 #maximum number of massaged date values remembered by _fixupDate()
+    maxConversionWarnings = 5 #number of unconvertible values logged for each column
+    trailerSize = 40 #bytes at the end of the file which contain the recordsWritten trailer
 
-    def __init__(self, filePath, typeMap={"CLOB":"LONGTEXT"}, recordDelim='\x02\n', fieldDelim='\x01'):
+    def __init__(self, filePath, typeMap={"CLOB":"LONGTEXT"}, recordDelim='\x02\n', fieldDelim='\x01',
+            readMode="readline", blockSize=4194304, indexDir=None, indexInterval=10000, typed=False,
+            cacheDir=None, cacheBytes=10737418240):
         self.dataTypeMap = typeMap
         self.numberTypes = ["INTEGER", "INT", "BIGINT", "TINYINT"]
+        self.decimalTypes = ["DECIMAL", "NUMERIC"]
         self.dateTypes = ["DATE", "DATETIME", "TIME", "TIMESTAMP"]
         self.columnNames = []
         self.primaryKey = []
@@ -88,21 +549,63 @@ class Parser(object):
         self.dateColumns = [] #fields containing dates need special treatment; we'll cache the indexes here
         self.numberColumns = [] #numeric fields don't accept NULL; we'll cache the indexes here to use later
         self.typeMap = None
-        self.recordsExpected = 0
+        self._recordsExpected = None #see getRecordsExpected()
+        self._dataEndPos = None
         self.latestRecordNum = 0
+        self.emptyValue = "NULL" #what nextRecord returns for empty fields
+        self._dateCache = {} #maps raw date values to massaged ones; see _fixupDate()
+        self.typed = typed #if True, fields are converted to Python values; see _convertRecords()
+        if typed:
+            self.emptyValue = None
+        self.converters = () #the function converting each column's fields when typed, or None to pass them through
+        self._convertedColumns = [] #indexes of the columns which have a converter
+        self.conversionErrors = {} #maps column names to the number of their fields which couldn't be converted
         self.commentChar = Parser.commentChar
         self.recordDelim = recordDelim
         self.fieldDelim = fieldDelim
+        if readMode not in Parser.readModes:
+            raise ValueError("Unknown readMode '%s'" % readMode)
+        if readMode in ("block", "mmap") and not recordDelim.endswith("\n"):
+            #Splitting on recordDelim only matches line-based reading when every delimiter
+            #also ends a physical line, so fall back for anything else.
+            LOGGER.warning("Record delimiter %r does not end with a newline; using readline mode", recordDelim)
+            readMode = "readline"
+        self.readMode = readMode
+        self.blockSize = blockSize
+        self._buffer = "" #block mode only; raw data read from the file but not yet returned
+        self._bufferPos = 0 #index in self._buffer of the first unconsumed byte
+        self._map = None #mmap mode only; the mapped window of the file
+        self._mapStart = 0 #file position of the beginning of the window
+        self._mapPos = 0 #file position of the first byte not yet returned
+        self._fileSize = 0
+        self.recordIndex = None
+        self.endPos = None #if set, reading stops at this position; see byteRanges()
+        self.profiler = None #if set, an EPFProfiler.Profiler to which the read, decode, split and fixup stages are added
+        self._unfixedBytes = 0 #while profiling, the bytes of the rows split since the last fixup
+        self.parseCache = None #set once the header has been read; see ParseCache
+        self._cachePos = None #while reading records from the parse cache, the file position following the last one
+        if indexDir:
+            self.recordIndex = RecordIndex(filePath, indexDir, interval=indexInterval,
+                recordDelim=recordDelim, fieldDelim=fieldDelim)
         
-        self.eFile = open(filePath, mode="rU") #this will throw an exception if filePath does not exist
-        
-        #Seek to the end and parse the recordsWritten line
-        self.eFile.seek(-40, os.SEEK_END)
-        str = self.eFile.read() #reads from -40 to end of file
-        lst = str.split(self.commentChar + Parser.recordCountTag)
-        numStr = lst.pop().rpartition(self.recordDelim)[0]
-        self.recordsExpected = int(numStr)
-        self.eFile.seek(0, os.SEEK_SET) #seek back to the beginning
+        self.filePath = filePath
+        self.compression = compressionOf(filePath)
+        if self.compression:
+            if not os.path.exists(filePath):
+                raise IOError(2, "No such file or directory", filePath) #as open() would
+            self.eFile = COMPRESSED_FILE_TYPES[self.compression](filePath, mode="rb")
+            if self.readMode == "mmap":
+                LOGGER.warning("Compressed files can't be memory-mapped; using block mode for %s", os.path.basename(filePath))
+                self.readMode = "block"
+        else:
+            self.eFile = open(filePath, mode="rU") #this will throw an exception if filePath does not exist
+            self._fileSize = os.fstat(self.eFile.fileno()).st_size
+            
+            #Seek to the end and parse the recordsWritten line
+            self.eFile.seek(-Parser.trailerSize, os.SEEK_END)
+            tail = self.eFile.read() #reads from -40 to end of file
+            self._parseTrailer(tail, self.eFile.tell())
+            self.eFile.seek(0, os.SEEK_SET) #seek back to the beginning
         #Extract the column names
         line1 = self.nextRowString(ignoreComments=False)
         self.columnNames = self.splitRow(line1, requiredPrefix=self.commentChar)
@@ -135,7 +638,14 @@ class Parser(object):
         line3 = self.nextRowString(ignoreComments=False)
         self.dataTypes = self.splitRow(line3, requiredPrefix=self.commentChar+Parser.dataTypesTag)
         """
-        self.eFile.seek(0, os.SEEK_SET) #seek back to the beginning
+        #The data records begin after the last of the leading comment rows
+        self.seekPos = 0
+        while (True):
+            self.dataStartPos = self.seekPos
+            aRow = self.nextRowString(ignoreComments=False)
+            if (not aRow) or (not aRow.startswith(self.commentChar)):
+                break
+        self.seekPos = 0 #seek back to the beginning
 
         #Convert any datatypes to mapped counterparts, and cache indexes of date/time types and number types
         for j in range(len(self.dataTypes)):
@@ -149,21 +659,173 @@ class Parser(object):
         #Build a dictionary of column names to data types
         self.typeMap = dict(zip(self.columnNames, self.dataTypes))
         
+        #Choose a converter for each column's fields, for typed parsing
+        converterMap = {"DATE":_toDate, "DATETIME":_toDatetime, "TIMESTAMP":_toDatetime}
+        converters = []
+        for j in range(len(self.columnNames)):
+            dType = (self.dataTypes[j].split("(")[0].strip().upper() if j < len(self.dataTypes) else "")
+            if dType in self.numberTypes:
+                converters.append(int)
+            elif dType in self.decimalTypes:
+                converters.append(decimal.Decimal)
+            else:
+                converters.append(converterMap.get(dType)) #TIME and text columns are passed through
+        self.converters = tuple(converters)
+        self._convertedColumns = [j for j in range(len(converters)) if converters[j]]
+        
+        if cacheDir:
+            self.parseCache = ParseCache(filePath, cacheDir, maxBytes=cacheBytes,
+                recordDelim=recordDelim, fieldDelim=fieldDelim)
+            if self.parseCache.isComplete:
+                if self._recordsExpected is None:
+                    #a compressed file's trailer needn't be read
+                    self._recordsExpected = self.parseCache.recordsExpected
+                    self._dataEndPos = self.parseCache.dataEndPos
+                self.seekPos = 0 #read the records from the cache
+        
+    
+    def getRecordsExpected(self):
+        """
+        Returns the number of records in the file, according to its recordsWritten trailer.
+        
+        For a compressed file, this reads the rest of the file to find the trailer, unless
+        the parser has already reached it; see knownRecordCount().
+        """
+        if self._recordsExpected is None:
+            self._readTrailer()
+        return self._recordsExpected
+        
+    def setRecordsExpected(self, count):
+        self._recordsExpected = count
+        
+    recordsExpected = property(fget=getRecordsExpected, fset=setRecordsExpected, doc="Number of records in the file")
+    
     
+    def getDataEndPos(self):
+        """
+        Returns the position at which the data records end (where the recordsWritten trailer begins).
+        
+        As with recordsExpected, this may read the rest of a compressed file.
+        """
+        if self._dataEndPos is None:
+            self._readTrailer()
+        return self._dataEndPos
+        
+    def setDataEndPos(self, pos):
+        self._dataEndPos = pos
+        
+    dataEndPos = property(fget=getDataEndPos, fset=setDataEndPos, doc="Position where the data records end")
+    
+    
+    def trimColumns(self, columnCount):
+        """
+        Drops the columns after the first columnCount, so that the records returned only hold
+        the fields of those (e.g. when ingesting a file into a table which has fewer columns).
+        """
+        self.columnNames = self.columnNames[:columnCount]
+        self.dateColumns = [j for j in self.dateColumns if j < columnCount]
+        self.numberColumns = [j for j in self.numberColumns if j < columnCount]
+        self.converters = self.converters[:columnCount]
+        self._convertedColumns = [j for j in self._convertedColumns if j < columnCount]
+        
+        
+    def knownRecordCount(self):
+        """
+        Returns recordsExpected if it's known without reading ahead, otherwise None.
+        """
+        return self._recordsExpected
+        
+        
+    def _parseTrailer(self, tail, endPos):
+        """
+        Sets recordsExpected and dataEndPos from tail, the last part of the file, which ends at position endPos.
+        """
+        lst = tail.split(self.commentChar + Parser.recordCountTag)
+        numStr = lst.pop().rpartition(self.recordDelim)[0]
+        self._recordsExpected = int(numStr)
+        #the data records end where the recordsWritten line begins
+        self._dataEndPos = endPos - len(tail) + tail.rfind(self.commentChar + Parser.recordCountTag)
+        
+        
+    def _readTrailer(self):
+        """
+        Finds the recordsWritten trailer of a compressed file, which can't be read from the end,
+        by decompressing the whole file with a separate stream and keeping only its last trailerSize bytes.
+        """
+        LOGGER.info("Reading through %s for its record count", os.path.basename(self.filePath))
+        tail = ""
+        size = 0
+        with COMPRESSED_FILE_TYPES[self.compression](self.filePath, mode="rb") as f:
+            while (True):
+                chunk = f.read(self.blockSize)
+                if not chunk:
+                    break
+                size += len(chunk)
+                tail = (tail + chunk)[-Parser.trailerSize:]
+        self._parseTrailer(tail, size)
+        
+        
+    def _noteTrailer(self, row, pos):
+        """
+        Called with each comment row skipped while reading, and the position at which it begins;
+        if it's the recordsWritten trailer and that hasn't been read yet, sets recordsExpected and dataEndPos,
+        so that a compressed file needn't be read again for them.
+        """
+        if (self._recordsExpected is None) and row.startswith(self.commentChar + Parser.recordCountTag):
+            try:
+                self._parseTrailer(str(row), pos + len(row))
+            except ValueError:
+                pass #the trailer is incomplete; _readTrailer will find it
+        
+        
     def setSeekPos(self, pos=0):
         """
         Sets the underlying file's seek position.
         
         This is useful for resuming a partial ingest that was interrupted for some reason.
+        
+        If the parse cache is complete and a record begins at pos, the records are read from the cache.
         """
-        self.eFile.seek(pos)
+        cache = self.parseCache
+        if cache and cache.isComplete:
+            recordNum = cache.recordAt(pos, self.dataStartPos)
+            if recordNum is not None:
+                cache.seekRecord(recordNum)
+                self._cachePos = pos
+                return
+            #no record begins there, so read the file instead
+            cache.cursor = None
+            self._cachePos = None
+        if self.readMode == "mmap":
+            self._mapPos = pos #the window is moved when it's next read
+            return
+        self._buffer = ""
+        self._bufferPos = 0
+        if self.compression:
+            #decompress our way forward in large reads, rather than the file object's small ones
+            if (pos < self.eFile.tell()):
+                self.eFile.seek(0)
+            while (self.eFile.tell() < pos):
+                if not self.eFile.read(min(self.blockSize, pos - self.eFile.tell())):
+                    break
+        else:
+            self.eFile.seek(pos)
  
     
     def getSeekPos(self):
         """
         Gets the underlying file's seek position.
+        
+        In block mode this is the position of the first byte not yet returned,
+        rather than the (further advanced) position of the file object itself. Since the
+        file is opened with universal newlines, this is only exact for files without
+        carriage returns (which EPF files never contain).
         """
-        return self.eFile.tell()
+        if self._cachePos is not None:
+            return self._cachePos
+        if self.readMode == "mmap":
+            return self._mapPos
+        return self.eFile.tell() - (len(self._buffer) - self._bufferPos)
         
     seekPos = property(fget=getSeekPos, fset=setSeekPos, doc="Seek position of the underlying file")
     
@@ -174,15 +836,62 @@ class Parser(object):
         
         Seeks to the beginning of the file if recordNum <=0,
         or the end if it's greater than the number of records.
+        
+        If there is a record index, seeks directly to the nearest indexed record first.
+        If the records are being read from the parse cache, seeks directly to the record.
         """
         self.seekPos = 0
         self.latestRecordNum = 0
         if (recordNum <= 0):
             return
-        for j in range(recordNum):
+        if self._cachePos is not None:
+            self._cachePos = self.parseCache.seekRecord(recordNum)
+            self.latestRecordNum = self.parseCache.cursor
+            return
+        if self.recordIndex:
+            self.latestRecordNum, self.seekPos = self.recordIndex.nearestOffset(recordNum)
+        for j in range(recordNum - self.latestRecordNum):
             self.advanceToNextRecord()
+        if self.recordIndex:
+            self.recordIndex.save() #keep any entries added while advancing
 
             
+    def byteRanges(self, count):
+        """
+        Divides the data records into at most count byte ranges of roughly equal size,
+        each beginning at the start of a record, and returns them as a list of
+        (start position, end position) tuples.
+        
+        A range can be read on its own by setting seekPos to its start and endPos to its end.
+        
+        A compressed file can't be divided without decompressing it, so it's returned as a single range.
+        """
+        if self.compression:
+            return [(self.dataStartPos, self.dataEndPos)]
+        boundaries = [self.dataStartPos]
+        with open(self.filePath, mode="rb") as rawFile:
+            for j in range(1, count):
+                pos = self.dataStartPos + (self.dataEndPos - self.dataStartPos) * j // count
+                pos = max(pos, boundaries[-1])
+                rawFile.seek(pos)
+                #move the boundary forward to just after the next record delimiter
+                chunk = ""
+                while (True):
+                    data = rawFile.read(65536)
+                    chunk += data
+                    ix = chunk.find(self.recordDelim)
+                    if (ix != -1) or (not data):
+                        break
+                    chunk = chunk[-(len(self.recordDelim) - 1):] if len(self.recordDelim) > 1 else ""
+                    pos = rawFile.tell() - len(chunk)
+                pos = (min(pos + ix + len(self.recordDelim), self.dataEndPos) if ix != -1 else self.dataEndPos)
+                if pos > boundaries[-1]:
+                    boundaries.append(pos)
+        if self.dataEndPos > boundaries[-1]:
+            boundaries.append(self.dataEndPos)
+        return zip(boundaries[:-1], boundaries[1:])
+        
+            
     def nextRowString(self, ignoreComments=True):
         """
         Returns (as a string) the next row of data (as delimited by self.recordDelim),
@@ -193,6 +902,39 @@ class Parser(object):
         Unfortunately Python doesn't allow line-based reading with user-supplied line separators
         (http://bugs.python.org/issue1152248), so we use normal line reading and then concatenate
         when we hit 0x02.
+        
+        Returns None if self.endPos is set and has been reached.
+        """
+        if (self.endPos is not None) and (self.seekPos >= self.endPos):
+            return None
+        profiler = self.profiler
+        if profiler:
+            t0 = time.time()
+        if self.readMode == "mmap":
+            rowString = self._nextMapRow(ignoreComments)[0]
+        elif self.readMode == "block":
+            rowString = self._nextBlockRow(ignoreComments)[0]
+        else:
+            rowString = self._nextLineRow(ignoreComments)
+        if (not rowString):
+            return None
+        if profiler:
+            t1 = time.time()
+            profiler.add("read", t1 - t0, 1, len(rowString))
+        #Although EPF specifies its exports as utf-8, for some reason Python sometimes complains
+        #about out-of-ASCII characters unless we reencode as latin-1.
+        #latin-1 maps each byte to a single character, so decoding the whole record
+        #at once is identical to decoding it line by line
+        rowString = unicode(rowString, 'latin-1')
+        if profiler:
+            profiler.add("decode", time.time() - t1, 1, len(rowString))
+        return rowString
+        
+        
+    def _nextLineRow(self, ignoreComments=True):
+        """
+        readline mode helper which returns the next row, undecoded and read a line at a time,
+        or None if there are no more rows.
         """
         lst = []
         isFirstLine = True
@@ -200,10 +942,8 @@ class Parser(object):
             ln = self.eFile.readline()
             if (not ln): #end of file
                 break
-            #Although EPF specifies its exports as utf-8, for some reason Python sometimes complains
-            #about out-of-ASCII characters unless we reencode as latin-1.
-            ln = unicode(ln, 'latin-1')
             if (isFirstLine and ignoreComments and ln.find(self.commentChar) == 0): #comment
+                self._noteTrailer(ln, self.eFile.tell() - len(ln))
                 continue
             lst.append(ln)
             if isFirstLine:
@@ -222,9 +962,25 @@ class Parser(object):
         Performs essentially the same task as nextRowString, but without constructing or returning anything.
         This allows much faster access to a record in the middle of the file.
         """
+        if self.recordIndex and (self.latestRecordNum % self.recordIndex.interval == 0):
+            self.recordIndex.addOffset(self.latestRecordNum, self.seekPos)
+        if self._cachePos is not None:
+            row = self.parseCache.nextRecord()
+            if row:
+                self._cachePos = row[1]
+                self.latestRecordNum += 1
+            return
+        if self.readMode in ("block", "mmap"):
+            if (self._nextMapRow() if self.readMode == "mmap" else self._nextBlockRow())[1]:
+                self.latestRecordNum += 1
+            elif self.recordIndex:
+                self.recordIndex.markComplete(self.latestRecordNum)
+            return
         while (True):
             ln = self.eFile.readline()
             if (not ln): #end of file
+                if self.recordIndex:
+                    self.recordIndex.markComplete(self.latestRecordNum)
                 return
             if (ln.find(self.commentChar) == 0): #comment; always skip
                 continue
@@ -232,7 +988,143 @@ class Parser(object):
                 break
         self.latestRecordNum += 1
         
+        
+    def _fillBuffer(self):
+        """
+        Block mode helper which discards the consumed part of the buffer and appends
+        the next blockSize bytes of the file to it.
+        
+        Returns False if the end of the file has been reached.
+        """
+        chunk = self.eFile.read(self.blockSize)
+        if not chunk:
+            return False
+        self._buffer = self._buffer[self._bufferPos:] + chunk
+        self._bufferPos = 0
+        return True
+        
+        
+    def _findInBuffer(self, sub):
+        """
+        Block mode helper which returns the index of sub in the buffer, at or after
+        self._bufferPos, reading more of the file as necessary.
+        
+        Returns -1 if sub does not occur before the end of the file.
+        """
+        searchFrom = 0 #relative to self._bufferPos, which _fillBuffer may change
+        while (True):
+            ix = self._buffer.find(sub, self._bufferPos + searchFrom)
+            if (ix != -1):
+                return ix
+            #a match may straddle the end of the buffer, so back up before searching again
+            searchFrom = max(0, len(self._buffer) - self._bufferPos - len(sub) + 1)
+            if not self._fillBuffer():
+                return -1
+        
+        
+    def _nextBlockRow(self, ignoreComments=True):
+        """
+        Block mode counterpart of the readline loop in nextRowString.
+        
+        Returns a tuple of the raw (undecoded) row string, or None at the end of the file,
+        and a bool which is True if the row was terminated by self.recordDelim.
+        
+        As in readline mode, comment lines are only skipped at the beginning of a row.
+        """
+        if ignoreComments:
+            while (True):
+                if (len(self._buffer) - self._bufferPos < len(self.commentChar)) and self._fillBuffer():
+                    continue
+                if not self._buffer.startswith(self.commentChar, self._bufferPos):
+                    break
+                ix = self._findInBuffer("\n")
+                end = (len(self._buffer) if ix == -1 else ix + 1)
+                self._noteTrailer(self._buffer[self._bufferPos:end], self.seekPos)
+                self._bufferPos = end
+        ix = self._findInBuffer(self.recordDelim)
+        isComplete = (ix != -1)
+        end = (ix + len(self.recordDelim) if isComplete else len(self._buffer))
+        rowString = self._buffer[self._bufferPos:end]
+        self._bufferPos = end
+        return ((rowString if rowString else None), isComplete)
+        
    
+    def _mapWindow(self, pos, minSize=0):
+        """
+        mmap mode helper which replaces the mapped window with one containing pos and the following
+        blockSize bytes (or minSize, if larger), or as many as there are before the end of the file.
+        
+        Unmapping the previous window lets its pages go, which keeps memory use flat.
+        """
+        if self._map:
+            self._map.close()
+            self._map = None
+        start = pos - pos % mmap.ALLOCATIONGRANULARITY #mmap offsets must be multiples of this
+        length = min(max(self.blockSize, minSize) + (pos - start), self._fileSize - start)
+        if (length > 0):
+            self._map = mmap.mmap(self.eFile.fileno(), length, access=mmap.ACCESS_READ, offset=start)
+        self._mapStart = start
+        
+        
+    def _ensureMapped(self, pos, minSize=0):
+        """
+        mmap mode helper which moves the window, if necessary, so that it contains pos
+        and at least minSize bytes after it (or as many as the file has).
+        """
+        if (not self._map) or (pos < self._mapStart) or (pos + minSize > self._mapStart + len(self._map)):
+            self._mapWindow(pos, minSize)
+        
+        
+    def _findInMap(self, sub, pos):
+        """
+        mmap mode helper which returns the file position of sub, at or after pos, moving or growing the
+        window so that it contains both pos and the match.
+        
+        Returns -1 if sub does not occur before the end of the file.
+        """
+        self._ensureMapped(pos)
+        searchFrom = pos
+        while (self._map):
+            ix = self._map.find(sub, searchFrom - self._mapStart)
+            if (ix != -1):
+                return self._mapStart + ix
+            mapEnd = self._mapStart + len(self._map)
+            if (mapEnd >= self._fileSize):
+                break
+            #a match may straddle the end of the window, so back up before searching again,
+            #in a window reaching further (the row beginning at pos must fit in it)
+            searchFrom = max(pos, mapEnd - len(sub) + 1)
+            self._mapWindow(pos, 2 * (mapEnd - pos))
+        return -1
+        
+        
+    def _nextMapRow(self, ignoreComments=True):
+        """
+        mmap mode counterpart of _nextBlockRow, with the same return value.
+        """
+        pos = self._mapPos
+        commentLength = len(self.commentChar)
+        if ignoreComments:
+            while (pos < self._fileSize):
+                self._ensureMapped(pos, commentLength)
+                offset = pos - self._mapStart
+                if (self._map[offset:offset + commentLength] != self.commentChar):
+                    break
+                ix = self._findInMap("\n", pos)
+                end = (self._fileSize if ix == -1 else ix + 1)
+                self._noteTrailer(self._map[pos - self._mapStart:end - self._mapStart], pos)
+                pos = end
+        if (pos >= self._fileSize):
+            self._mapPos = pos
+            return (None, False)
+        ix = self._findInMap(self.recordDelim, pos)
+        isComplete = (ix != -1)
+        end = (ix + len(self.recordDelim) if isComplete else self._fileSize)
+        rowString = self._map[pos - self._mapStart:end - self._mapStart]
+        self._mapPos = end
+        return ((rowString if rowString else None), isComplete)
+        
+        
     def splitRow(self, rowString, requiredPrefix=None):
         """
         Given rowString, strips requiredPrefix and self.recordDelim,
@@ -254,52 +1146,461 @@ class Parser(object):
         """
         Returns the next row of data as a list, or None if we're out of data.
         """
+        rec = self._nextSplitRecord()
+        if (rec is None):
+            return None
+        if (not self.profiler):
+            return self._fixupRecord(rec)
+        t = time.time()
+        rec = self._fixupRecord(rec)
+        self._profileFixup(time.time() - t, 1)
+        return rec
+        
+        
+    def nextRecords(self, maxNum=100, columnar=False, positions=None):
+        """
+        Returns the next maxNum records (or fewer if EOF) as a list of lists.
+        
+        The records are identical to those returned by nextRecord(), but the batch is fixed up
+        a column at a time (see _fixupBatch), which is considerably faster for tables with date columns.
+        If columnar is True, the batch is returned as a list of columns instead, each a list of
+        values, with any missing trailing fields filled in with self.emptyValue.
+        
+        If positions is a list, the seek position following each record is appended to it.
+        """
+        records = []
+        for j in range(maxNum):
+            rec = self._nextSplitRecord()
+            if (rec is None):
+                break
+            records.append(rec)
+            if positions is not None:
+                positions.append(self.seekPos)
+        if (not records):
+            return []
+        if (not self.profiler):
+            return self._fixupRecords(records, columnar=columnar)
+        t = time.time()
+        recordCount = len(records)
+        records = self._fixupRecords(records, columnar=columnar)
+        self._profileFixup(time.time() - t, recordCount)
+        return records
+        
+        
+    def _fixupRecords(self, records, columnar=False):
+        """
+        Fixes up a batch of split records for nextRecords(), with _fixupBatch unless some are short
+        a field or more, and returns them (as a list of columns if columnar is True).
+        """
+        width = len(self.columnNames)
+        for rec in records:
+            if (len(rec) != width):
+                break
+        else:
+            return self._fixupBatch(records, columnar=columnar)
+        #some rows are short a field or more
+        if columnar:
+            #fill in the missing fields, so that they become self.emptyValue
+            records = [(rec + [""] * (width - len(rec))) for rec in records]
+            return self._fixupBatch(records, columnar=True)
+        return [self._fixupRecord(rec) for rec in records] #exactly as nextRecord() would
+        
+        
+    def _nextSplitRecord(self):
+        """
+        Returns the next row of data split into a list of fields, without any fixups,
+        or None if we're out of data.
+        """
+        if self.recordIndex and (self.latestRecordNum % self.recordIndex.interval == 0):
+            self.recordIndex.addOffset(self.latestRecordNum, self.seekPos)
+        if self._cachePos is not None:
+            return self._nextCachedRecord()
+        cache = self.parseCache
+        if cache:
+            self._checkCacheWriting()
         rowString = self.nextRowString()
         if (rowString):
             self.latestRecordNum += 1 #update the record counter
+            if self.profiler:
+                t = time.time()
             rec = self.splitRow(rowString)
+            if cache and cache.isWriting():
+                cache.addRecord(rec, self.seekPos)
             rec = rec[:len(self.columnNames)] #if there are more data records than column names,
             #trim any surplus records via a slice
-            
-            #replace empty strings with NULL
-            for i in range(len(rec)):
-                val = rec[i]
-                rec[i] = ("NULL" if val == "" else val)
-
-            #massage dates into MySQL-compatible format.
-            #most date values look like '2009 06 21'; some are '2005-09-06-00:00:00-Etc/GMT'
-            #there are also some cases where there's only a year; we'll pad it out with a bogus month/day
-            yearMatch = re.compile(r"^\d\d\d\d$")
-            for j in self.dateColumns:
-                rec[j] = rec[j].strip().replace(" ", "-")[:19] #Include at most the first 19 chars
-                if yearMatch.match(rec[j]):
-                     rec[j] = "%s-01-01" % rec[j]
+            if self.profiler:
+                self.profiler.add("split", time.time() - t, 1, len(rowString))
+                self._unfixedBytes += len(rowString)
             return rec
         else:
+            if self.recordIndex:
+                self.recordIndex.markComplete(self.latestRecordNum)
+            if cache and cache.isWriting():
+                if self.endPos is None:
+                    cache.finish(self._dataEndPos, self._recordsExpected)
+                else:
+                    cache.abandon()
             return None
-                
         
-    def nextRecords(self, maxNum=100):
+        
+    def _nextCachedRecord(self):
         """
-        Returns the next maxNum records (or fewer if EOF) as a list of lists.
+        Returns the next record from the parse cache, as _nextSplitRecord would from the file.
+        
+        The cached fields are those of the whole row, so they are trimmed to the columns, as a copy
+        which the fixups can change.
+        """
+        if (self.endPos is not None) and (self._cachePos >= self.endPos):
+            return None
+        if self.profiler:
+            t = time.time()
+        row = self.parseCache.nextRecord()
+        if (row is None):
+            if self.recordIndex:
+                self.recordIndex.markComplete(self.latestRecordNum)
+            return None
+        self.latestRecordNum += 1
+        self._cachePos = row[1]
+        if self.profiler:
+            self.profiler.add("read", time.time() - t, 1, 0)
+        return row[0][:len(self.columnNames)]
+        
+        
+    def _checkCacheWriting(self):
+        """
+        Starts writing the parse cache's entry when the file's first record is about to be read
+        (unless only a byte range of it is being read), and abandons it if the parser then reads
+        anything but the following records.
+        """
+        cache = self.parseCache
+        if cache.isComplete:
+            return
+        pos = self.seekPos
+        if cache.isWriting():
+            if (self.latestRecordNum != cache.writtenCount) or (pos != cache.lastPos):
+                cache.abandon()
+        elif (self.latestRecordNum == 0) and (pos <= self.dataStartPos) and (self.endPos is None):
+            cache.startWriting(self.dataStartPos)
+        
+        
+    def _profileFixup(self, seconds, recordCount):
+        """
+        Adds seconds spent fixing up recordCount records, and the bytes they were split from,
+        to the profiler's fixup stage.
+        """
+        self.profiler.add("fixup", seconds, recordCount, self._unfixedBytes)
+        self._unfixedBytes = 0
+        
+        
+    def _fixupRecord(self, rec):
+        """
+        Replaces empty fields of the split record rec with self.emptyValue and massages its dates
+        into MySQL-compatible format, returning rec.
+        """
+        #replace empty strings with NULL
+        emptyValue = self.emptyValue
+        for i in range(len(rec)):
+            val = rec[i]
+            rec[i] = (emptyValue if val == "" else val)
+        
+        #massage dates into MySQL-compatible format.
+        #most date values look like '2009 06 21'; some are '2005-09-06-00:00:00-Etc/GMT'
+        #there are also some cases where there's only a year; we'll pad it out with a bogus month/day
+        for j in self.dateColumns:
+            if rec[j] is None:
+                continue
+            rec[j] = rec[j].strip().replace(" ", "-")[:19] #Include at most the first 19 chars
+            if YEAR_PATTERN.match(rec[j]):
+                 rec[j] = "%s-01-01" % rec[j]
+        if self.typed:
+            #convert the fields the record has; a short one isn't an error here
+            for j in self._convertedColumns:
+                if (j < len(rec)) and (rec[j] is not None):
+                    rec[j] = self._convertField(j, rec[j])
+        return rec
+        
+        
+    def _fixupBatch(self, records, columnar=False):
+        """
+        Applies the same fixups as _fixupRecord to a batch of split records with one field per column,
+        returning them as a list of records, or as a list of columns if columnar is True.
+        
+        Empty fields are replaced with a list comprehension per record (or per column), and dates
+        are massaged a column at a time by _fixupDate, which remembers the values it has seen.
+        If self.typed is True, the fields are then converted a column at a time.
+        """
+        emptyValue = self.emptyValue
+        cachedDate = self._dateCache.get
+        fixupDate = self._fixupDate
+        if columnar:
+            dateColumns = set(self.dateColumns)
+            columns = []
+            for j, col in enumerate(zip(*records)):
+                #the fields are all strings, so only the empty ones are false
+                col = [(val or emptyValue) for val in col]
+                if j in dateColumns:
+                    col = [(cachedDate(val) or fixupDate(val)) for val in col]
+                columns.append(col)
+            if self.typed:
+                for j in self._convertedColumns:
+                    self._convertColumn(j, columns[j])
+            return columns
+        records = [[(val or emptyValue) for val in rec] for rec in records]
+        for j in self.dateColumns:
+            for rec in records:
+                val = rec[j]
+                rec[j] = (cachedDate(val) or fixupDate(val))
+        if self.typed:
+            self._convertRecords(records)
+        return records
+        
+        
+    def _convertRecords(self, records):
+        """
+        Converts the fields of each column in records with the column's converter, in place
+        (e.g. '42' to 42, '9.99' to Decimal('9.99') and '2009-06-21' to a datetime.date),
+        so that they can be passed to the database as typed parameters. Fields which can't be
+        converted are passed through unchanged; see _convertField().
+        """
+        converters = self.converters
+        for j in self._convertedColumns:
+            convert = converters[j]
+            for rec in records:
+                val = rec[j]
+                if val is not None:
+                    try:
+                        rec[j] = convert(val)
+                    except (ValueError, decimal.InvalidOperation):
+                        self._conversionError(j, val)
+        
+        
+    def _convertColumn(self, j, values):
+        """
+        Converts the fields in values, a list of column j's fields, in place; see _convertRecords().
+        """
+        convert = self.converters[j]
+        for i in range(len(values)):
+            val = values[i]
+            if val is not None:
+                try:
+                    values[i] = convert(val)
+                except (ValueError, decimal.InvalidOperation):
+                    self._conversionError(j, val)
+        
+        
+    def _convertField(self, j, val):
+        """
+        Returns val, a field of column j, converted with the column's converter,
+        or val itself if it can't be converted.
+        """
+        try:
+            return self.converters[j](val)
+        except (ValueError, decimal.InvalidOperation):
+            self._conversionError(j, val)
+            return val
+        
+        
+    def _conversionError(self, j, val):
+        """
+        Counts (and for the first few of each column, logs) a field of column j which couldn't be converted.
+        The field is passed through as a string, for the database to accept or reject.
+        """
+        colName = self.columnNames[j]
+        errorCount = self.conversionErrors.get(colName, 0) + 1
+        self.conversionErrors[colName] = errorCount
+        if (errorCount <= Parser.maxConversionWarnings):
+            LOGGER.warning("Can't convert %r in column %s of %s to %s; passing it through",
+                val, colName, os.path.basename(self.filePath), self.dataTypes[j])
+        
+        
+    def _fixupDate(self, val):
+        """
+        Returns the date value val massaged as by _fixupRecord, remembering the result
+        in self._dateCache (which is emptied once it holds dateCacheSize values).
+        """
+        if val is None:
+            return None
+        fixed = val.strip().replace(" ", "-")[:19] #Include at most the first 19 chars
+        if YEAR_PATTERN.match(fixed):
+            fixed = "%s-01-01" % fixed
+        if (len(self._dateCache) >= Parser.dateCacheSize):
+            self._dateCache.clear()
+        self._dateCache[val] = fixed
+        return fixed
+        
+        
+class RecordSorter(object):
+    """
+    Reads the remaining records of a Parser and returns them sorted by its primary key,
+    using an external merge sort: records are collected until they take up about memoryLimit
+    bytes, then each such run is sorted and spilled to a temporary file in tmpDir, and finally
+    the runs are merged as the records are read back. If the records fit in a single run,
+    nothing is spilled.
+    
+    Numeric key columns are compared as numbers and the rest as strings, which only approximates
+    the database's collation, but is enough to make most inserts land at the end of the index.
+    
+    Call sort() first. The sorter can then be read with nextRecord() and nextRecords() in place
+    of the parser, whose other attributes it passes through. close() deletes the temporary files.
+    """
+    recordsPerBatch = 1000 #records per pickled batch in the run files
+    
+    def __init__(self, parser, memoryLimit=268435456, tmpDir=None):
+        self.parser = parser
+        self.memoryLimit = memoryLimit
+        self.tmpDir = tmpDir
+        self.runPaths = []
+        self.startRecordNum = 0
+        self.recordCount = 0
+        self.returnedCount = 0
+        self.spilledBytes = 0
+        self.sortTime = 0.0 #seconds spent reading, sorting and spilling the records
+        self.mergeTime = 0.0 #seconds spent merging the runs as the records are returned
+        self._run = [] #the sorted records, if they weren't spilled
+        self._records = None #iterator over the sorted records, or (key, record) tuples if they were spilled
+        self._keyIndexes = [parser.columnNames.index(aCol) for aCol in parser.primaryKey]
+        self._numberIndexes = set(parser.numberColumns)
+        
+        
+    def __getattr__(self, name):
+        return getattr(self.parser, name)
+        
+        
+    def getLatestRecordNum(self):
+        return self.startRecordNum + self.returnedCount
+        
+    latestRecordNum = property(fget=getLatestRecordNum, doc="Number of records read so far, as for a Parser")
+    
+    
+    def getSeekPos(self):
+        return self.parser.seekPos
+        
+    seekPos = property(fget=getSeekPos, doc="Seek position of the parser, which is past all the sorted records")
+    
+    
+    def sort(self):
+        """
+        Reads all of the parser's remaining records, sorting them into runs.
+        """
+        startTime = time.time()
+        self.startRecordNum = self.parser.latestRecordNum
+        run = []
+        runSize = 0
+        while (True):
+            records = self.parser.nextRecords(RecordSorter.recordsPerBatch)
+            if (not records):
+                break
+            for rec in records:
+                run.append(rec)
+                #a rough estimate of the memory taken up by the record's field strings (or typed values) and list
+                runSize += sum([(len(aField) if isinstance(aField, basestring) else 8) for aField in rec]) * 2 + 64 * len(rec)
+                if (runSize >= self.memoryLimit):
+                    self._spill(run)
+                    run = []
+                    runSize = 0
+        self.recordCount = self.parser.latestRecordNum - self.startRecordNum
+        if self.runPaths:
+            if run:
+                self._spill(run)
+        else:
+            run.sort(key=self._key)
+            self._run = run
+        self.rewind()
+        self.sortTime = time.time() - startTime
+        
+        
+    def rewind(self):
+        """
+        Starts returning the sorted records from the first one again.
+        """
+        self.returnedCount = 0
+        if self.runPaths:
+            self._records = heapq.merge(*[self._readRun(aPath) for aPath in self.runPaths])
+        else:
+            self._records = iter(self._run)
+        
+        
+    def nextRecord(self):
+        """
+        Returns the next record in key order, or None if there are no more.
+        """
+        startTime = time.time()
+        try:
+            rec = self._records.next()
+        except StopIteration:
+            return None
+        finally:
+            self.mergeTime += time.time() - startTime
+        self.returnedCount += 1
+        return (rec[1] if self.runPaths else rec)
+        
+        
+    def nextRecords(self, maxNum=100, positions=None):
+        """
+        Returns the next maxNum records (or fewer if there are no more) in key order.
+        
+        If positions is a list, the seek position (which is past all the sorted records)
+        is appended to it for each record, as for Parser.nextRecords.
         """
         records = []
         for j in range(maxNum):
-            lst = self.nextRecord()
-            if (not lst):
+            rec = self.nextRecord()
+            if (not rec):
                 break
-            records.append(lst)
+            records.append(rec)
+        if positions is not None:
+            positions.extend([self.seekPos] * len(records))
         return records
-                
         
-    def nextRecordDict(self):
+        
+    def close(self):
         """
-        Returns the next row of data as a dictionary, keyed by the column names.
+        Deletes the run files.
         """
-        vals = self.nextRecord()
-        if (not vals):
-            return None
-        else:
-            keys = self.columnNames
-            return dict(zip(keys, vals))
-
+        for aPath in self.runPaths:
+            try:
+                os.remove(aPath)
+            except OSError:
+                pass
+        self.runPaths = []
+        
+        
+    def _key(self, rec):
+        key = []
+        for j in self._keyIndexes:
+            val = rec[j]
+            if j in self._numberIndexes:
+                try:
+                    val = int(val)
+                except (TypeError, ValueError):
+                    pass
+            key.append(val)
+        return tuple(key)
+        
+        
+    def _spill(self, run):
+        """
+        Sorts run and writes it to a temporary file, in pickled batches of recordsPerBatch records
+        (pickled rather than marshalled, since typed records contain Decimals and dates).
+        """
+        run.sort(key=self._key)
+        fd, runPath = tempfile.mkstemp(prefix="epfsort_", dir=self.tmpDir)
+        self.runPaths.append(runPath)
+        with os.fdopen(fd, "wb") as f:
+            for j in range(0, len(run), RecordSorter.recordsPerBatch):
+                cPickle.dump(run[j:j + RecordSorter.recordsPerBatch], f, cPickle.HIGHEST_PROTOCOL)
+            self.spilledBytes += f.tell()
+        
+        
+    def _readRun(self, runPath):
+        """
+        A generator which yields a (key, record) tuple for each record in the run file at runPath.
+        """
+        with open(runPath, "rb") as f:
+            while (True):
+                try:
+                    batch = cPickle.load(f)
+                except EOFError:
+                    break
+                for rec in batch:
+                    yield (self._key(rec), rec)
@@ -0,0 +1,152 @@
+#
+# File: EPFProfiler.py
+# Abstract: The EPFProfiler.py module times the stages of an EPF ingest and reports their throughput.
+# Version: 1.0
+# 
+# Disclaimer: IMPORTANT:  This Apple software is supplied to you by Apple
+# Inc. ("Apple") in consideration of your agreement to the following
+# terms, and your use, installation, modification or redistribution of
+# this Apple software constitutes acceptance of these terms.  If you do
+# not agree with these terms, please do not use, install, modify or
+# redistribute this Apple software.
+# 
+# In consideration of your agreement to abide by the following terms, and
+# subject to these terms, Apple grants you a personal, non-exclusive
+# license, under Apple's copyrights in this original Apple software (the
+# "Apple Software"), to use, reproduce, modify and redistribute the Apple
+# Software, with or without modifications, in source and/or binary forms;
+# provided that if you redistribute the Apple Software in its entirety and
+# without modifications, you must retain this notice and the following
+# text and disclaimers in all such redistributions of the Apple Software.
+# Neither the name, trademarks, service marks or logos of Apple Inc. may
+# be used to endorse or promote products derived from the Apple Software
+# without specific prior written permission from Apple.  Except as
+# expressly stated in this notice, no other rights or licenses, express or
+# implied, are granted by Apple herein, including but not limited to any
+# patent rights that may be infringed by your derivative works or by other
+# works in which the Apple Software may be incorporated.
+# 
+# The Apple Software is provided by Apple on an "AS IS" basis.  APPLE
+# MAKES NO WARRANTIES, EXPRESS OR IMPLIED, INCLUDING WITHOUT LIMITATION
+# THE IMPLIED WARRANTIES OF NON-INFRINGEMENT, MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE, REGARDING THE APPLE SOFTWARE OR ITS USE AND
+# OPERATION ALONE OR IN COMBINATION WITH YOUR PRODUCTS.
+# 
+# IN NO EVENT SHALL APPLE BE LIABLE FOR ANY SPECIAL, INDIRECT, INCIDENTAL
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) ARISING IN ANY WAY OUT OF THE USE, REPRODUCTION,
+# MODIFICATION AND/OR DISTRIBUTION OF THE APPLE SOFTWARE, HOWEVER CAUSED
+# AND WHETHER UNDER THEORY OF CONTRACT, TORT (INCLUDING NEGLIGENCE),
+# STRICT LIABILITY OR OTHERWISE, EVEN IF APPLE HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#  
+# Copyright (C) 2010 Apple Inc. All Rights Reserved.
+#
+
+import os
+import json
+import datetime
+
+#The stages of an ingest, in the order records pass through them
+STAGES = ("read", "decode", "split", "fixup", "escape", "build", "execute")
+
+
+class Profiler(object):
+    """
+    Accumulates the time spent in each stage of ingesting an EPF file, along with the number
+    of rows and bytes which passed through it:
+    
+        read:    reading each row's bytes from the file (or copying LOAD DATA chunks from it)
+        decode:  decoding rows as latin-1
+        split:   splitting rows into fields
+        fixup:   replacing empty fields, massaging dates and converting typed fields
+        escape:  escaping the fields of each row for SQL
+        build:   building statements (or writing LOAD DATA chunks)
+        execute: executing them
+    
+    The parser adds the first four stages (see EPFParser.Parser) and the ingester the rest.
+    fixup counts the bytes of the rows as they were read, and execute counts none for
+    parameterized statements.
+    
+    Each stage is kept as a [seconds, rows, bytes] list. The threads of a pipelined ingest
+    add to different stages, so they can share a Profiler.
+    """
+    
+    def __init__(self, filePath, tableName):
+        self.filePath = filePath
+        self.tableName = tableName
+        self.startTime = datetime.datetime.now()
+        self.stages = dict([(aStage, [0.0, 0, 0]) for aStage in STAGES])
+        
+        
+    def add(self, stage, seconds, rows=0, byteCount=0):
+        """
+        Adds seconds, rows and byteCount to the totals for stage.
+        """
+        totals = self.stages[stage]
+        totals[0] += seconds
+        totals[1] += rows
+        totals[2] += byteCount
+        
+        
+    def merge(self, stages):
+        """
+        Adds the totals in stages (the stages attribute of another Profiler, such as
+        that of one of the workers of a split ingest) to this one's.
+        """
+        for aStage, (seconds, rows, byteCount) in stages.items():
+            self.add(aStage, seconds, rows, byteCount)
+            
+            
+    def report(self, **info):
+        """
+        Returns a dictionary describing the profiled ingest: the file and table, when profiling began
+        and how long ago that was, and for each stage, its total seconds, rows and bytes, its rows
+        and bytes per second, and its share of the time spent in all the stages.
+        
+        Any keyword arguments are included as well; EPFIngester.Ingester.writeProfile passes
+        the number of records ingested (as "records"), which is also given per second of elapsed time.
+        """
+        elapsed = (datetime.datetime.now() - self.startTime)
+        elapsedSeconds = elapsed.days * 86400 + elapsed.seconds + elapsed.microseconds / 1000000.0
+        totalSeconds = sum([totals[0] for totals in self.stages.values()])
+        stageDict = {}
+        for aStage in STAGES:
+            seconds, rows, byteCount = self.stages[aStage]
+            stageDict[aStage] = {"seconds":round(seconds, 6),
+                "rows":rows,
+                "bytes":byteCount,
+                "rowsPerSecond":_rate(rows, seconds),
+                "bytesPerSecond":_rate(byteCount, seconds),
+                "share":_rate(seconds, totalSeconds)}
+        reportDict = {"filePath":self.filePath,
+            "tableName":self.tableName,
+            "startTime":str(self.startTime),
+            "elapsedSeconds":round(elapsedSeconds, 6),
+            "stageOrder":list(STAGES),
+            "stages":stageDict}
+        reportDict.update(info)
+        if reportDict.get("records") is not None:
+            reportDict["recordsPerSecond"] = _rate(reportDict["records"], elapsedSeconds)
+        return reportDict
+        
+        
+    def write(self, path, **info):
+        """
+        Writes report(**info) to path as JSON, creating its directory if necessary.
+        """
+        dirPath = os.path.dirname(path)
+        if dirPath and not os.path.isdir(dirPath):
+            os.makedirs(dirPath)
+        with open(path, mode="w") as f:
+            json.dump(self.report(**info), f, indent=4, sort_keys=True)
+            
+            
+def _rate(amount, seconds):
+    """
+    Returns amount / seconds rounded to 2 places, or None if seconds is 0.
+    """
+    if (not seconds):
+        return None
+    return round(amount / float(seconds), 2)